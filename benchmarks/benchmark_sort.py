@@ -0,0 +1,320 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import time
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from matchminer.matchengine_v1.sort import add_sort_order
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+
+def add_sort_order_legacy(trial_match_df):
+    """
+    Row by row implementation of add_sort_order, which the vectorized one is tested and timed against.
+
+    Aggregate all the trial matches by MRN and provide a sort order using the following logic:
+    (1) First sort by tier
+    (2) Then sort by match_type (variant > gene)
+    (3) Then sort by cancer type (specific cancer type > all solid/liquid)
+    (4) Then sort by coordinating center (DFCI > MGH)
+    (5) Then sort by reverse protocol number (high > low)
+
+    :param trial_matches: List of trial match dictionaries
+    :return: List of trial match dictionaries with two additional columns:
+        (1) sort_order: Order in which to display the matches
+        (2) freq: Frequency with which this trial match appears throughout the entire patient cohort
+    """
+
+    if len(trial_match_df.index) == 0:
+        return trial_match_df
+
+    f1 = (trial_match_df['vital_status'] == 'alive')
+    f2 = (trial_match_df['trial_accrual_status'] == 'open')
+    f3 = (trial_match_df['genomic_alteration'].str.strip().str.title() != 'Structural Variation')
+    all_sample_ids = trial_match_df.sample_id.unique().tolist()
+    master_sort_order = {}
+
+    for sample_id in all_sample_ids:
+        f4 = (trial_match_df['sample_id'] == sample_id)
+        df = trial_match_df[f1 & f2 & f3 & f4]
+        matches = list(df.T.to_dict().values())
+
+        # The sort order dictionary keeps track of the priority for each sort category for each match
+        # Index 0 is sorted by tier with values 0 to 7
+        # Index 1 is sorted by match type with values 0 to 1
+        # Index 2 is sorted by cancer type match with values 0 to 2
+        # Index 3 is sorted by coordinating center with values 0 to 1
+        # Index 4 is sorted by reverse protocol number
+        sort_order = {}
+
+        for match in matches:
+
+            idx = (match['sample_id'], match['protocol_no'])
+            if idx not in sort_order:
+                sort_order[idx] = []
+
+            sort_order = sort_by_tier(match, sort_order)
+            sort_order = sort_by_match_type(match, sort_order)
+            sort_order = sort_by_cancer_type(match, sort_order)
+            sort_order = sort_by_coordinating_center(match, sort_order)
+
+        sort_order = sort_by_reverse_protocol_no(matches, sort_order)
+
+        # for k, v in sort_order.iteritems():
+        #     print '%s | %s' % (k, v)
+
+        master_sort_order = final_sort(sort_order, master_sort_order)
+
+    trial_match_df['sort_order'] = trial_match_df.apply(lambda x: master_sort_order[(x['sample_id'], x['protocol_no'])]
+                                                        if (x['sample_id'], x['protocol_no']) in master_sort_order
+                                                        else -1, axis=1)
+    return trial_match_df
+
+
+def sort_by_tier(match, sort_order):
+    """
+    Highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'mmr_status' in match and pd.notnull(match['mmr_status']):
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 1:
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 2:
+        sort_order[idx] = add_sort_value(sort_value=2,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'variant_category' in match and match['variant_category'] == 'CNV':
+        sort_order[idx] = add_sort_value(sort_value=3,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 3:
+        sort_order[idx] = add_sort_value(sort_value=4,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 4:
+        sort_order[idx] = add_sort_value(sort_value=5,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'wildtype' in match and match['wildtype'] is True:
+        sort_order[idx] = add_sort_value(sort_value=6,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    else:
+        sort_order[idx] = add_sort_value(sort_value=7,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_match_type(match, sort_order):
+    """
+    Second highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'match_type' in match and match['match_type'] == 'variant':
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=1,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'match_type' in match and match['match_type'] == 'gene':
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=1,
+                                         sort_order_li=sort_order[idx])
+    else:
+        sort_order[idx] = add_sort_value(sort_value=2,
+                                         priority=1,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_cancer_type(match, sort_order):
+    """
+    Third highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'cancer_type_match' in match and match['cancer_type_match'] == 'specific':
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'cancer_type_match' in match and match['cancer_type_match'] == 'all_solid':
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'cancer_type_match' in match and match['cancer_type_match'] == 'all_liquid':
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    else:
+        sort_order[idx] = add_sort_value(sort_value=2,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_coordinating_center(match, sort_order):
+    """
+    Fourth highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'coordinating_center' in match and match['coordinating_center'] == 'Dana-Farber Cancer Institute':
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=3,
+                                         sort_order_li=sort_order[idx])
+    else:
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=3,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_reverse_protocol_no(matches, sort_order):
+    """
+    Lowest priority sorting
+    """
+
+    rev_prot_no_sort = sorted(matches, key=lambda k: int(k['protocol_no'].split('-')[0]))
+    i = 0
+
+    for match in rev_prot_no_sort[::-1]:
+
+        if len(sort_order[(match['sample_id'], match['protocol_no'])]) == 4:
+            sort_order[(match['sample_id'], match['protocol_no'])].append(i)
+            i += 1
+
+    return sort_order
+
+
+def final_sort(sort_order, master_sort_order):
+
+    cols = ['tier', 'match_type', 'cancer_type', 'coordinating_center', 'rev_protocol_no']
+    sort_order_df = pd.DataFrame(list(sort_order.values()), columns=cols, index=list(sort_order.keys()))
+    sort_order_df.sort_values(by=cols, axis=0, ascending=True, inplace=True)
+
+    j = 0
+    for idx, row in sort_order_df.iterrows():
+        master_sort_order[idx] = j
+        j += 1
+
+    return master_sort_order
+
+
+def add_sort_value(sort_value, priority, sort_order_li):
+    """
+    Adds the sort value, independent of the logic required to assess and determine that value.
+    Accepts the lowest sort_value when there are multiple matches.
+
+    :param sort_value: Integer value that determines sort order
+    :param priority: Integer that determines which column to assign the sort value
+        (e.g. tier, match_type, etc.)
+    :param sort_order_li: The match-specific sort order list so far
+    """
+
+    if len(sort_order_li) >= priority + 1:
+
+        if sort_value < sort_order_li[priority]:
+            sort_order_li[priority] = sort_value
+    else:
+        sort_order_li.append(sort_value)
+
+    return sort_order_li
+
+
+def synthetic_trial_matches(rows, samples, protocols=500, seed=0):
+    """
+    Builds a random trial match table with the columns used by add_sort_order
+
+    :param rows: number of trial matches
+    :param samples: number of distinct sample ids
+    :param protocols: number of distinct protocol numbers
+    :param seed: random seed
+    :return: trial match dataframe
+    """
+
+    rs = np.random.RandomState(seed)
+    protocol_nos = np.array(['%02d-%03d' % (rs.randint(0, 20), i) for i in range(protocols)], dtype=object)
+    tiers = np.array([1, 2, 3, 4, np.nan], dtype=object)
+
+    return pd.DataFrame({
+        'sample_id': np.array(['S%06d' % i for i in rs.randint(0, samples, rows)], dtype=object),
+        'protocol_no': protocol_nos[rs.randint(0, protocols, rows)],
+        'vital_status': rs.choice(['alive', 'alive', 'alive', 'deceased'], rows),
+        'trial_accrual_status': rs.choice(['open', 'open', 'open', 'closed'], rows),
+        'genomic_alteration': rs.choice(['KRAS p.G12D', 'EGFR', 'Structural Variation', '!TP53'], rows),
+        'tier': tiers[rs.randint(0, len(tiers), rows)],
+        'mmr_status': rs.choice([None, None, None, None, 'MMR-D/MSI-H'], rows),
+        'variant_category': rs.choice(['MUTATION', 'CNV', 'SV', None], rows),
+        'wildtype': rs.choice([True, False, None], rows),
+        'match_type': rs.choice(['variant', 'gene', 'other'], rows),
+        'cancer_type_match': rs.choice(['specific', 'all_solid', 'all_liquid', 'unknown'], rows),
+        'coordinating_center': rs.choice(['Dana-Farber Cancer Institute', 'Massachusetts General Hospital'], rows),
+    })
+
+
+def run_benchmark(rows, samples, legacy=True):
+    """
+    Times add_sort_order against the legacy implementation and checks both agree
+
+    :param rows: number of trial matches
+    :param samples: number of distinct sample ids
+    :param legacy: also time the legacy implementation
+    """
+
+    df = synthetic_trial_matches(rows, samples)
+    logging.info('benchmarking add_sort_order on %d matches of %d samples' % (rows, samples))
+
+    start = time.time()
+    new = add_sort_order(df.copy())
+    logging.info('vectorized: %.2fs' % (time.time() - start))
+
+    if not legacy:
+        return
+
+    start = time.time()
+    old = add_sort_order_legacy(df.copy())
+    logging.info('legacy: %.2fs' % (time.time() - start))
+
+    if not new['sort_order'].equals(old['sort_order']):
+        raise AssertionError('sort orders differ')
+    logging.info('sort orders are identical')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark add_sort_order')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--skip-legacy', dest='legacy', action='store_false')
+    args = parser.parse_args()
+
+    run_benchmark(args.rows, args.samples, legacy=args.legacy)
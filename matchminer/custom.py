@@ -11,7 +11,6 @@ from urllib.parse import urlparse
 from bson import ObjectId
 
 import simplejson as json
-import oncotreenx
 from requests import post, get
 from requests.auth import HTTPBasicAuth
 
@@ -19,10 +18,12 @@ from matchminer import settings, database
 from matchminer import data_model
 import matchminer.miner
 from matchminer.elasticsearch import reset_elasticsearch
-from matchminer.miner import _count_matches_by_filter
+from matchminer.miner import _count_matches_by_filter, recover_filter_jobs
+from matchminer.oncotree import get_oncotree
+from matchminer.event_hooks.trial_match import rank_trial_matches
 from matchminer.settings import *
 from matchminer.utilities import parse_resource_field, nocache, reannotate_trials
-from matchminer.security import auth_required
+from matchminer.security import auth_required, find_token_user, invalidate_user_tokens
 import logging
 
 import matchengine.internals.engine
@@ -100,7 +101,7 @@ def get_vip_clinical():
         return json.dumps({"error": "no authorization supplied"})
 
     accounts = db.user
-    user = accounts.find_one({'token': auth.username})
+    user = find_token_user(accounts, auth.username)
     if not user:
         return json.dumps({"error": "not authorized"})
 
@@ -146,6 +147,7 @@ def rerun_filters_endpoint(silent=False):
     """
     Trigger filter run.
     Run in a separate thread to return response & not run multiple full filter runs simultaneously.
+    While filters are running, the run is queued and started once the current run is done.
     :param silent: Suppress email notification. Will generate emails by default
     :return:
     """
@@ -156,19 +158,24 @@ def rerun_filters_endpoint(silent=False):
     # Allow default values to be overridden in POST data params
     datapush_id = None
     silent = False
+    incremental = False
     if request.data:
         data = request.get_json()
         datapush_id = data.get('data_push_id', None)
         silent = data.get('silent', None)
+        incremental = data.get('incremental', False)
 
-    is_currently_running = list(db.active_processes.find())
-    if len(is_currently_running) > 0:
+    owner = uuid.uuid4().hex
+    if not matchminer.miner.acquire_filter_lock(db, owner):
+        matchminer.miner.queue_filter_run(db, silent, datapush_id, incremental)
         msg = "Filters already running"
-        response = {msg: True}
+        response = {msg: True, "queued": True}
     else:
-        msg = f"Full filters run started. Datapush id: {str(datapush_id)}. Silent: {str(silent)}"
+        run_type = "Incremental" if incremental else "Full"
+        msg = f"{run_type} filters run started. Datapush id: {str(datapush_id)}. Silent: {str(silent)}"
         response = {msg: True}
-        thread = threading.Thread(target=matchminer.miner.start_filter_run, daemon=True, args=[silent, datapush_id])
+        thread = threading.Thread(target=matchminer.miner.start_filter_run, daemon=True,
+                                  args=[silent, datapush_id, incremental, owner])
         thread.start()
 
     logging.info(msg)
@@ -183,8 +190,7 @@ def rerun_filters_endpoint(silent=False):
 def is_engine_running():
     db = database.get_db()
 
-    running_processes = list(db.active_processes.find())
-    is_running = True if len(running_processes) > 0 else False
+    is_running = matchminer.miner.is_filter_run_active(db)
 
     logging.info(f"/api/is_matchengine_running {str(is_running)}")
     resp = Response(response=json.dumps({"is_running": is_running}),
@@ -193,6 +199,57 @@ def is_engine_running():
     return resp
 
 
+@blueprint.route('/api/filter_run_log', methods=['GET'])
+@nocache
+@auth_required
+def filter_run_log():
+    """
+    Reports the latest filter runs with the wall time and database counters of each stage,
+    and of the query stage of every filter, slowest first.
+    :return:
+    """
+    limit = request.args.get('limit', 1, type=int)
+
+    db = database.get_db()
+    runs = list(db.filter_run_log.find({}, {'_id': 0}).sort('start_time', -1).limit(limit))
+
+    resp = Response(response=json.dumps(runs, default=str),
+                    status=200,
+                    mimetype="application/json")
+    return resp
+
+
+@blueprint.route('/api/filter_job/<job_id>', methods=['GET'])
+@nocache
+@auth_required
+def filter_job_status(job_id):
+    """
+    Reports the status of a filter matching job, see matchminer.miner.submit_filter_job.
+    Once the job is done the response includes the filter's num_samples and enrollment.
+    :param job_id:
+    :return:
+    """
+    if not ObjectId.is_valid(job_id):
+        return Response(response=json.dumps({"error": "invalid job id"}), status=400, mimetype="application/json")
+
+    db = database.get_db()
+    recover_filter_jobs(db)
+    job = db.filter_job.find_one({"_id": ObjectId(job_id)}, {"owner": 0})
+    if job is None:
+        return Response(response=json.dumps({"error": "job not found"}), status=404, mimetype="application/json")
+
+    job['_id'] = str(job['_id'])
+    job['filter_id'] = str(job['filter_id'])
+    for field in ['created', 'started', 'finished', 'heartbeat', 'expires']:
+        if job.get(field) is not None:
+            job[field] = job[field].strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+    resp = Response(response=json.dumps(job),
+                    status=200,
+                    mimetype="application/json")
+    return resp
+
+
 @blueprint.route('/api/reannotate_trials', methods=['POST'])
 @nocache
 @auth_required
@@ -224,6 +281,8 @@ def run_matchengine():
         me_prod.get_matches_for_all_trials()
         me_prod.update_all_matches()
 
+    rank_trial_matches(app.data.driver.db)
+
     reset_elasticsearch()
     resp = Response(response=json.dumps({"success": True}),
                     status=200,
@@ -341,6 +400,7 @@ def build_redirect_url_epic(user, trial_match):
     db['user'].update_one({'_id': user['_id']}, {
         '$set': {'token': token, 'last_auth': datetime.datetime.now()}
     })
+    invalidate_user_tokens(user['_id'])
 
     # Build redirect URL
     patient_id = str(trial_match["_id"])
@@ -486,7 +546,7 @@ def count_query():
     token = request.authorization.username
 
     # find the user.
-    user = accounts.find_one({'token': token})
+    user = find_token_user(accounts, token)
 
     # extract counts
     db = database.get_db()
@@ -538,14 +598,14 @@ def unique_query():
     # special case for oncotree.
     if resource == 'clinical' and field == 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME':
 
-        # make oncotree.
-        onco_tree = oncotreenx.build_oncotree(settings.DATA_ONCOTREE_FILE)
+        # get the cached oncotree.
+        onco_tree = get_oncotree(settings.DATA_ONCOTREE_FILE)
 
         # turn into
         results = list()
-        for n in onco_tree.nodes():
+        for n in onco_tree.graph.nodes():
             tmp = {
-                'text': onco_tree.node[n]['text'],
+                'text': onco_tree.text(n),
                 'code': n
             }
             results.append(tmp)
@@ -757,6 +817,7 @@ def saml(page=None):
             'token': str(uuid.uuid4()),
             'last_auth': datetime.datetime.now()
         }})
+        invalidate_user_tokens(user['_id'])
 
         # redirect to the slo at idp
         return response
@@ -813,6 +874,7 @@ def saml(page=None):
             result = db['user'].update_one({'_id': user['_id']}, {
                 '$set': {'token': token, 'last_auth': datetime.datetime.now()}
             })
+            invalidate_user_tokens(user['_id'])
 
             # set redirect url.
             redirect_url = settings.ACS_URL
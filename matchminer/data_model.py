@@ -1668,6 +1668,8 @@ trial_match_schema = {
     'clinical_id': {'type': 'objectid'},
     'genomic_id': {'type': 'objectid'},
     'sort_order': {'type': 'integer'},
+    'rank': {'type': 'integer', 'readonly': True},
+    'sort_rank': {'type': 'integer', 'readonly': True},
     'trial_summary_status': {'type': 'string', 'required': False},
     'show_in_ui': {'type': 'boolean', 'required': False},
     'is_disabled': {'type': 'boolean', 'required': False}
@@ -146,14 +146,7 @@ def align_matches_clinical(a):
             enrolled.add(match['FILTER_ID'])
 
     # grab all filters.
-    filters = list()
-    for filter_id in matches:
-
-        # get filter.
-        filter = filter_db.find_one(filter_id)
-
-        # save it to list.
-        filters.append(filter)
+    filters = list(filter_db.find({'_id': {'$in': list(matches)}}, {'filter_hash': 0}))
 
     # embed in object.
     a['FILTER'] = filters
@@ -102,22 +102,30 @@ def align_matches_genomic(a):
 
             variants[variant_id].append(match['FILTER_ID'])
 
+    # fetch the active filters of the user's teams at once.
+    filter_ids = list(set(filter_id for filter_ids in variants.values() for filter_id in filter_ids))
+    teams = set(user['teams'])
+    filters = dict()
+    for filter_doc in (filter_db.find({'_id': {'$in': filter_ids}}, {'filter_hash': 0}) if filter_ids else []):
+
+        # check status.
+        if filter_doc['status'] != 1:
+            continue
+
+        # check ownership.
+        if filter_doc['TEAM_ID'] not in teams:
+            continue
+
+        filters[filter_doc['_id']] = filter_doc
+
     for item in a['_items']:
         if item['_id'] in variants:
             for filter_id in variants[item['_id']]:
 
-                filter_doc = filter_db.find_one(filter_id)
+                filter_doc = filters.get(filter_id)
                 if filter_doc is None:
                     continue
 
-                # check status.
-                if filter_doc['status'] != 1:
-                    continue
-
-                # check ownership.
-                if filter_doc['TEAM_ID'] not in set(user['teams']):
-                    continue
-
                 # embed this in filter.
                 if 'FILTER' not in item:
                     item['FILTER'] = list()
@@ -1,14 +1,271 @@
+import os
+import stat
+import queue
+import atexit
 import datetime
 import logging
+import threading
 
+import bson
 from bson import ObjectId
 from flask import current_app as app
+from pymongo.errors import PyMongoError, BulkWriteError
+
+from matchminer import settings
+
+# spool files of a process are named hipaa_spool.<pid>.bson, and renamed to hipaa_spool.<pid>.replay to be replayed
+SPOOL_PREFIX = 'hipaa_spool.'
+SPOOL_SUFFIX = '.bson'
+REPLAY_SUFFIX = '.replay'
+
+
+class HipaaAuditWriter(object):
+    """
+    Writes HIPAA audit transactions in the background.
+
+    The transactions of a response are queued together and written with insert_many by a
+    single thread, which combines queued responses into batches. The queue is bounded: when it
+    is full, the request waits up to HIPAA_QUEUE_TIMEOUT seconds and then writes its
+    transactions itself. Transactions which cannot be written are spooled to a file of the
+    process in HIPAA_SPOOL_DIR and written again with the next successful batch, together with
+    the spools left behind by processes which have exited. The spool directory has to be owned by
+    the server user and not be accessible to anyone else, nothing is spooled without one.
+    """
+
+    def __init__(self, db, queue_size, batch_size, spool_dir):
+        """
+        :param db: database connection
+        :param queue_size: maximum number of queued responses
+        :param batch_size: maximum number of transactions per insert
+        :param spool_dir: directory transactions are kept in while the database is unavailable, or None
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.spool_dir = spool_dir
+        self.spool_path = _spool_path(spool_dir, os.getpid(), SPOOL_SUFFIX) if spool_dir else None
+        self.replay_path = _spool_path(spool_dir, os.getpid(), REPLAY_SUFFIX) if spool_dir else None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._spool_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, transactions):
+        """
+        Queue the transactions of a response
+
+        :param transactions: list of transactions
+        """
+        try:
+            self._queue.put(transactions, timeout=settings.HIPAA_QUEUE_TIMEOUT)
+        except queue.Full:
+            logging.warning("HIPAA audit queue is full, writing in request")
+            self.write(transactions)
+
+    def flush(self):
+        """Wait until all queued transactions are written"""
+        self._queue.join()
+
+    def write(self, transactions):
+        """
+        Insert transactions, spooling them if the database is unavailable
+
+        :param transactions: list of transactions
+        """
+        try:
+            _insert_transactions(self.db, transactions)
+        except PyMongoError as e:
+            logging.error(f"Spooling {len(transactions)} HIPAA transactions: {e}")
+            self._spool(transactions)
+            return
+
+        self._replay_spool()
+
+    def _run(self):
+        while True:
+            batches = [self._queue.get()]
+            transactions = list(batches[0])
+            while len(transactions) < self.batch_size:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                transactions.extend(batches[-1])
+
+            try:
+                self.write(transactions)
+            except Exception:
+                logging.exception("HIPAA audit writer failed")
+
+                # the thread must survive a full or unwritable disk, or requests would block on the queue.
+                try:
+                    self._spool(transactions)
+                except Exception:
+                    logging.exception(f"Spooling {len(transactions)} HIPAA transactions failed, they are lost")
+            finally:
+                for _ in batches:
+                    self._queue.task_done()
+
+    def _spool(self, transactions):
+        with self._spool_lock:
+            self._append(self.spool_path, transactions)
+
+    def _append(self, path, transactions):
+        self._check_spool_dir()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'ab') as spool:
+            for transaction in transactions:
+                spool.write(bson.encode(transaction))
+            spool.flush()
+            os.fsync(spool.fileno())
+
+    def _replay_spool(self):
+        with self._spool_lock:
+            for path in self._replayable_spools():
+
+                # the spool is renamed before it is read, so a spool is only ever replayed by one writer and
+                # nothing is appended to it while it is read.
+                if path != self.replay_path:
+                    try:
+                        os.rename(path, self.replay_path)
+                    except FileNotFoundError:
+                        continue
+
+                with open(self.replay_path, 'rb') as spool:
+                    transactions = list(bson.decode_file_iter(spool))
+
+                try:
+                    _insert_transactions(self.db, transactions)
+                except PyMongoError as e:
+                    logging.error(f"Replaying spooled HIPAA transactions failed: {e}")
+                    self._append(self.spool_path, transactions)
+                    os.remove(self.replay_path)
+                    return
+
+                os.remove(self.replay_path)
+                logging.info(f"Replayed {len(transactions)} spooled HIPAA transactions")
+
+    def _check_spool_dir(self):
+        """Create the spool directory, and make sure only the server user can access it"""
+        if not self.spool_dir:
+            raise RuntimeError("HIPAA_SPOOL_DIR is not set, HIPAA transactions can't be spooled")
+
+        os.makedirs(self.spool_dir, mode=0o700, exist_ok=True)
+        info = os.lstat(self.spool_dir)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise RuntimeError(f"HIPAA spool directory {self.spool_dir} must be a directory owned by uid "
+                               f"{os.getuid()} with mode 0700")
+
+    def _replayable_spools(self):
+        """
+        Returns the spools to replay: an interrupted replay of this process, its own spool and the
+        spools and interrupted replays of processes which have exited
+
+        :return: list of paths
+        """
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return []
+
+        try:
+            self._check_spool_dir()
+        except RuntimeError as e:
+            logging.error(f"Not replaying spooled HIPAA transactions: {e}")
+            return []
+
+        orphans = list()
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            pid = _spool_pid(name)
+            if pid is not None and path not in (self.replay_path, self.spool_path) and not _pid_alive(pid):
+                orphans.append(path)
+
+        return [path for path in (self.replay_path, self.spool_path) if os.path.exists(path)] + orphans
+
+
+def _spool_path(spool_dir, pid, suffix):
+    return os.path.join(spool_dir, f"{SPOOL_PREFIX}{pid}{suffix}")
+
+
+def _spool_pid(name):
+    """Returns the pid of a spool file name, None if it is not a spool"""
+    for suffix in (SPOOL_SUFFIX, REPLAY_SUFFIX):
+        if name.startswith(SPOOL_PREFIX) and name.endswith(suffix):
+            pid = name[len(SPOOL_PREFIX):-len(suffix)]
+            return int(pid) if pid.isdigit() else None
+    return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to another user
+        pass
+    return True
+
+
+def _insert_transactions(db, transactions):
+    """
+    Insert transactions. Transactions already written by an earlier, partly failed attempt
+    keep their _id and are skipped.
+
+    :param db: database connection
+    :param transactions: list of transactions
+    """
+    try:
+        db['hipaa'].insert_many(transactions, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])) or \
+                e.details.get('writeConcernErrors'):
+            raise
+
+
+# started on first use so every forked server worker gets its own thread
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_audit_writer(db):
+    """
+    Returns the audit writer of the process
+
+    :param db: database connection
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = HipaaAuditWriter(db, settings.HIPAA_QUEUE_SIZE, settings.HIPAA_BATCH_SIZE,
+                                       settings.HIPAA_SPOOL_DIR)
+            atexit.register(_writer.flush)
+        return _writer
 
 
 def hipaa_logging_item(resource, response):
+    _log_transactions(resource, [response])
+
+
+def hipaa_logging_resource(resource, response):
+
+    if resource == 'trial' or resource == 'public_stats':
+        return
+
+    _log_transactions(resource, response['_items'])
+
+
+def _log_transactions(resource, items):
+    """
+    Log access to the PHI of returned documents.
+
+    :param resource: name of the resource
+    :param items: returned documents
+    """
     if resource == 'response' or app.auth is None:
         return
 
+    if resource not in ('clinical', 'match') or not items:
+        return
+
     db = app.data.driver.db
     user = app.auth.get_request_auth_value()
     user_name = user['user_name']
@@ -17,38 +274,23 @@ def hipaa_logging_item(resource, response):
     if user_name == 'cbioone':
         return
 
-    # deal with clinical.
-    needs_logging = False
+    # fetch loggable patient ids.
     if resource == 'clinical':
-        needs_logging = True
-
-        # fetch loggable patient id.
-        patient_mrn = response['MRN']
-
-    elif resource == 'match':
-        needs_logging = True
-
-        # fetch the clinical_id
-        clinical_id = response['CLINICAL_ID']
-
-        # determine if it was resolved.
-        if isinstance(clinical_id, dict):
-            patient_mrn = clinical_id['MRN']
-
-        else:
-            clinical = db['clinical'].find_one({'_id': ObjectId(clinical_id)})
-            patient_mrn = clinical['MRN']
+        patient_mrns = [item['MRN'] for item in items]
+    else:
+        patient_mrns = _match_mrns(db, items)
 
-    if needs_logging:
+    dt = datetime.datetime.now()
+    transactions = list()
+    for item, patient_mrn in zip(items, patient_mrns):
         phi_list = list()
-        for x in response.keys():
+        for x in item.keys():
             if x[0] == '_':
                 continue
             phi_list.append(x)
 
         # create entry.
-        dt = datetime.datetime.now()
-        transaction = {
+        transactions.append({
             'user_id': user_name,
             'patient_id': patient_mrn,
             'phi': phi_list,
@@ -56,16 +298,37 @@ def hipaa_logging_item(resource, response):
             'timestamp': dt,
             app.config['LAST_UPDATED']: dt,
             app.config['DATE_CREATED']: dt
-        }
+        })
 
-        # insert it.
-        app.data.insert('hipaa', transaction)
+    # no queue writes the transactions in the request, used by the test suite
+    if settings.HIPAA_QUEUE_SIZE:
+        get_audit_writer(db).submit(transactions)
+    else:
+        db['hipaa'].insert_many(transactions)
 
 
-def hipaa_logging_resource(resource, response):
+def _match_mrns(db, matches):
+    """
+    Resolve the MRNs of matches, looking up all clinical documents which were not embedded at once
 
-    if resource == 'trial' or resource == 'public_stats':
-        return
+    :param db: database connection
+    :param matches: match documents
+    :return: list of MRNs
+    """
+    clinical_ids = [ObjectId(match['CLINICAL_ID']) for match in matches if not isinstance(match['CLINICAL_ID'], dict)]
+
+    mrns = dict()
+    if clinical_ids:
+        for clinical in db['clinical'].find({'_id': {'$in': clinical_ids}}, {'MRN': 1}):
+            mrns[clinical['_id']] = clinical['MRN']
 
-    for item in response['_items']:
-        hipaa_logging_item(resource, item)
+    patient_mrns = list()
+    for match in matches:
+        clinical_id = match['CLINICAL_ID']
+
+        # determine if it was resolved.
+        if isinstance(clinical_id, dict):
+            patient_mrns.append(clinical_id['MRN'])
+        else:
+            patient_mrns.append(mrns[ObjectId(clinical_id)])
+    return patient_mrns
@@ -115,15 +115,11 @@ def build_trial_elasticsearch_fields(items):
     :param items:
     :return:
     """
-    # get database connection.
-    db = database.get_db()
-
     # loop over each item.
     for item in items:
 
         # build tree.
-        me = MatchEngine(db)
-        status, trial_tree = me.create_trial_tree(item, no_validate=True)
+        trial_tree = MatchEngine.build_trial_tree(item)
 
         # look at every node.
         genomic = {}
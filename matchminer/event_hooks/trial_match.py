@@ -1,4 +1,14 @@
+import json
+import hashlib
+import itertools
+
 from flask import current_app as app
+from pymongo import UpdateOne
+
+from matchminer import database
+
+# trial match updates written per bulk request when ranking
+RANK_CHUNK_SIZE = 1000
 
 
 def sort_trial_matches(trial_matches):
@@ -14,25 +24,148 @@ def sort_trial_matches(trial_matches):
 
     There is also a field show_in_ui which determines whether a match document
     is viewable in the UI.
+
+    Matches ranked by rank_trial_matches are already sorted by the database and only have their
+    rank returned as sort_order. Pages with a match which wasn't ranked yet, or whose sort order
+    changed since it was ranked, are sorted here, page by page.
     """
     db = app.data.driver.db
 
-    current_rank = 1
-    seen_protocol_nos = dict()
+    if trial_matches['_items'] and _is_ranked(db, trial_matches['_items']):
+        for match in trial_matches['_items']:
+            match['sort_order'] = match['rank']
+        return
+
     if trial_matches['_items'] and isinstance(trial_matches['_items'][0]['sort_order'], list):
 
         # get status of protocols. if trial is closed, don't count in ranking
-        query = {"protocol_no": {"$in": [item['protocol_no'] for item in trial_matches['_items']]}}
-        protocols = list(db.trial.find(query, {"_summary.status.value": 1, "protocol_no": 1}))
-        protocol_statuses = {p['protocol_no']:p['_summary']['status'][0]['value'].lower() for p in protocols}
+        protocol_statuses = _protocol_statuses(db, [item['protocol_no'] for item in trial_matches['_items']])
 
-        trial_matches['_items'] = sorted(trial_matches['_items'], key=lambda x: (tuple(x['sort_order'][:-1]) + (1.0 / x['sort_order'][-1],)))
-        for match in trial_matches['_items']:
-            if match['protocol_no'] not in seen_protocol_nos:
-                if any([x < 0 for x in match['sort_order']]) or \
-                        protocol_statuses[match['protocol_no']] != 'open to accrual':
-                    seen_protocol_nos[match['protocol_no']] = -1
-                else:
-                    seen_protocol_nos[match['protocol_no']] = current_rank
-                    current_rank += 1
-            match['sort_order'] = seen_protocol_nos[match['protocol_no']]
+        trial_matches['_items'] = sorted(trial_matches['_items'], key=_sort_key)
+        for match, (rank, _) in zip(trial_matches['_items'], _ranks(trial_matches['_items'], protocol_statuses)):
+            match['sort_order'] = rank
+
+
+def rank_trial_matches(db=None, sample_ids=None):
+    """
+    Store the rank of every trial match of a sample, so the trial_match resource can be sorted
+    and paginated by the database. Call it whenever matches are written or the accrual status of
+    a trial changes.
+
+    Each enabled match gets its position among the sample's matches as sort_rank, and the rank of
+    its protocol as rank. Protocols are ranked in the order of their best match, closed protocols
+    and protocols with a negative sort order rank -1. The hash of the sort order the rank was
+    computed from is stored as rank_hash, so ranks of matches rewritten since are not trusted.
+
+    :param db: database connection
+    :param sample_ids: samples to rank, all samples if None
+    :return: number of updated matches
+    """
+    if db is None:
+        db = database.get_db()
+
+    samples = {} if sample_ids is None else {'sample_id': {'$in': list(sample_ids)}}
+    query = dict(samples, **{'sort_order.0': {'$exists': True}, 'is_disabled': {'$ne': True}})
+
+    protocol_statuses = _protocol_statuses(db, db['trial_match'].distinct('protocol_no', query))
+    matches = db['trial_match'].find(query, {'sample_id': 1, 'protocol_no': 1, 'sort_order': 1, 'rank': 1,
+                                             'sort_rank': 1, 'rank_hash': 1}).sort('sample_id', 1)
+
+    updated = 0
+    requests = list()
+    for _, sample_matches in itertools.groupby(matches, key=lambda match: match['sample_id']):
+        sample_matches = sorted(sample_matches, key=_sort_key)
+        for match, (rank, sort_rank) in zip(sample_matches, _ranks(sample_matches, protocol_statuses)):
+            ranked = {'rank': rank, 'sort_rank': sort_rank, 'rank_hash': _sort_order_hash(match['sort_order'])}
+            if any(match.get(field) != value for field, value in ranked.items()):
+                requests.append(UpdateOne({'_id': match['_id']}, {'$set': ranked}))
+
+        if len(requests) >= RANK_CHUNK_SIZE:
+            db['trial_match'].bulk_write(requests, ordered=False)
+            updated += len(requests)
+            requests = list()
+
+    if requests:
+        db['trial_match'].bulk_write(requests, ordered=False)
+        updated += len(requests)
+
+    # disabled matches aren't ranked, they are sorted page by page if requested.
+    result = db['trial_match'].update_many(dict(samples, **{'is_disabled': True, 'rank': {'$exists': True}}),
+                                           {'$unset': {'rank': 1, 'sort_rank': 1, 'rank_hash': 1}})
+    return updated + result.modified_count
+
+
+def rank_protocol_trial_matches(item, original):
+    """
+    Rank the trial matches of the samples matched to a trial again when its accrual status changes
+
+    :param item: updates or replacement of the trial
+    :param original: trial before the change
+    """
+    # on PATCH, item only holds the updated fields.
+    if _trial_status(dict(original, **item)) == _trial_status(original):
+        return
+
+    db = app.data.driver.db
+    rank_trial_matches(db, db['trial_match'].distinct('sample_id', {'protocol_no': original['protocol_no']}))
+
+
+def _is_ranked(db, matches):
+    """
+    Returns whether all matches have a rank computed from their current sort order. rank_hash is
+    internal and not part of the resource schema, so it is read from the database.
+
+    :param db: database connection
+    :param matches: trial matches of a page
+    :return: bool
+    """
+    if not all('rank' in match for match in matches):
+        return False
+
+    hashes = {match['_id']: match.get('rank_hash') for match in
+              db['trial_match'].find({'_id': {'$in': [match['_id'] for match in matches]}}, {'rank_hash': 1})}
+    return all(hashes.get(match['_id']) == _sort_order_hash(match['sort_order']) for match in matches)
+
+
+def _sort_order_hash(sort_order):
+    return hashlib.sha1(json.dumps(sort_order).encode('utf-8')).hexdigest()
+
+
+def _sort_key(match):
+    return tuple(match['sort_order'][:-1]) + (1.0 / match['sort_order'][-1],)
+
+
+def _ranks(matches, protocol_statuses):
+    """
+    Returns the rank and sort rank of sorted matches
+
+    :param matches: matches of a sample in sort order
+    :param protocol_statuses: dictionary of protocol numbers to lower case trial status
+    :return: list of (rank, sort_rank)
+    """
+    current_rank = 1
+    seen_protocol_nos = dict()
+    ranks = list()
+    for sort_rank, match in enumerate(matches, 1):
+        if match['protocol_no'] not in seen_protocol_nos:
+            if any([x < 0 for x in match['sort_order']]) or \
+                    protocol_statuses.get(match['protocol_no']) != 'open to accrual':
+                seen_protocol_nos[match['protocol_no']] = -1
+            else:
+                seen_protocol_nos[match['protocol_no']] = current_rank
+                current_rank += 1
+        ranks.append((seen_protocol_nos[match['protocol_no']], sort_rank))
+    return ranks
+
+
+def _protocol_statuses(db, protocol_nos):
+    query = {"protocol_no": {"$in": list(protocol_nos)}}
+    protocols = db.trial.find(query, {"_summary.status.value": 1, "protocol_no": 1})
+    return {p['protocol_no']: p['_summary']['status'][0]['value'].lower() for p in protocols}
+
+
+def _trial_status(trial):
+    try:
+        return trial['_summary']['status'][0]['value'].lower()
+    except (KeyError, IndexError, TypeError):
+        return None
@@ -2,6 +2,7 @@ import datetime
 import logging
 
 from matchminer import settings, database
+from matchminer.security import invalidate_user_tokens
 from matchminer.templates.emails import emails
 
 
@@ -43,6 +44,16 @@ def email_user(items):
         db['email'].insert(email_item)
 
 
+def user_updated(updates, original):
+    """Drop the cached tokens of an updated or replaced user, its roles and teams may have changed"""
+    invalidate_user_tokens(original['_id'])
+
+
+def user_deleted(item):
+    """Drop the cached tokens of a deleted user"""
+    invalidate_user_tokens(item['_id'])
+
+
 def _user_email_text(user, cur_date, cur_stamp):
     html = '''<html><head></head><body>%s</body></html>''' % emails.ACCOUNT_APPROVAL_BODY.format(
         user['first_name'],
@@ -8,7 +8,7 @@ from matchminer.event_hooks.genomic import negative_genomic, genomic_insert, ali
 from matchminer.event_hooks.hipaa import hipaa_logging_item, hipaa_logging_resource
 from matchminer.event_hooks.immunoprofile import immunoprofile_insert
 from matchminer.event_hooks.public_stats import get_public_stats
-from matchminer.event_hooks.trial_match import sort_trial_matches
+from matchminer.event_hooks.trial_match import sort_trial_matches, rank_protocol_trial_matches
 from matchminer import settings
 from matchminer.event_hooks.match import add_filter_run_id
 from matchminer.miner import transform_filter_to_CTML, find_filter_matches, update_filter_post, \
@@ -17,7 +17,7 @@ from matchminer.event_hooks.patient_view import patient_view_post
 from matchminer.security import pre_get_restricted, team_restricted_item
 from matchminer.event_hooks.status import status_insert
 from matchminer.event_hooks.trial import trial_insert, trial_replace
-from matchminer.event_hooks.user import email_user
+from matchminer.event_hooks.user import email_user, user_updated, user_deleted
 
 logging.basicConfig(level=logging.DEBUG, format='[%(levelname)s] %(message)s', )
 
@@ -88,6 +88,8 @@ def register_hooks(app):
     app.on_insert_trial += trial_insert
     app.on_update_trial += trial_replace
     app.on_replace_trial += trial_replace
+    app.on_updated_trial += rank_protocol_trial_matches
+    app.on_replaced_trial += rank_protocol_trial_matches
 
     # trial_match
     app.on_fetched_resource_trial_match += sort_trial_matches
@@ -97,4 +99,7 @@ def register_hooks(app):
 
     # user
     app.on_inserted_user += email_user
+    app.on_updated_user += user_updated
+    app.on_replaced_user += user_updated
+    app.on_deleted_item_user += user_deleted
     return app
@@ -0,0 +1,132 @@
+import logging
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# queries of the hot request and filter paths, explained to verify they use an index
+INDEX_QUERIES = [
+    ('match', {'CLINICAL_ID': ObjectId(), 'is_disabled': False}),
+    ('match', {'TEAM_ID': ObjectId(), 'FILTER_ID': ObjectId(), 'is_disabled': False}),
+    ('genomic', {'CLINICAL_ID': ObjectId()}),
+    ('genomic', {'SAMPLE_ID': ''}),
+    ('genomic', {'TRUE_HUGO_SYMBOL': 'BRAF', 'VARIANT_CATEGORY': 'MUTATION'}),
+    ('clinical', {'SAMPLE_ID': ''}),
+    ('clinical', {'MRN': ''}),
+    ('trial', {'protocol_no': ''}),
+    ('user', {'token': ''}),
+    ('patient_view', {'user_id': ObjectId(), 'mrn': '', 'protocol_no': ''}),
+    ('trial_match', {'sample_id': ''}),
+]
+
+
+def declared_indexes(domain):
+    """
+    Returns the indexes declared by the mongo_indexes of the Eve resources
+
+    :param domain: Eve DOMAIN
+    :return: list of (collection, index name, keys, options)
+    """
+    indexes = list()
+    seen = set()
+    for resource, config in domain.items():
+        collection = config.get('datasource', {}).get('source', resource)
+        for name, spec in config.get('mongo_indexes', {}).items():
+            if isinstance(spec, tuple):
+                keys, options = spec
+            else:
+                keys, options = spec, {}
+
+            # resources sharing a collection declare the same indexes.
+            if (collection, name) in seen:
+                continue
+            seen.add((collection, name))
+            indexes.append((collection, name, list(keys), dict(options)))
+
+    return indexes
+
+
+def ensure_indexes(db, domain):
+    """
+    Create the declared indexes which don't exist yet. An existing index with the same keys
+    satisfies a declaration whatever its name.
+
+    :param db: database connection
+    :param domain: Eve DOMAIN
+    :return: list of (collection, index name) created
+    """
+    created = list()
+    for collection, name, keys, options in declared_indexes(domain):
+        if _find_index(db[collection].index_information(), name, keys) is not None:
+            continue
+
+        try:
+            db[collection].create_index(keys, name=name, **options)
+        except OperationFailure as e:
+            logging.error(f"Creating index {name} on {collection} failed: {e}")
+            continue
+
+        logging.info(f"Created index {name} on {collection}")
+        created.append((collection, name))
+
+    return created
+
+
+def index_report(db, domain, queries=INDEX_QUERIES):
+    """
+    Report declared indexes which are missing, indexes which have not been used since the
+    server started or they were created, and representative queries which scan their whole
+    collection.
+
+    :param db: database connection
+    :param domain: Eve DOMAIN
+    :param queries: list of (collection, query) to explain
+    :return: dictionary of missing, unused and collection_scans
+    """
+    missing = list()
+    collections = set()
+    for collection, name, keys, options in declared_indexes(domain):
+        collections.add(collection)
+        if _find_index(db[collection].index_information(), name, keys) is None:
+            missing.append({'collection': collection, 'name': name, 'keys': keys})
+
+    unused = list()
+    for collection in sorted(collections):
+        for stats in db[collection].aggregate([{'$indexStats': {}}]):
+            if stats['name'] != '_id_' and stats['accesses']['ops'] == 0:
+                unused.append({'collection': collection, 'name': stats['name'], 'since': stats['accesses']['since']})
+
+    collection_scans = list()
+    for collection, query in queries:
+        plan = db[collection].find(query).explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _plan_stages(plan):
+            collection_scans.append({'collection': collection, 'query': query})
+
+    return {'missing': missing, 'unused': unused, 'collection_scans': collection_scans}
+
+
+def _find_index(index_information, name, keys):
+    """
+    Returns the name of the existing index matching a declaration
+
+    :param index_information: index_information() of the collection
+    :param name: declared name
+    :param keys: declared keys
+    :return: index name or None
+    """
+    keys = [tuple(key) for key in keys]
+    for existing, info in sorted(index_information.items(), key=lambda item: item[0] != name):
+        if [tuple(key) for key in info['key']] == keys:
+            return existing
+
+    return None
+
+
+def _plan_stages(plan):
+    """Returns the stages of a query plan"""
+    stages = [plan['stage']]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child is not None:
+            stages.extend(_plan_stages(child))
+    return stages
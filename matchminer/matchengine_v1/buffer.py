@@ -0,0 +1,100 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import math
+import logging
+import tempfile
+import datetime as dt
+
+import bson
+import pandas as pd
+
+# logging
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# columns read by add_sort_order
+SORT_COLUMNS = (
+    'sample_id', 'protocol_no', 'vital_status', 'trial_accrual_status', 'genomic_alteration', 'tier',
+    'mmr_status', 'variant_category', 'wildtype', 'match_type', 'cancer_type_match', 'coordinating_center'
+)
+
+
+class MatchBuffer(object):
+    """
+    Bounded-memory buffer of trial matches.
+
+    Matches are spilled to a temporary BSON file as they are found and only the columns needed to
+    compute the sort order are kept in memory. Once sorted, the matches are read back one at a time
+    as trial_match documents.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.sort_columns = {column: [] for column in SORT_COLUMNS}
+        self._file = tempfile.TemporaryFile()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def extend(self, matches):
+        """
+        Adds matches to the buffer
+
+        :param matches: list of match dictionaries
+        """
+        for match in matches:
+            for column in match:
+                self.columns.setdefault(column, None)
+            for column in SORT_COLUMNS:
+                self.sort_columns[column].append(match.get(column))
+            self._file.write(bson.encode(match))
+            self._count += 1
+
+    def sort_frame(self):
+        """Returns the sort columns of all matches as a dataframe"""
+        return pd.DataFrame(self.sort_columns, columns=list(SORT_COLUMNS))
+
+    def records(self, sort_order):
+        """
+        Yields the buffered matches as trial_match documents. Every document carries all columns seen
+        in the run, missing values are None.
+
+        :param sort_order: sort order of each match, in buffer order
+        """
+        self._file.flush()
+        self._file.seek(0)
+        columns = [column for column in self.columns if column != 'sort_order']
+        for match, order in zip(bson.decode_file_iter(self._file), sort_order):
+            record = {column: format_match_value(column, match.get(column)) for column in columns}
+            record['sort_order'] = int(order)
+            yield record
+
+    def close(self):
+        self._file.close()
+
+
+def format_match_value(column, value):
+    """
+    Formats a match value for the trial_match collection
+
+    :param column: column name
+    :param value: match value
+    :return: formatted value
+    """
+
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+
+    if column in ('clinical_id', 'genomic_id'):
+        return str(value)
+
+    if column == 'report_date' and isinstance(value, dt.datetime):
+        return dt.datetime.strftime(value, '%Y-%m-%d %X')
+
+    return value
@@ -0,0 +1,127 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import sys
+import logging
+import threading
+from collections import OrderedDict
+
+from matchminer.matchengine_v1.settings import LEAF_CACHE_MAX_BYTES
+
+# logging
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+
+class LeafResultCache(object):
+    """
+    Process-wide LRU cache of leaf query results.
+
+    Entries are keyed by the data version they were computed against and the normalized
+    query key (see utilities.query_key), so identical leaves across trials and back-to-back
+    runs on the same data are only queried once. Values are treated as read-only; callers
+    must copy them before handing them out.
+    """
+
+    def __init__(self, max_bytes=LEAF_CACHE_MAX_BYTES):
+        """
+        :param max_bytes: Approximate memory cap of the cached results
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.version = None
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, version, key):
+        """
+        Returns the cached result of a leaf query or None.
+
+        :param version: Data version, see get_data_version
+        :param key: Normalized query key
+        :return: (matched_sample_ids, matched_genomic_info, not_match) or None
+        """
+        if version is None:
+            return None
+
+        with self._lock:
+            item = self._items.get((version, key))
+            if item is None:
+                return None
+            self._items.move_to_end((version, key))
+            return item[0]
+
+    def put(self, version, key, value):
+        """
+        Stores the result of a leaf query, evicting the least recently used results over the memory cap.
+
+        :param version: Data version, see get_data_version
+        :param key: Normalized query key
+        :param value: (matched_sample_ids, matched_genomic_info, not_match)
+        """
+        if version is None:
+            return
+
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+
+            # results computed against older data can never be hit again
+            if version != self.version:
+                self._clear()
+                self.version = version
+
+            old = self._items.pop((version, key), None)
+            if old is not None:
+                self.nbytes -= old[1]
+
+            self._items[(version, key)] = (value, size)
+            self.nbytes += size
+
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.nbytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+
+def estimate_size(value):
+    """
+    Approximates the memory held by a leaf query result.
+
+    :param value: (matched_sample_ids, matched_genomic_info, not_match)
+    :return: size in bytes
+    """
+    matched_sample_ids, matched_genomic_info, _ = value
+    size = sys.getsizeof(matched_sample_ids) + sys.getsizeof(matched_genomic_info)
+    size += sum(sys.getsizeof(s) for s in matched_sample_ids)
+    for info in matched_genomic_info:
+        size += sys.getsizeof(info)
+        size += sum(sys.getsizeof(v) for v in info.values())
+    return size
+
+
+def get_data_version(db):
+    """
+    Identifies the state of the clinical and genomic data. The latest status document marks
+    a datapush, the collection counts guard against loads that did not record one.
+
+    :param db: database connection
+    :return: hashable data version
+    """
+    status = db.status.find_one(sort=[('last_update', -1)], projection={'_id': 1})
+    status_id = str(status['_id']) if status is not None else None
+    return status_id, db.clinical.estimated_document_count(), db.genomic.estimated_document_count()
+
+
+# shared by every MatchEngine in the process
+leaf_cache = LeafResultCache()
@@ -2,13 +2,20 @@
 
 from cerberus1 import schema_registry
 import networkx as nx
-import gc
+import multiprocessing
+import numpy as np
 import logging
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 
 from matchminer.matchengine_v1 import schema
 from matchminer.matchengine_v1.validation import ConsentValidatorCerberus
 from matchminer.matchengine_v1.utilities import *
 from matchminer.matchengine_v1.sort import add_sort_order
+from matchminer.matchengine_v1.buffer import MatchBuffer
+from matchminer.matchengine_v1.match_tree import compile_match_tree
+from matchminer.matchengine_v1.cache import leaf_cache, get_data_version
+from matchminer.matchengine_v1.settings import MATCH_PROCESSES
 
 # logging
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s: %(message)s', )
@@ -35,6 +42,33 @@ schema_registry.add('yaml_genomic_schema', schema.yaml_genomic_schema)
 schema_registry.add('yaml_clinical_schema', schema.yaml_clinical_schema)
 schema_registry.add('map', schema.map)
 
+# server errors of aggregations whose output exceeds the document size limit: BSONObjectTooLarge, a result
+# document over the limit and a $facet document over the limit
+DOCUMENT_TOO_LARGE_CODES = (10334, 16389, 4031700)
+
+# state handed to forked matching workers, see MatchEngine.find_trial_matches
+_worker_state = {}
+
+
+def _init_match_worker(mongo_uri, address, db_name):
+    """
+    Gives a forked matching worker its own Mongo connection to the database of the parent engine
+
+    :param mongo_uri: Mongo URI to connect with, or None to connect to the address of the parent's client
+    :param address: (host, port) of the parent's client
+    :param db_name: name of the parent's database
+    """
+    client = MongoClient(mongo_uri) if mongo_uri else MongoClient(*address)
+    _worker_state['engine'].db = client[db_name]
+
+
+def _match_worker(indices):
+    """Matches the given segments inside a worker"""
+    engine = _worker_state['engine']
+    matches = engine._match_segments(_worker_state['segments'], _worker_state['match_trees'],
+                                     _worker_state['mrn_map'], indices)
+    return [match for segment_matches in matches for match in segment_matches]
+
 
 class MatchEngine(object):
 
@@ -45,6 +79,22 @@ class MatchEngine(object):
         # stores the complete list as easy lookup
         self.all_match = set(self.db.clinical.distinct('SAMPLE_ID'))
 
+        # dense index of all samples. match trees are evaluated as boolean masks over it.
+        self.sample_ids = np.array(sorted(self.all_match), dtype=object)
+        self.sample_index = {sample_id: i for i, sample_id in enumerate(self.sample_ids)}
+
+        # leaf queries keyed by match tree and node
+        self.leaf_specs = {}
+
+        # results of leaf queries keyed by their normalized query. results are shared with
+        # the process-wide leaf cache for as long as the data version does not change.
+        self.leaf_results = {}
+        self.leaf_masks = {}
+
+        # clinical fields copied into matches keyed by sample id, shared by all trials of a run
+        self.clinical_info = {}
+        self.data_version = get_data_version(self.db)
+
         # get mapping values between yml and db
         self.bootstrap_map()
         self.mapping = list(self.db.map.find())
@@ -155,38 +205,16 @@ class MatchEngine(object):
         return is_dict, is_list, is_value
 
     @staticmethod
-    def create_match_tree(data):
+    def create_match_tree(data, protocol_no=None):
         """
-        Given json object of MATCH clause , the function returns a directed graph
+        Given json object of MATCH clause , the function returns its compiled match tree. Trees are
+        cached, so the same clause of a trial is only compiled once per process.
 
         :param data: json match clause
-        :return: diGraph match tree
-        """
-
-        key = list(data.keys())[0]
-        value = data[key]
-        global_node = 1
-        g = nx.DiGraph()
-        s = []
-        s.append([0, global_node, key, value])
-
-        while len(s) > 0:
-            current = s.pop(0)
-            parent = current[0]
-            node = current[1]
-            key = current[2]
-            value = current[3]
-            g.add_node(node)
-            g.add_edges_from([(parent, node)])
-            g.nodes[node]['type'] = key
-            if isinstance(value, dict):
-                g.nodes[node]['value'] = value
-            elif isinstance(value, list):
-                for i in range(0, len(value)):
-                    global_node += 1
-                    s.append([node, global_node, list(value[i].keys())[0], value[i][list(value[i].keys())[0]]])
-        g.remove_node(0)
-        return g
+        :param protocol_no: protocol number of the trial the clause belongs to
+        :return: MatchTree
+        """
+        return compile_match_tree(data, protocol_no)
 
     def create_trial_tree(self, raw_data, no_validate=False):
         """ creates networkx tree of trial from a python dictionary
@@ -211,20 +239,34 @@ class MatchEngine(object):
         else:
             data = raw_data
 
+        return 0, self.build_trial_tree(data)
+
+    @staticmethod
+    def build_trial_tree(data):
+        """
+        Creates the networkx tree of a trial without validating it. It doesn't need a database, so
+        it can be called without constructing a MatchEngine.
+
+        :param data: trial dictionary
+        :return: networkx DiGraph
+        """
+
         # create the graph
         G = nx.DiGraph()
 
         # create the graph.
-        self._recursive_create(None, data, G)
-        self._annotate_match(G)
+        MatchEngine._recursive_create(None, data, G)
+        MatchEngine._annotate_match(G)
 
         # return the tree.
-        return 0, G
+        return G
 
     def run_query(self, node):
         """
         Runs genomic or clinical query against Mongo database and returns a set of sample ids that matched
 
+        Leaves already run by plan_leaf_queries are served from self.leaf_results.
+
         :param node: node location with the trial match tree
         :param db: database connection
 
@@ -233,122 +275,304 @@ class MatchEngine(object):
             matched_genomic_info: genomic information regarding each match
         """
 
-        matched_genomic_info = []
+        spec = self._prepare_leaf(node)
+        if spec is None:
+            logging.info("bad match tree")
+            return
+
+        if spec['key'] not in self.leaf_results:
+            self._execute_leaf_queries([spec])
+
+        # hand out copies as the genomic information is extended into match documents downstream
+        matched_sample_ids, matched_genomic_info, not_match = self.leaf_results[spec['key']]
+        if not_match is not None:
+            matched_sample_ids = self.all_match - matched_sample_ids
+            return matched_sample_ids, [self._expand_not_match(sample_id, not_match)
+                                        for sample_id in matched_sample_ids]
+
+        return set(matched_sample_ids), [dict(info) for info in matched_genomic_info]
+
+    def _leaf_mask(self, spec):
+        """
+        Returns the samples matched by a leaf query as a boolean mask over self.sample_ids
+
+        :param spec: leaf query dictionary from _prepare_leaf
+        :return: numpy boolean array
+        """
+
+        if spec['key'] not in self.leaf_results:
+            self._execute_leaf_queries([spec])
+
+        mask = self.leaf_masks.get(spec['key'])
+        if mask is None:
+            matched_sample_ids, _, not_match = self.leaf_results[spec['key']]
+            mask = np.zeros(len(self.sample_ids), dtype=bool)
+            mask[[self.sample_index[i] for i in matched_sample_ids if i in self.sample_index]] = True
+
+            # negative leaves hold the samples which carry the alteration
+            if not_match is not None:
+                mask = ~mask
+
+            self.leaf_masks[spec['key']] = mask
+
+        return mask
 
-        # execute query against genomic table
+    @staticmethod
+    def _expand_not_match(sample_id, not_match):
+        """
+        Builds the genomic information of a sample matched by a negative leaf
+
+        :param sample_id: matched sample id
+        :param not_match: alteration reflecting the negative trial criteria
+        :return: genomic information
+        """
+        genomic_info = {'sample_id': sample_id}
+        genomic_info.update(not_match)
+        return genomic_info
+
+    def plan_leaf_queries(self, match_trees):
+        """
+        Collects every genomic and clinical leaf across the given match trees, deduplicates identical
+        normalized queries and runs them in a few batched aggregations. The results are kept in
+        self.leaf_results for run_query.
+
+        :param match_trees: list of compiled match trees
+        """
+
+        plan = {}
+        for g in match_trees:
+            for node_id in g.leaves():
+                spec = self._prepare_leaf(g.nodes[node_id], (g.key, node_id))
+                if spec is not None and spec['key'] not in self.leaf_results:
+                    plan[spec['key']] = spec
+
+        logging.info('Running %d unique leaf queries' % len(plan))
+        self._execute_leaf_queries(list(plan.values()))
+
+    def _prepare_leaf(self, node, cache_key=None):
+        """
+        Translates a leaf node into its Mongo query.
+
+        :param node: leaf node of a match tree
+        :param cache_key: (match tree key, node id) under which the query is kept in self.leaf_specs
+        :return: dictionary with the query, its collection, negative and structural variant flags and its key
+        """
+
+        if cache_key in self.leaf_specs:
+            return self.leaf_specs[cache_key]
+
+        # the criteria are pruned while translating, compiled match trees are read-only
         if node['type'] == 'genomic':
+            g, neg, sv = self.prepare_genomic_criteria(dict(node['value']))
+            spec = {'collection': 'genomic', 'query': g, 'neg': neg, 'sv': sv}
+
+        elif node['type'] == 'clinical':
+            c = self.prepare_clinical_criteria(dict(node['value']))
+            spec = {'collection': 'clinical', 'query': c, 'neg': False, 'sv': False}
 
-            item = node['value']
+        else:
+            return None
 
-            # prepare genomic criteria
-            g, neg, sv = self.prepare_genomic_criteria(item)
+        spec['key'] = query_key(spec['collection'], spec['query'], spec['neg'])
+        if cache_key is not None:
+            self.leaf_specs[cache_key] = spec
+        return spec
 
-            # execute match
-            if len(list(g.keys())) == 0:
-                matched_sample_ids = list()
-            else:
+    def _execute_leaf_queries(self, specs):
+        """
+        Runs leaf queries in batches. Each batch is a single aggregation which narrows the collection with
+        an indexed $or of all queries and splits the result back per query with $facet.
 
-                if neg:
-                    proj = {'SAMPLE_ID': 1}  # speeds up query
-                else:
-                    proj = {
-                        'SAMPLE_ID': 1,
-                        'TRUE_HUGO_SYMBOL': 1,
-                        'TRUE_PROTEIN_CHANGE': 1,
-                        'TRUE_VARIANT_CLASSIFICATION': 1,
-                        'VARIANT_CATEGORY': 1,
-                        'CNV_CALL': 1,
-                        'WILDTYPE': 1,
-                        'CHROMOSOME': 1,
-                        'POSITION': 1,
-                        'TRUE_CDNA_CHANGE': 1,
-                        'REFERENCE_ALLELE': 1,
-                        'TRUE_TRANSCRIPT_EXON': 1,
-                        'CANONICAL_STRAND': 1,
-                        'ALLELE_FRACTION': 1,
-                        'TIER': 1,
-                        'CLINICAL_ID': 1,
-                        'MMR_STATUS': 1,
-                        'ACTIONABILITY': 1,
-                        '_id': 1
-                    }
-
-                    # record pathologist's chromosomal rearrangement comment for downstream manual analysis
-                    if sv:
-                        proj['STRUCTURAL_VARIANT_COMMENT'] = 1
-
-                results = list(self.db.genomic.find(g, proj))
-
-                # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
-                # and the genomic information will not be copied into the trial_match document
-                if neg:
-
-                    # If the yaml criterium was negative, then subtract the matched results from the total set
-                    matched_sample_ids = self.all_match - set(x['SAMPLE_ID'] for x in results)
-                    alteration, is_variant = format_not_match(g)
-
-                    # add genomic alterations per sample id
-                    matched_genomic_info = [{
-                        'sample_id': sample_id,
-                        'match_type': is_variant,
-                        'genomic_alteration': alteration
-                    } for sample_id in matched_sample_ids]
+        :param specs: list of leaf query dictionaries from _prepare_leaf
+        """
 
+        genomic = []
+        clinical = []
+        for spec in specs:
+
+            # identical leaves run earlier against the same data
+            cached = leaf_cache.get(self.data_version, spec['key'])
+            if cached is not None:
+                self.leaf_results[spec['key']] = cached
+            elif len(list(spec['query'].keys())) == 0:
+                self._store_leaf(spec, (set(), [], None))
+            elif spec['collection'] == 'genomic':
+                genomic.append(spec)
+            else:
+                clinical.append(spec)
+
+        # clinical leaves only need the matching sample ids
+        for batch in chunker(clinical, LEAF_BATCH_SIZE):
+            for spec, ids in zip(batch, self._run_facets(self.db.clinical, batch)):
+                self._store_leaf(spec, (set(ids), [], None))
+
+        # genomic leaves return sample ids when negative and genomic ids otherwise
+        genomic_ids = {}
+        for batch in chunker(genomic, LEAF_BATCH_SIZE):
+            for spec, ids in zip(batch, self._run_facets(self.db.genomic, batch)):
+                if spec['neg']:
+                    self._store_leaf(spec, self._format_genomic_results(spec, [{'SAMPLE_ID': i} for i in ids]))
                 else:
-                    for item in results:
+                    genomic_ids[spec['key']] = ids
 
-                        # format the genomic alteration that matched
-                        alteration, is_variant = format_genomic_alteration(item, g)
+        if not genomic_ids:
+            return
 
-                        # add genomic information and alterations that matched per sample id
-                        genomic_info = {
-                            'match_type': is_variant,
-                            'genomic_alteration': alteration
-                        }
+        # fetch each matched genomic document once, no matter how many leaves matched it
+        all_ids = sorted(set(i for ids in genomic_ids.values() for i in ids))
+        proj = dict(genomic_proj, STRUCTURAL_VARIANT_COMMENT=1)
+        docs = {}
+        for chunk in chunker(all_ids, FETCH_CHUNK_SIZE):
+            for doc in self.db.genomic.find({'_id': {'$in': chunk}}, proj):
+                docs[doc['_id']] = doc
 
-                        # copy genomic document projection into match
-                        for field in proj:
-                            if field in item:
-                                if field == '_id':
-                                    genomic_info['genomic_id'] = item[field]
-                                else:
-                                    genomic_info[field.lower()] = item[field]
+        for spec in genomic:
+            if spec['key'] in genomic_ids:
+                results = [docs[i] for i in sorted(genomic_ids[spec['key']]) if i in docs]
+                self._store_leaf(spec, self._format_genomic_results(spec, results))
 
-                        # add unique matches by sample id
-                        matched_genomic_info.append(genomic_info)
+    def _store_leaf(self, spec, result):
+        """
+        Keeps the result of a leaf query for this run and for later runs on the same data.
 
-                    matched_sample_ids = set(item['SAMPLE_ID'] for item in results)
+        :param spec: leaf query dictionary
+        :param result: (matched_sample_ids, matched_genomic_info, not_match)
+        """
 
-        # execute query against clinical table
-        elif node['type'] == 'clinical':
+        matched_sample_ids, matched_genomic_info, not_match = result
+        result = (frozenset(matched_sample_ids), tuple(matched_genomic_info), not_match)
+        self.leaf_results[spec['key']] = result
+        leaf_cache.put(self.data_version, spec['key'], result)
 
-            item = node['value']
+    @staticmethod
+    def _run_facets(collection, batch):
+        """
+        Runs a batch of leaf queries as one aggregation.
 
-            # prepare clinical criteria
-            c = self.prepare_clinical_criteria(item)
+        :param collection: Mongo collection
+        :param batch: list of leaf query dictionaries
+        :return: list with the matched ids of each query, in batch order
+        """
 
-            # execute match
-            if len(list(c.keys())) == 0:
-                matched_sample_ids = list()
+        facets = {}
+        for i, spec in enumerate(batch):
+            if spec['collection'] == 'genomic' and not spec['neg']:
+                group = {'$group': {'_id': None, 'ids': {'$push': '$_id'}}}
             else:
-                matched_sample_ids = set(self.db.clinical.find(c).distinct('SAMPLE_ID'))
+                group = {'$group': {'_id': None, 'ids': {'$addToSet': '$SAMPLE_ID'}}}
+            facets[str(i)] = [{'$match': spec['query']}, group]
+
+        pipeline = [
+            {'$match': {'$or': [spec['query'] for spec in batch]}},
+            {'$facet': facets}
+        ]
+
+        try:
+            result = list(collection.aggregate(pipeline, allowDiskUse=True))[0]
+        except OperationFailure as e:
+            if e.code not in DOCUMENT_TOO_LARGE_CODES:
+                raise
+
+            # a batch whose output exceeds the document size limit is run one query at a time, and a
+            # single query too broad for one document is streamed through a cursor
+            if len(batch) == 1:
+                logging.warning("leaf query failed, streaming it instead: %s" % str(e))
+                return [MatchEngine._stream_ids(collection, batch[0])]
+            logging.warning("batched leaf query failed, running queries individually: %s" % str(e))
+            return [ids for spec in batch for ids in MatchEngine._run_facets(collection, [spec])]
+
+        return [result[str(i)][0]['ids'] if result[str(i)] else [] for i in range(len(batch))]
+
+    @staticmethod
+    def _stream_ids(collection, spec):
+        """
+        Runs a single leaf query with find, returning the same ids as its facet
+
+        :param collection: Mongo collection
+        :param spec: leaf query dictionary
+        :return: list of matched ids
+        """
+
+        if spec['collection'] == 'genomic' and not spec['neg']:
+            return [doc['_id'] for doc in collection.find(spec['query'], {'_id': 1})]
+
+        return list(set(doc['SAMPLE_ID'] for doc in collection.find(spec['query'], {'SAMPLE_ID': 1})))
+
+    def _format_genomic_results(self, spec, results):
+        """
+        Formats the genomic documents matched by a leaf query
+
+        :param spec: leaf query dictionary
+        :param results: matched genomic documents
+        :returns
+            matched_sample_ids: set of matched sample ids, or of excluded sample ids for negative queries
+            matched_genomic_info: genomic information regarding each match
+            not_match: alteration shared by all samples matched by a negative query, otherwise None
+        """
+
+        g = spec['query']
+        matched_genomic_info = []
+        not_match = None
+
+        # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
+        # and the genomic information will not be copied into the trial_match document
+        if spec['neg']:
+
+            # If the yaml criterium was negative, every sample but the matched results is a match. only the
+            # excluded samples and a single alteration are kept, the cohort is expanded from the sample index.
+            matched_sample_ids = set(x['SAMPLE_ID'] for x in results)
+            alteration, is_variant = format_not_match(g)
+            not_match = {
+                'match_type': is_variant,
+                'genomic_alteration': alteration
+            }
 
         else:
-            logging.info("bad match tree")
-            return
 
-        # return a list of sample ids and match information
-        return matched_sample_ids, matched_genomic_info
+            # record pathologist's chromosomal rearrangement comment for downstream manual analysis
+            proj = genomic_proj
+            if spec['sv']:
+                proj = dict(genomic_proj, STRUCTURAL_VARIANT_COMMENT=1)
+
+            for item in results:
+
+                # format the genomic alteration that matched
+                alteration, is_variant = format_genomic_alteration(item, g)
+
+                # add genomic information and alterations that matched per sample id
+                genomic_info = {
+                    'match_type': is_variant,
+                    'genomic_alteration': alteration
+                }
+
+                # copy genomic document projection into match
+                for field in proj:
+                    if field in item:
+                        if field == '_id':
+                            genomic_info['genomic_id'] = item[field]
+                        else:
+                            genomic_info[field.lower()] = item[field]
+
+                # add unique matches by sample id
+                matched_genomic_info.append(genomic_info)
+
+            matched_sample_ids = set(item['SAMPLE_ID'] for item in results)
+
+        return matched_sample_ids, matched_genomic_info, not_match
 
     def traverse_match_tree(self, g):
         """ Finds matches for a given match tree
 
-        :param g: diGraph match tree
+        Leaves are combined as boolean masks over the sample index and the genomic information is only
+        expanded for the samples matching at the root.
+
+        :param g: compiled match tree
         :return: match set for a tree
         """
 
-        tree_genomic = {}
-        for node_id in list(nx.dfs_postorder_nodes(g, source=1)):
+        masks = {}
+        leaves = []
+        for node_id in g.postorder():
 
             # get node and its child
             node = g.nodes[node_id]
@@ -356,35 +580,43 @@ class MatchEngine(object):
 
             # if leaf node then execute query
             if len(successors) == 0:
-                matched_sample_ids, matched_genomic_info = self.run_query(node)
+                spec = self._prepare_leaf(node, (g.key, node_id))
+                if spec is None:
+                    logging.info("bad match tree")
+                    masks[node_id] = np.zeros(len(self.sample_ids), dtype=bool)
+                    continue
 
-                node['matched_sample_ids'] = matched_sample_ids
-                node['matched_genomic_info'] = matched_genomic_info
-
-                for match in node['matched_genomic_info']:
-                    if match['sample_id'] not in tree_genomic:
-                        tree_genomic[match['sample_id']] = [match]
-                    else:
-                        tree_genomic[match['sample_id']].append(match)
+                masks[node_id] = self._leaf_mask(spec)
+                leaves.append(spec['key'])
 
             # else apply logic based on and/or
+            elif node['type'] == 'and':
+                masks[node_id] = np.logical_and.reduce([masks[i] for i in successors])
+
+            elif node['type'] == 'or':
+                masks[node_id] = np.logical_or.reduce([masks[i] for i in successors])
+
             else:
+                masks[node_id] = masks[successors[0]]
 
-                node['matched_sample_ids'] = set([])
-                node['matched_sample_ids'].update(g.nodes[successors[0]]['matched_sample_ids'])
-                node['matched_genomic_info'] = g.nodes[successors[0]]['matched_genomic_info']
+        final = masks[1]
+        final_sample_ids = set(self.sample_ids[final])
 
-                for i in range(1, len(successors)):
-                    s_list = g.nodes[successors[i]]['matched_sample_ids']
+        # collect the genomic information of every matched sample
+        tree_genomic = {}
+        for key in leaves:
+            _, matched_genomic_info, not_match = self.leaf_results[key]
 
-                    if node['type'] == 'and':
-                        node['matched_sample_ids'].intersection_update(s_list)
+            if not_match is not None:
+                for sample_id in self.sample_ids[final & self.leaf_masks[key]]:
+                    tree_genomic.setdefault(sample_id, []).append(self._expand_not_match(sample_id, not_match))
 
-                    elif node['type'] == 'or':
-                        node['matched_sample_ids'].update(s_list)
+            else:
+                for info in matched_genomic_info:
+                    if info['sample_id'] in final_sample_ids:
+                        tree_genomic.setdefault(info['sample_id'], []).append(dict(info))
 
-        final_sample_ids = g.nodes[1]['matched_sample_ids']
-        final_genomic_infos = [tree_genomic[i] for i in final_sample_ids]
+        final_genomic_infos = [tree_genomic[i] for i in self.sample_ids[final] if i in tree_genomic]
 
         return final_sample_ids, final_genomic_infos
 
@@ -398,7 +630,7 @@ class MatchEngine(object):
 
         c = {}
 
-        # create the oncotree.
+        # get the cached oncotree.
         onco_tree = build_oncotree()
 
         # only match by these keys
@@ -484,11 +716,15 @@ class MatchEngine(object):
 
         return g, track_neg, track_sv
 
-    def find_trial_matches(self):
+    def find_trial_matches(self, processes=MATCH_PROCESSES, mongo_uri=None):
         """
         Iterates through all match clauses of all trials located in the database and matches patients to trials
         based on their clinical and genomic documents.
 
+        :param processes: Number of worker processes matching trials. Workers are forked after the leaf queries
+        ran and share the sample index and leaf results read-only.
+        :param mongo_uri: Mongo URI the workers connect with, needed if the server requires credentials. Workers
+        connect to the address of the engine's client by default, and always use the engine's database.
         :return: Dictionary containing matches
         """
 
@@ -500,54 +736,117 @@ class MatchEngine(object):
         # create a map between sample id and MRN
         mrn_map = samples_from_mrns(self.db, mrns)
 
-        # initialize trial matches
-        trial_matches = []
-
-        # for all trials check for matches on the dose, arm, and step levels and keep track of what is found
+        # collect the step, arm, and dose levels of all trials which have a match clause
+        segments = []
         for trial in all_trials:
 
-            logging.info('Matching trial %s' % trial['protocol_no'])
-
             # If the trial is not open to accrual, all matches to all match trees in this trial will be marked closed
-            trial_status = 'open'
-            if '_summary' in trial:
-                if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
-                    if 'value' in trial['_summary']['status'][0]:
-                        if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
-                            trial_status = 'closed'
+            trial_status = get_trial_status(trial)
 
             # STEP #
             for step in trial['treatment_list']['step']:
                 if 'match' in step:
-                    trial_matches = self._assess_match(mrn_map, trial_matches, trial, step, 'step', trial_status)
+                    segments.append((trial, step, 'step', trial_status))
 
                 # ARM #
                 for arm in step['arm']:
                     if 'match' in arm:
-                        trial_matches = self._assess_match(mrn_map, trial_matches, trial, arm, 'arm', trial_status)
+                        segments.append((trial, arm, 'arm', trial_status))
 
                     # DOSE #
                     for dose in arm['dose_level']:
                         if 'match' in dose:
-                            trial_matches = self._assess_match(mrn_map, trial_matches, trial, dose, 'dose',
-                                                               trial_status)
+                            segments.append((trial, dose, 'dose', trial_status))
 
-        trial_match_df = pd.DataFrame.from_dict(trial_matches)
+        # run the leaf queries of every match tree up front
+        match_trees = [self.create_match_tree(trial_segment['match'][0], trial['protocol_no'])
+                       for trial, trial_segment, _, _ in segments]
+        self.plan_leaf_queries(match_trees)
 
-        # force garbage collector to remove unused object after conversion to df
-        del trial_matches
-        gc.collect()
+        # for all trials check for matches on the dose, arm, and step levels and keep track of what is found
+        if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            trial_matches = self._match_segments_parallel(segments, match_trees, mrn_map, processes, mongo_uri)
+        else:
+            trial_matches = self._match_segments(segments, match_trees, mrn_map, range(len(segments)))
 
-        # sort
-        logging.info('Sorting trial matches.')
-        trial_matches_df = add_sort_order(trial_match_df)
-        logging.info('Number of trial matches: %s' % str(trial_match_df.shape[0]))
+        # matches are spilled to disk as they are found, only the sort columns stay in memory
+        with MatchBuffer() as buffer:
+            for segment_matches in trial_matches:
+                buffer.extend(segment_matches)
 
-        # add to db
-        logging.info('Adding trial matches to database')
-        add_matches(trial_matches_df, self.db)
+            # sort
+            logging.info('Sorting trial matches.')
+            sort_order = add_sort_order(buffer.sort_frame())['sort_order'].values if len(buffer) else []
+            logging.info('Number of trial matches: %s' % str(len(buffer)))
+
+            # add to db
+            logging.info('Adding trial matches to database')
+            add_matches(buffer.records(sort_order), self.db)
+
+    def _match_segments(self, segments, match_trees, mrn_map, indices):
+        """
+        Matches patients to the given trial segments
+
+        :param segments: list of (trial, trial_segment, match_segment, trial_status)
+        :param match_trees: match tree of each segment
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param indices: indices of the segments to match
+        :return: generator of the matches of each segment
+        """
+
+        protocol_no = None
+        for i in indices:
+            trial, trial_segment, match_segment, trial_status = segments[i]
+
+            if trial['protocol_no'] != protocol_no:
+                protocol_no = trial['protocol_no']
+                logging.info('Matching trial %s' % protocol_no)
+
+            yield self._assess_match(mrn_map, [], trial, trial_segment, match_segment, trial_status,
+                                     match_tree=match_trees[i])
 
-    def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status):
+    def _match_segments_parallel(self, segments, match_trees, mrn_map, processes, mongo_uri):
+        """
+        Spreads the trials across forked worker processes. Each worker matches all segments of a trial and the
+        results are merged in segment order, so the matches equal those of a serial run.
+
+        :param segments: list of (trial, trial_segment, match_segment, trial_status)
+        :param match_trees: match tree of each segment
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param processes: number of worker processes
+        :param mongo_uri: Mongo URI the workers connect with, or None to use the address of the engine's client
+        :return: generator of the matches of each trial, in segment order
+        """
+
+        # build every leaf mask before forking so the workers share them
+        for g in match_trees:
+            for node_id in g.leaves():
+                spec = self._prepare_leaf(g.nodes[node_id], (g.key, node_id))
+                if spec is not None:
+                    self._leaf_mask(spec)
+
+        # segments of a trial are consecutive
+        groups = []
+        protocol_no = None
+        for i, segment in enumerate(segments):
+            if segment[0]['protocol_no'] != protocol_no or not groups:
+                protocol_no = segment[0]['protocol_no']
+                groups.append([])
+            groups[-1].append(i)
+
+        logging.info('Matching %d trials with %d processes' % (len(groups), processes))
+        _worker_state.update(engine=self, segments=segments, match_trees=match_trees, mrn_map=mrn_map)
+        try:
+            ctx = multiprocessing.get_context('fork')
+            initargs = (mongo_uri, self.db.client.address, self.db.name)
+            with ctx.Pool(processes, initializer=_init_match_worker, initargs=initargs) as pool:
+                for matches in pool.imap(_match_worker, groups):
+                    yield matches
+        finally:
+            _worker_state.clear()
+
+    def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status,
+                      match_tree=None):
         """
         Given a trial's match tree, finds all patients that matches to it and records the step, arm, or dose
         internal id that it matched to along with the genomic alteration that matched.
@@ -558,27 +857,16 @@ class MatchEngine(object):
         :param trial_segment: Either the step, arm, or dose segment of the trial document
         :param match_segment: Marker indicating if segment is step, arm, or dose
         :param trial_status: Overall trial status. either open or closed.
+        :param match_tree: Match tree of the segment, if already built
         :return: Dictionary containing the matches
         """
 
         # get all matches
-        match_tree = self.create_match_tree(trial_segment['match'][0])
+        if match_tree is None:
+            match_tree = self.create_match_tree(trial_segment['match'][0], trial.get('protocol_no'))
         sample_ids, ginfos = self.traverse_match_tree(match_tree)
 
-        clinical = []
-        if sample_ids:
-            cproj = {
-                'SAMPLE_ID': 1,
-                'ORD_PHYSICIAN_NAME': 1,
-                'ORD_PHYSICIAN_EMAIL': 1,
-                'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 1,
-                'REPORT_DATE': 1,
-                'VITAL_STATUS': 1,
-                'FIRST_LAST': 1,
-                'GENDER': 1,
-                '_id': 1
-            }
-            clinical = list(self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj))
+        self._load_clinical_info(sample_ids)
 
         # add to master list if any sample ids matched
         for sample in ginfos:
@@ -598,14 +886,7 @@ class MatchEngine(object):
                         match[trial_key] = trial[trial_key]
 
                 # copy clinical document
-                if clinical:
-                    for citem in clinical:
-                        if citem['SAMPLE_ID'] == alteration['sample_id']:
-                            for field in citem:
-                                if field == '_id':
-                                    match['clinical_id'] = citem[field]
-                                else:
-                                    match[field.lower()] = citem[field]
+                match.update(self.clinical_info.get(alteration['sample_id'], {}))
 
                 # add internal id
                 if match_segment == 'dose':
@@ -627,6 +908,24 @@ class MatchEngine(object):
 
         return trial_matches
 
+    def _load_clinical_info(self, sample_ids):
+        """
+        Fetches the clinical fields copied into matches for samples not seen earlier in the run
+        and stores them in self.clinical_info as flat lower-cased dictionaries.
+
+        :param sample_ids: matched sample ids
+        """
+
+        missing = sorted(set(sample_ids) - set(self.clinical_info))
+        for chunk in chunker(missing, FETCH_CHUNK_SIZE):
+            for citem in self.db.clinical.find({'SAMPLE_ID': {'$in': chunk}}, clinical_proj):
+                info = self.clinical_info.setdefault(citem['SAMPLE_ID'], {})
+                for field in citem:
+                    if field == '_id':
+                        info['clinical_id'] = citem[field]
+                    else:
+                        info[field.lower()] = citem[field]
+
     @staticmethod
     def _search_oncotree_diagnosis(onco_tree, c):
         """Add all the oncotree nodes """
@@ -643,31 +942,24 @@ class MatchEngine(object):
             for txt in diagnoses:
                 if txt.endswith("_LIQUID_") or txt.endswith("_SOLID_"):
 
-                    # build the nodes for liquid.
-                    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
-                    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
-
-                    nodes1 = list(nx.dfs_tree(onco_tree, node1))
-                    nodes2 = list(nx.dfs_tree(onco_tree, node2))
-                    nodes = list(set(nodes1).union(set(nodes2)))
+                    # liquid and solid expansions are precomputed on the oncotree.
+                    nodes = onco_tree.liquid
 
                     # if its really solid take the inverse.
                     if txt == "_SOLID_":
-                        all_nodes = set(list(onco_tree.nodes()))
-                        tmp_nodes = all_nodes - set(nodes)
-                        nodes = list(tmp_nodes)
+                        nodes = onco_tree.solid
 
                 else:
                     # get tree node.
-                    node = oncotreenx.lookup_text(onco_tree, txt)
+                    node = onco_tree.lookup_text(txt)
 
                     # get its children.
                     if onco_tree.has_node(node):
                         # list of nodes.
-                        nodes = list(nx.dfs_tree(onco_tree, node))
+                        nodes = onco_tree.subtree(node)
 
                         # replace it with free text.
-                nodes_txt = [onco_tree.node[n]['text'] for n in nodes]
+                nodes_txt = [onco_tree.text(n) for n in nodes]
 
                 if key == '$eq':
                     key = '$in'
@@ -692,7 +984,8 @@ class MatchEngine(object):
 
         return tmpc['ONCOTREE_PRIMARY_DIAGNOSIS_NAME']
 
-    def _recursive_create(self, parent_id, data, G):
+    @staticmethod
+    def _recursive_create(parent_id, data, G):
         child_id_set = ['protocol_id', 'arm_internal_id', 'level_internal_id', 'step_internal_id']
         key_set = set(['treatment_list', 'step', 'arm', 'dose_level'])
 
@@ -726,9 +1019,10 @@ class MatchEngine(object):
                     list_val = data[key]
 
                 for child_data in list_val:
-                    self._recursive_create(cur_name, child_data, G)
+                    MatchEngine._recursive_create(cur_name, child_data, G)
 
-    def _annotate_match(self, G):
+    @staticmethod
+    def _annotate_match(G):
 
         # loop over each node.
         for n in G.nodes():
@@ -739,7 +1033,7 @@ class MatchEngine(object):
 
             # create the match-tree.
             content = {'match': G.nodes[n]['match']}
-            match_tree = self.create_match_tree(content)
+            match_tree = MatchEngine.create_match_tree(content, G.nodes[0].get('protocol_no'))
 
             # embed it in trial tree.
             G.nodes[n]['match_tree'] = match_tree
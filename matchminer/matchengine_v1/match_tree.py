@@ -0,0 +1,157 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import copy
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+
+from matchminer.matchengine_v1.settings import MATCH_TREE_CACHE_SIZE
+
+# logging
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# compiled match trees keyed by protocol number and content hash, least recently used first
+_MATCH_TREES = OrderedDict()
+_MATCH_TREES_LOCK = threading.Lock()
+
+
+class MatchTree(object):
+    """
+    Immutable match tree compiled from a CTML match clause.
+
+    Nodes are numbered breadth first from 1 like the networkx trees built before, and each node is a
+    read-only mapping holding its 'type' and, for dictionaries, its 'value'. The read-only part of the
+    DiGraph interface used by the trial consumers is supported: iterating over node ids, nodes[n],
+    nodes() and successors(n).
+    """
+
+    __slots__ = ('key', 'nodes', '_children', '_postorder', '_leaves')
+
+    def __init__(self, data, key=None):
+        """
+        :param data: json match clause
+        :param key: cache key of the tree
+        """
+
+        nodes = []
+        children = []
+
+        # breadth first, numbering children as they are queued
+        queue = [(None, list(data.keys())[0], list(data.values())[0])]
+        while queue:
+            parent, node_type, value = queue.pop(0)
+            node_id = len(nodes) + 1
+
+            node = {'type': node_type}
+            kids = []
+            if isinstance(value, dict):
+                node['value'] = MappingProxyType(copy.deepcopy(value))
+            elif isinstance(value, list):
+                next_id = node_id + len(queue) + 1
+                for i, item in enumerate(value):
+                    kids.append(next_id + i)
+                    queue.append((node_id, list(item.keys())[0], item[list(item.keys())[0]]))
+
+            nodes.append(MappingProxyType(node))
+            children.append(tuple(kids))
+
+        postorder = []
+        stack = [(1, False)]
+        while stack:
+            node_id, visited = stack.pop()
+            if visited:
+                postorder.append(node_id)
+                continue
+            stack.append((node_id, True))
+            stack.extend((child, False) for child in reversed(children[node_id - 1]))
+
+        object.__setattr__(self, 'key', key)
+        object.__setattr__(self, 'nodes', NodeView(tuple(nodes)))
+        object.__setattr__(self, '_children', tuple(children))
+        object.__setattr__(self, '_postorder', tuple(postorder))
+        object.__setattr__(self, '_leaves', tuple(n for n in postorder if not children[n - 1]))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("MatchTree is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("MatchTree is immutable")
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    def successors(self, node_id):
+        """Returns the children of a node"""
+        return self._children[node_id - 1]
+
+    def postorder(self):
+        """Returns all node ids depth first, children before their parent"""
+        return self._postorder
+
+    def leaves(self):
+        """Returns the ids of all leaf nodes in postorder"""
+        return self._leaves
+
+
+class NodeView(object):
+    """Read-only node access of a MatchTree, usable as nodes[n] and nodes()"""
+
+    __slots__ = ('_nodes',)
+
+    def __init__(self, nodes):
+        self._nodes = nodes
+
+    def __getitem__(self, node_id):
+        if not 0 < node_id <= len(self._nodes):
+            raise KeyError(node_id)
+        return self._nodes[node_id - 1]
+
+    def __call__(self):
+        return range(1, len(self._nodes) + 1)
+
+    def __iter__(self):
+        return iter(range(1, len(self._nodes) + 1))
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node_id):
+        return isinstance(node_id, int) and 0 < node_id <= len(self._nodes)
+
+
+def compile_match_tree(data, protocol_no=None):
+    """
+    Returns the compiled match tree of a match clause. Trees are cached per process by protocol number
+    and a hash of the clause, so every consumer of a trial shares one tree.
+
+    :param data: json match clause
+    :param protocol_no: protocol number of the trial the clause belongs to
+    :return: MatchTree
+    """
+
+    digest = hashlib.sha1(json.dumps(data, default=str).encode('utf-8')).hexdigest()
+    key = (protocol_no, digest)
+
+    with _MATCH_TREES_LOCK:
+        tree = _MATCH_TREES.get(key)
+        if tree is not None:
+            _MATCH_TREES.move_to_end(key)
+            return tree
+
+    tree = MatchTree(data, key=key)
+
+    with _MATCH_TREES_LOCK:
+        _MATCH_TREES[key] = tree
+        while len(_MATCH_TREES) > MATCH_TREE_CACHE_SIZE:
+            _MATCH_TREES.popitem(last=False)
+
+    return tree
@@ -33,3 +33,67 @@ mmr_map_rev = {
     'Proficient (MMR-P / MSS)': 'MMR-P/MSS',
     'Deficient (MMR-D / MSI-H)': 'MMR-D/MSI-H'
 }
+
+# number of leaf queries sent to mongo per $facet aggregation
+LEAF_BATCH_SIZE = 20
+
+# number of genomic documents fetched per $in query
+FETCH_CHUNK_SIZE = 1000
+
+# number of trial matches sent to mongo per insert_many
+INSERT_BATCH_SIZE = 1000
+
+# trial matches are built in a staging collection and renamed over trial_match once complete
+TRIAL_MATCH_STAGING = 'trial_match_staging'
+
+# indexes built on the staging collection before it is swapped in, next to those already on trial_match
+trial_match_indexes = [
+    [('sample_id', 1), ('sort_rank', 1)],
+    [('mrn', 1)],
+    [('protocol_no', 1)]
+]
+
+# number of compiled match trees kept per process
+MATCH_TREE_CACHE_SIZE = 10000
+
+# approximate memory cap of the process-wide leaf query result cache
+LEAF_CACHE_MAX_BYTES = int(os.getenv('LEAF_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# number of worker processes used to match trials, 1 matches serially
+MATCH_PROCESSES = int(os.getenv('MATCH_PROCESSES', 1))
+
+# clinical fields copied into trial matches
+clinical_proj = {
+    'SAMPLE_ID': 1,
+    'ORD_PHYSICIAN_NAME': 1,
+    'ORD_PHYSICIAN_EMAIL': 1,
+    'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 1,
+    'REPORT_DATE': 1,
+    'VITAL_STATUS': 1,
+    'FIRST_LAST': 1,
+    'GENDER': 1,
+    '_id': 1
+}
+
+# genomic fields copied into trial matches
+genomic_proj = {
+    'SAMPLE_ID': 1,
+    'TRUE_HUGO_SYMBOL': 1,
+    'TRUE_PROTEIN_CHANGE': 1,
+    'TRUE_VARIANT_CLASSIFICATION': 1,
+    'VARIANT_CATEGORY': 1,
+    'CNV_CALL': 1,
+    'WILDTYPE': 1,
+    'CHROMOSOME': 1,
+    'POSITION': 1,
+    'TRUE_CDNA_CHANGE': 1,
+    'REFERENCE_ALLELE': 1,
+    'TRUE_TRANSCRIPT_EXON': 1,
+    'CANONICAL_STRAND': 1,
+    'ALLELE_FRACTION': 1,
+    'TIER': 1,
+    'CLINICAL_ID': 1,
+    'MMR_STATUS': 1,
+    'ACTIONABILITY': 1,
+    '_id': 1
+}
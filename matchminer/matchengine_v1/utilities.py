@@ -5,13 +5,16 @@ import os
 import sys
 import yaml
 import json
+import hashlib
+import itertools
 import logging
 import pandas as pd
 import datetime as dt
 from pymongo import MongoClient
 
-import oncotreenx
-from matchminer.matchengine_v1.settings import months, TUMOR_TREE, mmr_map, mmr_map_rev
+from matchminer.oncotree import get_oncotree
+from matchminer.matchengine_v1.settings import months, TUMOR_TREE, mmr_map, mmr_map_rev, LEAF_BATCH_SIZE, \
+    FETCH_CHUNK_SIZE, INSERT_BATCH_SIZE, TRIAL_MATCH_STAGING, genomic_proj, clinical_proj, trial_match_indexes
 
 
 def build_gquery(field, txt):
@@ -99,8 +102,8 @@ def build_cquery(c, norm_field, txt):
 
 
 def build_oncotree():
-    """Builds oncotree"""
-    return oncotreenx.build_oncotree(file_path=TUMOR_TREE)
+    """Returns the process-wide cached oncotree"""
+    return get_oncotree(TUMOR_TREE)
 
 
 def normalize_fields(mapping, field):
@@ -373,24 +376,60 @@ def format_query(g, gene=False):
     return alteration
 
 
-def add_matches(trial_matches_df, db):
-    """Add the match table to the database or update what already exists theres"""
+def add_matches(trial_matches, db, batch_size=INSERT_BATCH_SIZE):
+    """
+    Replaces the match table in the database. Nothing is replaced when there are no matches.
+
+    The matches are inserted into a staging collection which gets the indexes of trial_match and is then
+    renamed over it in one step, so readers never see a partial table. If anything fails the staging
+    collection is dropped and trial_match is left as it was.
+
+    :param trial_matches: iterable of trial_match documents, see MatchBuffer.records
+    :param db: database connection
+    :param batch_size: number of documents per insert_many
+    """
+
+    staging = db[TRIAL_MATCH_STAGING]
+    staging.drop()
+
+    try:
+        count = 0
+        for records in chunker(trial_matches, batch_size):
+            staging.insert_many(records)
+            count += len(records)
+
+        if count == 0:
+            staging.drop()
+            return
+
+        create_match_indexes(db.trial_match, staging)
+        staging.rename(db.trial_match.name, dropTarget=True)
+        logging.info('Swapped %d trial matches into %s' % (count, db.trial_match.name))
 
-    if 'clinical_id' in trial_matches_df.columns:
-        trial_matches_df['clinical_id'] = trial_matches_df['clinical_id'].apply(lambda x: str(x))
+    except Exception:
+        logging.error('Building trial matches failed, keeping the current %s' % db.trial_match.name)
+        staging.drop()
+        raise
 
-    if 'genomic_id' in trial_matches_df.columns:
-        trial_matches_df['genomic_id'] = trial_matches_df['genomic_id'].apply(lambda x: str(x))
 
-    if 'report_date' in trial_matches_df.columns:
-        trial_matches_df['report_date'] = trial_matches_df['report_date'].apply(
-            lambda x: dt.datetime.strftime(x, '%Y-%m-%d %X') if pd.notnull(x) else x)
+def create_match_indexes(live, staging):
+    """
+    Builds the indexes of the live trial_match collection and those in trial_match_indexes on the staging collection
+
+    :param live: trial_match collection
+    :param staging: staging collection
+    """
+
+    for name, info in live.index_information().items():
+        if name == '_id_':
+            continue
+        options = {k: v for k, v in info.items() if k not in ('key', 'v', 'ns')}
+        staging.create_index(info['key'], name=name, **options)
 
-    if len(trial_matches_df.index) > 0:
-        db.trial_match.drop()
-        for i in range(0, trial_matches_df.shape[0], 1000):
-            records = list(json.loads(trial_matches_df[i:i + 1000].T.to_json()).values())
-            db.trial_match.insert_many(records)
+    existing = [info['key'] for info in staging.index_information().values()]
+    for keys in trial_match_indexes:
+        if keys not in existing:
+            staging.create_index(keys)
 
 
 def get_db(uri):
@@ -464,6 +503,57 @@ def clean_query_for_msi(g):
     return g
 
 
+def query_key(collection, query, neg=False):
+    """
+    Returns a canonical hash of a leaf query so identical criteria across arms, doses and trials
+    can share a single result.
+
+    Datetimes are reduced to the day, as age criteria are computed relative to now.
+    Compiled regular expressions are reduced to their pattern and flags.
+
+    :param collection: Name of the collection the query runs against
+    :param query: Mongo query
+    :param neg: Whether the matched samples are subtracted from the whole cohort
+    :return: Hex digest
+    """
+
+    def _canonical(obj):
+        if isinstance(obj, dt.datetime):
+            return obj.date().isoformat()
+        if isinstance(obj, re.Pattern):
+            return '/%s/%s' % (obj.pattern, obj.flags)
+        return str(obj)
+
+    txt = json.dumps([collection, neg, query], sort_keys=True, default=_canonical)
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+
+def chunker(seq, size):
+    """Splits an iterable into lists of at most size items"""
+    it = iter(seq)
+    chunk = list(itertools.islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(it, size))
+
+
+def get_trial_status(trial):
+    """
+    Returns 'closed' if the trial is not open to accrual, otherwise 'open'
+
+    :param trial: Entire trial object
+    """
+
+    trial_status = 'open'
+    if '_summary' in trial:
+        if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
+            if 'value' in trial['_summary']['status'][0]:
+                if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
+                    trial_status = 'closed'
+
+    return trial_status
+
+
 def get_cancer_type_match(trial):
     """
     Determines if the trial has criteria to match all solid or all liquid tumors in it.
@@ -1,40 +1,59 @@
 import logging
 import datetime
-import copy
-
-import pandas as pd
+import calendar
+import json
+import uuid
+import hashlib
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from dateutil.relativedelta import relativedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from matchminer.templates.emails import emails
 from matchminer import settings, database
+from matchminer.run_stats import RunStats, stage
 from matchengine.internals.engine import MatchEngine
+from matchengine.internals.match_translator import extract_match_clauses_from_trial, create_match_tree, \
+    get_match_paths, translate_match_path
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
 
+# bump when transform_filter_to_CTML changes its output, so stored filters are compiled again
+CTML_VERSION = 2
+
+# id of the filter run lock document in active_processes
+FILTER_LOCK_ID = "filters"
+
+# background filter matching jobs, see submit_filter_job
+_filter_job_executor = None
+_filter_job_lock = threading.Lock()
 
-def rerun_filters(filters=None, do_update=True, datapush_id=None):
+
+def rerun_filters(filters=None, do_update=True, datapush_id=None, sample_ids=None, stats=None):
     """
     Update all filters, or individual filters accepted as an array of ids
     :param filters: Array of filter IDs or None to run all filters
     :param do_update: When finding matches for temporary filters do not update db
     :param datapush_id: When all filters are rerun as part of the oncopanel datapush,
     flag new matches as 'new' and not 'pending', add datapush ID to matches
+    :param sample_ids: Set of SAMPLE_IDs to match or None to match the whole cohort.
+    Only matches of these samples are updated or disabled.
+    :param stats: RunStats to record the timing of each stage in, or None
     """
 
-    with MatchEngine(
-            plugin_dir='./filters_config/plugins',
-            protocol_nos=filters,
-            match_on_closed=False,
-            config='./filters_config/filters_config.json',
-            db_name=settings.MONGO_DBNAME,
-            match_document_creator_class="DFCIFilterMatchDocumentCreator",
-            report_all_clinical_reasons=True,
-            trial_match_collection="match",
-            chunk_size=5000
-    ) as me:
+    with _filter_match_engine(sample_ids=sample_ids, protocol_nos=filters, chunk_size=5000) as me:
+        if stats is not None:
+            me.get_matches_for_trial = _staged_trial_matching(me.get_matches_for_trial, stats)
+            me.results_transformer = _staged_results_transformer(me.results_transformer, stats)
+
         me.get_matches_for_all_trials()
         if do_update:
-            me.update_all_matches()
+            with stage(stats, 'update_all_matches'):
+                me.update_all_matches()
 
         run_id = me.run_id.hex
         update = {"data_push_id": datapush_id}
@@ -44,10 +63,93 @@ def rerun_filters(filters=None, do_update=True, datapush_id=None):
         if datapush_id:
             update["MATCH_STATUS"] = 0
 
-        database.get_collection("match").update_many({"_me_id": run_id}, {"$set": update})
+        with stage(stats, 'update_match_run_id'):
+            database.get_collection("match").update_many({"_me_id": run_id}, {"$set": update})
     return me.matches, run_id
 
 
+def _staged_trial_matching(get_matches_for_trial, stats):
+    """
+    Wrap MatchEngine.get_matches_for_trial to time the query stage of each filter
+
+    :param get_matches_for_trial: bound method of the MatchEngine
+    :param stats: RunStats
+    :return: function
+    """
+    def staged(protocol_no):
+        with stats.stage('query', protocol_no):
+            matches = get_matches_for_trial(protocol_no)
+        stats.count('query', 'num_samples', len(matches), protocol_no)
+        return matches
+    return staged
+
+
+def _staged_results_transformer(results_transformer, stats):
+    """
+    Wrap the results_transformer plugin of the MatchEngine to time its genomic lookups
+
+    :param results_transformer: bound method of the MatchEngine
+    :param stats: RunStats
+    :return: function
+    """
+    def staged(results):
+        with stats.stage('results_transformer'):
+            results_transformer(results)
+        stats.count('results_transformer', 'num_clinical', len(results))
+    return staged
+
+
+def preview_filter(filter_id):
+    """
+    Find the samples matching a filter without creating match documents.
+
+    Only the query phase of the MatchEngine runs: each match path of the filter is queried and
+    the matched clinical documents are collected. No match documents are built, results_transformer
+    does not look up genomic documents and nothing is written to the db.
+
+    :param filter_id: ID of a filter in the db
+    :return: Dictionary of SAMPLE_IDs to one entry per matching path with the sample's CLINICAL_ID
+    and REPORT_DATE, the same shape get_enrollment reads from match documents
+    """
+    matches = {}
+    with _filter_match_engine(protocol_nos=[filter_id], ignore_run_log=True, skip_run_log_entry=True) as me:
+        if filter_id not in me.trials_to_match_on:
+            return matches
+
+        clinical_ids = me.get_clinical_ids_for_protocol(filter_id, set())
+        for match_clause in extract_match_clauses_from_trial(me, filter_id):
+            match_tree = create_match_tree(me, match_clause)
+            for match_path in get_match_paths(match_tree):
+                query = translate_match_path(me, match_clause, match_path)
+                results = me.loop.run_until_complete(me.run_query(query, clinical_ids))
+                for clinical_id in results:
+                    clinical = me.cache.docs[clinical_id]
+                    matches.setdefault(clinical['SAMPLE_ID'], []).append({
+                        'CLINICAL_ID': clinical_id,
+                        'REPORT_DATE': clinical.get('REPORT_DATE')
+                    })
+    return matches
+
+
+def _filter_match_engine(**kwargs):
+    """
+    Create a MatchEngine configured for matching filters
+
+    :param kwargs: Additional MatchEngine arguments
+    :return: MatchEngine
+    """
+    return MatchEngine(
+        plugin_dir='./filters_config/plugins',
+        match_on_closed=False,
+        config='./filters_config/filters_config.json',
+        db_name=settings.MONGO_DBNAME,
+        match_document_creator_class="DFCIFilterMatchDocumentCreator",
+        report_all_clinical_reasons=True,
+        trial_match_collection="match",
+        **kwargs
+    )
+
+
 def _email_text(user, cur_stamp, new_filter_match_counts):
     """
     Generate email text for notifiying new users about new matches.
@@ -95,28 +197,29 @@ def email_matches(run_id=None):
         run_id = [run_id]
 
     logging.info(f"Filter engine run_id: {' ,'.join(run_id)}")
-    team_query = {
-        "_me_id": {"$in": run_id},
-        "is_disabled": False,
-        "FILTER_STATUS": 1,
-    }
-    teams = list(db.match.find(team_query, {"TEAM_ID": 1}).distinct("TEAM_ID"))
-    for team_id in teams:
-        filters_new_matches_query = {"TEAM_ID": team_id, "is_disabled": False, "FILTER_STATUS": 1}
-        filters_with_new_matches = list(db.match.find(filters_new_matches_query, {"FILTER_ID": 1}).distinct("FILTER_ID"))
-        new_filters_match_counts = _get_new_filters_match_counts(team_id, filters_with_new_matches, run_id[0])
-
-        team_members = list(db.user.find({'teams': {'$elemMatch': {'$in': [team_id]}}}))
-        for user in team_members:
+    new_match_counts = _get_new_match_counts(db, run_id)
+    if not new_match_counts:
+        logging.info("DONE")
+        return
+
+    team_members = {team_id: [] for team_id in new_match_counts}
+    for user in db.user.find({'teams': {'$in': list(new_match_counts)}}):
+        for team_id in user['teams']:
+            if team_id in team_members:
+                team_members[team_id].append(user)
+
+    cur_date = datetime.date.today().strftime("%B %d, %Y")
+    cur_stamp = datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y")
+    email_items = []
+    for team_id, new_filters_match_counts in new_match_counts.items():
+        for user in team_members[team_id]:
             if 'silent' in user and user['silent']:
                 continue
 
-            cur_date = datetime.date.today().strftime("%B %d, %Y")
-            cur_stamp = datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y")
             html = _email_text(user, cur_stamp, new_filters_match_counts)
             logging.info(f"Generated email for {user['email']}")
 
-            email_item = {
+            email_items.append({
                 'email_from': settings.EMAIL_AUTHOR_PROTECTED,
                 'email_to': user['email'],
                 'subject': 'New Patient Matches - %s' % cur_date,
@@ -127,41 +230,52 @@ def email_matches(run_id=None):
                 'errors': [],
                 '_created': datetime.datetime.now(),
                 '_me_id': run_id
-            }
-            db.email.insert(email_item)
+            })
+
+    if email_items:
+        db.email.insert_many(email_items)
     logging.info("DONE")
 
 
-def _get_new_filters_match_counts(team_id, filters_with_new_matches, run_id):
+def _get_new_match_counts(db, run_id):
     """
-    Aggregate new filter match counts by team
+    Aggregate new filter match counts of a run by team with a single aggregation over matches
 
-    :param team_id: Team with associated filters
-    :param filters_with_new_matches: List of filter IDs associated with single team
-    :return:
+    :param db: database connection
+    :param run_id: List of run ids, new matches are counted for the first
+    :return: Dictionary of team ids to dictionaries of filter ids to match counts and filter details
     """
-    db = database.get_db()
-    new_filter_match_counts = {}
-    for filter_id in filters_with_new_matches:
-        matches_query = {
-            "TEAM_ID": team_id,
-            "FILTER_ID": filter_id,
-            "is_disabled": False,
-            "_me_id": run_id
-        }
-        num_matches = len(list(db.match.find(matches_query, {"_id": 1})))
-
-        if num_matches < 1:
+    pipeline = [
+        {'$match': {'_me_id': {'$in': run_id}, 'is_disabled': False}},
+        {'$group': {
+            '_id': {'TEAM_ID': '$TEAM_ID', 'FILTER_ID': '$FILTER_ID'},
+            'num_matches': {'$sum': {'$cond': [{'$eq': ['$_me_id', run_id[0]]}, 1, 0]}},
+            'active': {'$max': {'$eq': ['$FILTER_STATUS', 1]}}
+        }},
+        {'$match': {'active': True}},
+        {'$sort': {'_id.TEAM_ID': 1, '_id.FILTER_ID': 1}}
+    ]
+    groups = list(db.match.aggregate(pipeline))
+
+    # only teams with active filters are notified, even if none of their filters gained matches
+    new_match_counts = {group['_id']['TEAM_ID']: {} for group in groups}
+
+    filter_ids = [group['_id']['FILTER_ID'] for group in groups if group['num_matches'] > 0]
+    proj = {'description': 1, 'label': 1, 'protocol_id': 1}
+    filters = {f['_id']: f for f in db.filter.find({'_id': {'$in': filter_ids}}, proj)}
+
+    for group in groups:
+        filter_ = filters.get(group['_id']['FILTER_ID'])
+        if group['num_matches'] < 1 or filter_ is None:
             continue
-        else:
-            filter_ = list(db.filter.find({'_id': filter_id}))[0]
-            new_filter_match_counts[filter_id] = {
-                "num_matches": num_matches,
-                "description": filter_['description'],
-                "label": filter_['label'],
-                "protocol_id": filter_['protocol_id']
-            }
-    return new_filter_match_counts
+
+        new_match_counts[group['_id']['TEAM_ID']][group['_id']['FILTER_ID']] = {
+            "num_matches": group['num_matches'],
+            "description": filter_.get('description'),
+            "label": filter_['label'],
+            "protocol_id": filter_.get('protocol_id')
+        }
+    return new_match_counts
 
 
 def transform_filter_to_CTML(items, save=False):
@@ -174,6 +288,9 @@ def transform_filter_to_CTML(items, save=False):
     Eventually, this function should be removed as CTML ideally would be generated
     correctly in the frontend and saved/sent directly to the filter engine for matching,
 
+    The hash of the filter criteria the CTML was compiled from is stored as 'filter_hash'. When
+    saving, filters whose criteria did not change since are skipped.
+
     :param save: When calling function explicitly (not part of eve built-in hook), e
     explicitly update filter in db. Usually eve does this automatically
     :param items: List of filters
@@ -181,6 +298,9 @@ def transform_filter_to_CTML(items, save=False):
     """
 
     for item in items:
+        if save and not _filter_changed(item):
+            continue
+
         # MMR_STATUS should always be on the genomic filter
         if 'clinical_filter' in item and 'MMR_STATUS' in item['clinical_filter']:
             item['genomic_filter']['MMR_STATUS'] = item['clinical_filter']['MMR_STATUS']
@@ -233,43 +353,10 @@ def transform_filter_to_CTML(items, save=False):
                     genomic_and[k] = v
 
             # If a user has selected multiple criteria, generate all possible
-            # OR CTML nodes. Filter out error clauses later.
+            # OR CTML nodes.
             # A user may select multiple genes, variant categories, or multiples
-            # of both categories.
-            if len(multis) == 1:
-                for val in genomic_filter[multis[0]]:
-                    or_clause = copy.deepcopy(genomic_and)
-                    or_clause[multis[0]] = val
-                    or_clauses.append({"genomic": or_clause})
-            elif len(multis) == 2:
-                for val in genomic_filter[multis[0]]:
-                    for i_val in genomic_filter[multis[1]]:
-                        or_clause = copy.deepcopy(genomic_and)
-                        or_clause[multis[0]] = val
-                        or_clause[multis[1]] = i_val
-                        or_clauses.append({"genomic": or_clause})
-            elif len(multis) == 3:
-                for val in genomic_filter[multis[0]]:
-                    for i_val in genomic_filter[multis[1]]:
-                        for i_i_val in genomic_filter[multis[2]]:
-                            or_clause = copy.deepcopy(genomic_and)
-                            or_clause[multis[0]] = val
-                            or_clause[multis[1]] = i_val
-                            or_clause[multis[2]] = i_i_val
-                            or_clauses.append({"genomic": or_clause})
-
-        # remove CNV_CALL's when VARIANT_CATEGORY is MUTATION or SV
-        for or_clause in or_clauses:
-            or_node = or_clause['genomic']
-            if 'VARIANT_CATEGORY' in or_node and 'CNV_CALL' in or_node and \
-                    (or_node['VARIANT_CATEGORY'] == 'MUTATION' or or_node['VARIANT_CATEGORY'] == 'SV'):
-                del or_node['CNV_CALL']
-
-        # remove duplicate nodes
-        cleaned_or_clauses = []
-        for i in range(len(or_clauses)):
-            if or_clauses[i] not in or_clauses[i + 1:]:
-                cleaned_or_clauses.append(or_clauses[i])
+            # of any other criteria.
+            or_clauses = list(_genomic_or_clauses(genomic_and, genomic_filter, multis))
 
         clinical_and = {}
         if 'clinical_filter' in item:
@@ -294,20 +381,92 @@ def transform_filter_to_CTML(items, save=False):
         if genomic_and:
             and_clause['and'].append({"genomic": genomic_and})
 
-        if cleaned_or_clauses:
-            and_clause["and"].append({"or": cleaned_or_clauses})
-
+        if or_clauses:
             # If new OR clauses have been generated, remove
             # extra AND clause as it is already included on all OR clauses
-            del and_clause['and'][1]
+            if genomic_and:
+                del and_clause['and'][1]
+
+            and_clause["and"].append({"or": or_clauses})
 
         item['match'] = [and_clause]
         item['description'] = get_filter_description(item)
+        item['filter_hash'] = get_filter_hash(item)
 
         if save:
             database.get_collection("filter").replace_one({"_id": item['_id']}, item)
 
 
+def _genomic_or_clauses(genomic_and, genomic_filter, multis):
+    """
+    Lazily generate one OR clause per combination of the multi-valued genomic criteria.
+
+    Clauses share the values of the single-valued criteria instead of copying them. CNV_CALL is
+    only expanded for combinations where it applies, as it is dropped when VARIANT_CATEGORY is
+    MUTATION or SV, and duplicate clauses are only yielded once.
+
+    :param genomic_and: Single-valued genomic criteria
+    :param genomic_filter: Genomic criteria of the filter
+    :param multis: Keys of the multi-valued criteria
+    :return: generator of {"genomic": criteria} clauses
+    """
+    if not multis:
+        return
+
+    keys = [k for k in multis if k != 'CNV_CALL']
+
+    seen = set()
+    for values in itertools.product(*(genomic_filter[k] for k in keys)):
+        or_node = dict(genomic_and)
+        or_node.update(zip(keys, values))
+
+        # remove CNV_CALL's when VARIANT_CATEGORY is MUTATION or SV
+        if or_node.get('VARIANT_CATEGORY') in ('MUTATION', 'SV'):
+            or_node.pop('CNV_CALL', None)
+            nodes = [or_node]
+        elif 'CNV_CALL' in multis:
+            nodes = [dict(or_node, CNV_CALL=cnv_call) for cnv_call in genomic_filter['CNV_CALL']]
+        else:
+            nodes = [or_node]
+
+        for node in nodes:
+            key = json.dumps(node, sort_keys=True, default=str)
+            if key not in seen:
+                seen.add(key)
+                yield {"genomic": node}
+
+
+def get_filter_hash(item):
+    """
+    Hash the criteria a filter's CTML is compiled from
+
+    :param item: filter
+    :return: hex digest
+    """
+    criteria = {
+        'version': CTML_VERSION,
+        'genomic_filter': item.get('genomic_filter'),
+        'clinical_filter': item.get('clinical_filter')
+    }
+    return hashlib.sha1(json.dumps(criteria, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _filter_changed(item):
+    """
+    Whether a filter's CTML needs to be compiled again
+
+    :param item: filter
+    :return: bool
+    """
+    if 'match' not in item or item.get('filter_hash') != get_filter_hash(item):
+        return True
+
+    # TODO remove once filter backfill is complete
+    # ages of filters on BIRTH_DATE are relative to today
+    clinical_filter = item.get('clinical_filter') or {}
+    return clinical_filter.get('BIRTH_DATE') is not None and 'AGE_NUMERICAL' not in clinical_filter
+
+
 def transform_age_to_CTML(filter_date_obj):
     """
     Transform date object as delivered by UI into valid CTML
@@ -451,80 +610,499 @@ def get_filter_description(item):
 
 
 def find_filter_matches(items):
+    """
+    Find the matches of newly saved filters.
+
+    Temporary filters are previews for the filter builder and are counted in the request by
+    preview_filter so the response carries their counts. All other filters are matched by a
+    background job, the job id is returned as '_job_id' and its progress and results are
+    available at /api/filter_job.
+
+    :param items: List of filters
+    :return:
+    """
     db = database.get_db()
     for item in items:
-        do_update = False if item['temporary'] else True
-        num_matches, run_id = rerun_filters(filters=[item['_id']], do_update=do_update, datapush_id=None)
-        enrollments = get_enrollment(num_matches[item['_id']])
-        item['num_samples'] = len(num_matches[item['_id']])
-        item['enrollment'] = enrollments
+        if not item['temporary']:
+            item['_job_id'] = str(submit_filter_job(item['_id']))
+            continue
+
+        matches = preview_filter(item['_id'])
+        item['num_samples'] = len(matches)
+        item['enrollment'] = get_enrollment(matches)
 
         # don't persist temporary filters
-        if item['status'] == 2 and item['temporary'] == True:
+        if item['status'] == 2:
             db.filter.remove({"_id": item['_id']})
 
 
+def submit_filter_job(filter_id):
+    """
+    Queue a matching job for a saved filter.
+
+    Jobs are recorded in the filter_job collection so their status can be reported by any worker,
+    and run on a thread pool of FILTER_JOB_WORKERS threads, or right away if it is 0. Jobs hold a
+    lease of FILTER_JOB_TTL seconds which their worker renews while it runs them, jobs whose lease
+    expired because their worker died are queued again, see recover_filter_jobs.
+
+    :param filter_id: ID of the filter to match
+    :return: ID of the job
+    """
+    db = database.get_db()
+    recover_filter_jobs(db)
+
+    now = datetime.datetime.utcnow()
+    job = {
+        "filter_id": filter_id,
+        "status": "queued",
+        "created": now,
+        "started": None,
+        "finished": None,
+        "expires": now + datetime.timedelta(seconds=settings.FILTER_JOB_TTL),
+        "attempts": 0,
+        "num_samples": None,
+        "enrollment": None,
+        "run_id": None,
+        "error": None
+    }
+    job_id = db.filter_job.insert_one(job).inserted_id
+    _start_filter_job(job_id)
+    return job_id
+
+
+def run_filter_job(job_id):
+    """
+    Match a single filter and record the outcome on its job.
+    A job is skipped if a newer job of the same filter has been queued in the meantime, or if
+    another worker has taken it.
+
+    :param job_id: ID of the job
+    :return:
+    """
+    db = database.get_db()
+    owner = uuid.uuid4().hex
+    job = _claim_filter_job(db, job_id, owner)
+    if job is None:
+        return
+    filter_id = job['filter_id']
+
+    newer = db.filter_job.find_one({"filter_id": filter_id, "created": {"$gt": job['created']}}, {"_id": 1})
+    if newer is not None:
+        db.filter_job.update_one({"_id": job_id, "owner": owner}, {"$set": {
+            "status": "superseded",
+            "finished": datetime.datetime.utcnow()
+        }})
+        return
+
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(target=_filter_job_heartbeat, args=[job_id, owner, stop_heartbeat], daemon=True)
+    heartbeat.start()
+
+    try:
+        matches, run_id = rerun_filters(filters=[filter_id], do_update=True, datapush_id=None)
+        filter_matches = matches.get(filter_id, {})
+        update = {
+            "status": "done",
+            "num_samples": len(filter_matches),
+            "enrollment": get_enrollment(filter_matches),
+            "run_id": run_id
+        }
+    except Exception as e:
+        logging.exception(f"Filter job {job_id} failed")
+        update = {"status": "failed", "error": str(e)}
+    finally:
+        stop_heartbeat.set()
+
+    # a job whose lease expired may have been taken over, only its current owner records the outcome.
+    update["finished"] = datetime.datetime.utcnow()
+    db.filter_job.update_one({"_id": job_id, "owner": owner}, {"$set": update})
+
+
+def recover_filter_jobs(db):
+    """
+    Queue again the jobs whose lease expired, because the worker which queued or ran them died.
+    Jobs which have been started FILTER_JOB_MAX_ATTEMPTS times are failed instead.
+
+    :param db: database connection
+    :return: list of IDs of the jobs queued again
+    """
+    now = datetime.datetime.utcnow()
+    stale = {"status": {"$in": ["queued", "running"]}, "expires": {"$lt": now}}
+
+    requeued = list()
+    for job in db.filter_job.find(stale, {"attempts": 1}):
+        if job.get('attempts', 0) >= settings.FILTER_JOB_MAX_ATTEMPTS:
+            db.filter_job.update_one(dict(stale, _id=job['_id']), {"$set": {
+                "status": "failed",
+                "error": f"Filter job was abandoned {job['attempts']} times",
+                "finished": now
+            }})
+            continue
+
+        # renewing the lease keeps other workers from queueing the job as well.
+        result = db.filter_job.update_one(dict(stale, _id=job['_id']), {"$set": {
+            "status": "queued",
+            "expires": now + datetime.timedelta(seconds=settings.FILTER_JOB_TTL)
+        }})
+        if result.modified_count:
+            logging.warning(f"Queueing stale filter job {job['_id']} again")
+            requeued.append(job['_id'])
+
+    for job_id in requeued:
+        _start_filter_job(job_id)
+    return requeued
+
+
+def _start_filter_job(job_id):
+    # no workers runs the job in the request, used by the test suite
+    if settings.FILTER_JOB_WORKERS:
+        _get_filter_job_executor().submit(run_filter_job, job_id)
+    else:
+        run_filter_job(job_id)
+
+
+def _claim_filter_job(db, job_id, owner):
+    """
+    Atomically take a queued job, or a running job whose lease has expired
+
+    :param db: database connection
+    :param job_id: ID of the job
+    :param owner: Unique ID of the caller
+    :return: job document, or None if the job is taken or finished
+    """
+    now = datetime.datetime.utcnow()
+    return db.filter_job.find_one_and_update(
+        {"_id": job_id, "$or": [{"status": "queued"}, {"status": "running", "expires": {"$lt": now}}]},
+        {
+            "$set": {
+                "status": "running",
+                "owner": owner,
+                "started": now,
+                "heartbeat": now,
+                "expires": now + datetime.timedelta(seconds=settings.FILTER_JOB_TTL)
+            },
+            "$inc": {"attempts": 1}
+        },
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def _filter_job_heartbeat(job_id, owner, stop):
+    """
+    Extend the lease of a filter job while its owner is running it
+
+    :param job_id: ID of the job
+    :param owner: Unique ID of the job's worker
+    :param stop: Event set when the owner is done
+    """
+    db = database.get_db()
+    while not stop.wait(settings.FILTER_JOB_HEARTBEAT):
+        now = datetime.datetime.utcnow()
+        db.filter_job.update_one(
+            {"_id": job_id, "owner": owner, "status": "running"},
+            {"$set": {"heartbeat": now, "expires": now + datetime.timedelta(seconds=settings.FILTER_JOB_TTL)}}
+        )
+
+
+def _get_filter_job_executor():
+    # created on first use so every forked server worker gets its own threads
+    global _filter_job_executor
+    with _filter_job_lock:
+        if _filter_job_executor is None:
+            _filter_job_executor = ThreadPoolExecutor(max_workers=settings.FILTER_JOB_WORKERS)
+        return _filter_job_executor
+
+
 def get_enrollment(matches):
     """
     Get enrollment counts by month.
+
+    Every month from July 2013 through the last month whose last business day falls before one
+    month from now is counted, plus any other month a match was reported in.
+
     :param matches:
     :return:
     """
-    # Generate date list from first of the month
     today = datetime.date.today() + datetime.timedelta(1 * 365 / 12)
-    all_dates = pd.date_range(datetime.datetime(2013, 7, 1), today, freq='BM')
-    all_dates = all_dates.map(lambda x: datetime.datetime(x.year, x.month, 1))
-    all_dates = pd.Series(all_dates)
-
-    # Get report dates with days reset to first of the month
-    report_dates = []
-    for sample_id in matches:
-        for match in matches[sample_id]:
-            if 'REPORT_DATE' in match and match['REPORT_DATE'] is not None:
-                tmp_date = pd.Series(datetime.datetime(match['REPORT_DATE'].year, match['REPORT_DATE'].month, 1))
-                all_dates = all_dates.append(tmp_date)
 
-    # combine them and remove base counts.
-    total_dates = all_dates.append(report_dates)
-    counts = total_dates.value_counts()
-    counts = counts - 1
-    counts = counts.sort_index()
+    # months as integers (year * 12 + month - 1)
+    first_month = 2013 * 12 + 6
+    last_month = today.year * 12 + today.month - 1
+    if _last_business_day(last_month) > today:
+        last_month -= 1
+    all_months = np.arange(first_month, last_month + 1)
 
-    # convert to lists.
-    x_axis = list(counts.index)
-    y_axis = list(counts)
+    report_months = np.fromiter((match['REPORT_DATE'].year * 12 + match['REPORT_DATE'].month - 1
+                                 for sample_id in matches
+                                 for match in matches[sample_id]
+                                 if match.get('REPORT_DATE') is not None), dtype=np.int64)
 
-    x_axis = [d.strftime("%y-%m-%d") for d in x_axis]
+    # combine them and remove base counts.
+    months, counts = np.unique(np.concatenate([all_months, report_months]), return_counts=True)
+    counts = counts - 1
 
     return {
-        "x_axis": x_axis,
-        "y_axis": y_axis
+        "x_axis": [datetime.date(m // 12, m % 12 + 1, 1).strftime("%y-%m-%d") for m in months],
+        "y_axis": counts.tolist()
     }
 
 
-def start_filter_run(silent=False, datapush_id=None):
+def _last_business_day(month):
+    """
+    Returns the last weekday of a month
+
+    :param month: year * 12 + month - 1
+    :return: date
+    """
+    year, month = divmod(month, 12)
+    day = datetime.date(year, month + 1, calendar.monthrange(year, month + 1)[1])
+    while day.weekday() > 4:
+        day -= datetime.timedelta(1)
+    return day
+
+
+def start_filter_run(silent=False, datapush_id=None, incremental=False, owner=None):
     """
     Wrapper function which calls rerun filters.
-    Creates a record in active_process collection to make sure multiple filter
-    matching runs are not created simultaneously.
+
+    Filter runs hold a leased lock in the active_processes collection so multiple filter
+    matching runs are not created simultaneously. If the lock is held, the run is queued
+    instead: queued runs coalesce into a single run which the lock holder starts once it is done.
 
     :param silent: Whether to send emails or not
     :param datapush_id: ID to append to output matches if relevant
-    :return:
+    :param incremental: Only match samples whose clinical or genomic documents changed since
+    the last completed filter run. Falls back to a full run if there is no previous run.
+    :param owner: Owner of an already acquired filter lock, see acquire_filter_lock
+    :return: run id of the last run, or None if the run was queued
     """
     db = database.get_db()
-    db.active_processes.insert({"filters_running": True})
-    filters = list(db.filter.find({"temporary": False, "status": {"$in": [0, 1]}}))
-    transform_filter_to_CTML(filters, save=True)
-    _, run_id = rerun_filters(datapush_id=datapush_id)
-    db.active_processes.drop()
+    if owner is None:
+        owner = uuid.uuid4().hex
+        if not acquire_filter_lock(db, owner):
+            queue_filter_run(db, silent, datapush_id, incremental)
+            return None
+
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(target=_filter_lock_heartbeat, args=[owner, stop_heartbeat], daemon=True)
+    heartbeat.start()
+
+    try:
+        while True:
+            run_id = _run_all_filters(db, silent, datapush_id, incremental)
+
+            # runs queued in the meantime have to see the data this run did not
+            queued = _release_filter_lock(db, owner)
+            if queued is None:
+                break
+
+            logging.info("Starting queued filter run")
+            silent = queued.get('queued_silent', False)
+            datapush_id = queued.get('queued_data_push_id')
+            incremental = queued.get('queued_incremental', False)
+    except Exception:
+        # runs queued in the meantime take over the lock instead of waiting for an unrelated run
+        queued = _release_filter_lock(db, owner)
+        if queued is not None:
+            logging.info("Starting queued filter run after a failed run")
+            thread = threading.Thread(target=start_filter_run, daemon=True,
+                                      args=[queued.get('queued_silent', False), queued.get('queued_data_push_id'),
+                                            queued.get('queued_incremental', False), owner])
+            thread.start()
+        raise
+    finally:
+        stop_heartbeat.set()
+
+    return run_id
+
 
-    if not silent:
-        email_matches(run_id)
+def _run_all_filters(db, silent, datapush_id, incremental):
+    """
+    Run all saved filters and log the run
+
+    :param db: database connection
+    :param silent: Whether to send emails or not
+    :param datapush_id: ID to append to output matches if relevant
+    :param incremental: Only match samples changed since the last completed filter run
+    :return: run id or None if no samples needed to be matched
+    """
+    started = datetime.datetime.utcnow()
+    stats = RunStats()
+
+    with stats.collect(), stats.stage('total'):
+        sample_ids = None
+        if incremental:
+            last_run = get_last_filter_run(db)
+            if last_run is not None:
+                with stats.stage('changed_samples'):
+                    sample_ids = changed_sample_ids(db, last_run['start_time'])
+                logging.info(f"Incremental filter run over {len(sample_ids)} changed samples")
+
+        run_id = None
+        if sample_ids is None or sample_ids:
+            with stats.stage('ctml_transform'):
+                filters = list(db.filter.find({"temporary": False, "status": {"$in": [0, 1]}}))
+                transform_filter_to_CTML(filters, save=True)
+            _, run_id = rerun_filters(datapush_id=datapush_id, sample_ids=sample_ids, stats=stats)
+
+        if not silent and run_id is not None:
+            with stats.stage('email'):
+                email_matches(run_id)
+
+    db.filter_run_log.insert_one({
+        "run_id": run_id,
+        "start_time": started,
+        "end_time": datetime.datetime.utcnow(),
+        "incremental": sample_ids is not None,
+        "num_samples": len(sample_ids) if sample_ids is not None else None,
+        "data_push_id": datapush_id,
+        **stats.as_document()
+    })
 
     return run_id
 
 
+def acquire_filter_lock(db, owner):
+    """
+    Atomically take the filter run lock if it is free or its lease has expired.
+    The lock is a single document which only exists while it is held, so a concurrent
+    acquisition fails on the duplicate _id.
+
+    :param db: database connection
+    :param owner: Unique ID of the caller
+    :return: True if the lock was acquired
+    """
+    now = datetime.datetime.utcnow()
+    try:
+        db.active_processes.find_one_and_update(
+            {"_id": FILTER_LOCK_ID, "expires": {"$lt": now}},
+            {
+                "$set": {
+                    "filters_running": True,
+                    "owner": owner,
+                    "heartbeat": now,
+                    "expires": now + datetime.timedelta(seconds=settings.FILTER_LOCK_TTL),
+                    "queued": False
+                },
+                "$unset": {"queued_silent": "", "queued_data_push_id": "", "queued_incremental": ""}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def queue_filter_run(db, silent=False, datapush_id=None, incremental=False):
+    """
+    Queue a filter run behind the current lock holder. Queued runs coalesce: the run is
+    silent or incremental only if all queued requests were, and uses the latest datapush ID.
+    If the lock was released in the meantime, a run is started instead.
+
+    :param db: database connection
+    :param silent: Whether to send emails or not
+    :param datapush_id: ID to append to output matches if relevant
+    :param incremental: Only match samples changed since the last completed filter run
+    :return:
+    """
+    queued = db.active_processes.update_one(
+        {"_id": FILTER_LOCK_ID, "expires": {"$gte": datetime.datetime.utcnow()}},
+        {
+            "$set": {"queued": True, "queued_data_push_id": datapush_id},
+            "$min": {"queued_silent": bool(silent), "queued_incremental": bool(incremental)}
+        }
+    )
+    if queued.matched_count:
+        logging.info("Filters already running, queued a filter run")
+        return
+
+    owner = uuid.uuid4().hex
+    if acquire_filter_lock(db, owner):
+        thread = threading.Thread(target=start_filter_run, daemon=True,
+                                  args=[silent, datapush_id, incremental, owner])
+        thread.start()
+    else:
+        queue_filter_run(db, silent, datapush_id, incremental)
+
+
+def is_filter_run_active(db):
+    """
+    Returns whether a filter run holds an unexpired lock
+
+    :param db: database connection
+    """
+    lock = db.active_processes.find_one({"_id": FILTER_LOCK_ID, "expires": {"$gte": datetime.datetime.utcnow()}})
+    return lock is not None
+
+
+def _release_filter_lock(db, owner):
+    """
+    Release the filter run lock, unless a run has been queued meanwhile. In that case the lock
+    is kept and the queued run is handed to the caller.
+
+    :param db: database connection
+    :param owner: Unique ID of the lock holder
+    :return: Lock document with the queued run parameters, or None if the lock was released
+    """
+    released = db.active_processes.delete_one({"_id": FILTER_LOCK_ID, "owner": owner, "queued": {"$ne": True}})
+    if released.deleted_count:
+        return None
+
+    return db.active_processes.find_one_and_update(
+        {"_id": FILTER_LOCK_ID, "owner": owner},
+        {
+            "$set": {"queued": False},
+            "$unset": {"queued_silent": "", "queued_data_push_id": "", "queued_incremental": ""}
+        }
+    )
+
+
+def _filter_lock_heartbeat(owner, stop):
+    """
+    Extend the filter lock lease while its owner is running
+
+    :param owner: Unique ID of the lock holder
+    :param stop: Event set when the owner is done
+    """
+    db = database.get_db()
+    while not stop.wait(settings.FILTER_LOCK_HEARTBEAT):
+        now = datetime.datetime.utcnow()
+        db.active_processes.update_one(
+            {"_id": FILTER_LOCK_ID, "owner": owner},
+            {"$set": {"heartbeat": now, "expires": now + datetime.timedelta(seconds=settings.FILTER_LOCK_TTL)}}
+        )
+
+
+def get_last_filter_run(db):
+    """
+    Returns the log entry of the last completed filter run over all filters, or None
+
+    :param db: database connection
+    """
+    return db.filter_run_log.find_one(sort=[("start_time", -1)])
+
+
+def changed_sample_ids(db, since):
+    """
+    Collects the samples which need to be re-matched against all filters: samples whose clinical
+    document or any of its genomic documents was created or updated since the given time.
+    Deleted samples need no re-match as clinical_delete removes their matches.
+
+    :param db: database connection
+    :param since: datetime (UTC) of the previous run
+    :return: set of SAMPLE_IDs
+    """
+    changed = {"$or": [{"_updated": {"$gte": since}}, {"_created": {"$gte": since}}]}
+
+    sample_ids = set(db.clinical.distinct("SAMPLE_ID", changed))
+
+    clinical_ids = db.genomic.distinct("CLINICAL_ID", changed)
+    if clinical_ids:
+        sample_ids.update(db.clinical.distinct("SAMPLE_ID", {"_id": {"$in": clinical_ids}}))
+
+    return sample_ids
+
+
 def update_filter_pre(item, original):
     """
     When filter is updated via PUT request, update filter "match" clause
@@ -0,0 +1,156 @@
+import os
+import logging
+import threading
+from types import MappingProxyType
+
+import networkx as nx
+import oncotreenx
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# oncotree objects keyed by absolute file path.
+_ONCOTREES = {}
+_ONCOTREES_LOCK = threading.Lock()
+
+
+class OncoTree(object):
+    """
+    Immutable view of an oncotree file with every traversal precomputed.
+
+    Parsing the tumor tree and walking it with networkx used to happen for every clinical
+    node, trial and request. An OncoTree is built once per file (see get_oncotree) and
+    answers descendant, ancestor and text lookups from memory.
+    """
+
+    __slots__ = ('file_path', 'mtime', 'graph', 'primary_tumors', 'liquid', 'solid', 'liquid_texts',
+                 'solid_texts', '_texts', '_codes', '_children', '_descendants', '_ancestors', '_all')
+
+    def __init__(self, file_path, mtime=None):
+        """
+        :param file_path: Path to the oncotree tsv file
+        :param mtime: Modification time of the file when it was read
+        """
+        graph = oncotreenx.build_oncotree(file_path=file_path)
+        nodes = list(graph.nodes())
+
+        # text <-> code lookups. the first node wins, like oncotreenx.lookup_text.
+        texts = {}
+        codes = {}
+        for n in nodes:
+            texts[n] = graph.nodes[n]['text']
+            codes.setdefault(texts[n], n)
+
+        # closures.
+        children = {n: tuple(graph.successors(n)) for n in nodes}
+        descendants = {n: frozenset(nx.descendants(graph, n)) for n in nodes}
+        ancestors = {}
+        for n in nodes:
+            chain = []
+            predecessors = list(graph.predecessors(n))
+            while predecessors:
+                chain.append(predecessors[0])
+                predecessors = list(graph.predecessors(predecessors[0]))
+            ancestors[n] = tuple(chain)
+
+        # primary tumor names as written in the file.
+        oncotree_df = pd.read_csv(file_path, sep='\t')
+        primary_tumors = tuple(i.split('(')[0].strip() for i in oncotree_df.primary.unique().tolist())
+
+        # _LIQUID_ is everything under Lymph and Blood, _SOLID_ is everything else.
+        liquid = set()
+        for txt in ["Lymph", "Blood"]:
+            code = codes.get(txt)
+            if code is not None:
+                liquid.add(code)
+                liquid.update(descendants[code])
+        liquid = frozenset(liquid)
+        solid = frozenset(nodes) - liquid
+
+        object.__setattr__(self, 'file_path', file_path)
+        object.__setattr__(self, 'mtime', mtime)
+        object.__setattr__(self, 'graph', nx.freeze(graph))
+        object.__setattr__(self, 'primary_tumors', primary_tumors)
+        object.__setattr__(self, 'liquid', liquid)
+        object.__setattr__(self, 'solid', solid)
+        object.__setattr__(self, 'liquid_texts', frozenset(texts[n] for n in liquid
+                                                           if texts[n].strip() not in primary_tumors))
+        object.__setattr__(self, 'solid_texts', frozenset(texts[n] for n in solid
+                                                          if texts[n].strip() not in primary_tumors))
+        object.__setattr__(self, '_texts', MappingProxyType(texts))
+        object.__setattr__(self, '_codes', MappingProxyType(codes))
+        object.__setattr__(self, '_children', MappingProxyType(children))
+        object.__setattr__(self, '_descendants', MappingProxyType(descendants))
+        object.__setattr__(self, '_ancestors', MappingProxyType(ancestors))
+        object.__setattr__(self, '_all', frozenset(nodes))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("OncoTree is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("OncoTree is immutable")
+
+    def nodes(self):
+        """Returns all oncotree codes"""
+        return self._all
+
+    def has_node(self, code):
+        return code in self._texts
+
+    def text(self, code):
+        """Returns the free text name of an oncotree code"""
+        return self._texts[code]
+
+    def lookup_text(self, txt):
+        """Returns the oncotree code of a free text name or None"""
+        code = self._codes.get(txt)
+        if code is None:
+            code = oncotreenx.lookup_text(self.graph, txt)
+        return code
+
+    def children(self, code):
+        """Returns the direct children of an oncotree code"""
+        return self._children[code]
+
+    def descendants(self, code):
+        """Returns all nodes below an oncotree code, excluding the code itself"""
+        return self._descendants[code]
+
+    def subtree(self, code):
+        """
+        Returns an oncotree code and everything below it.
+
+        Mirrors nx.dfs_tree, so a code of None yields every node in the tree.
+        """
+        if code is None:
+            return self._all
+        return self._descendants[code] | {code}
+
+    def ancestors(self, code):
+        """Returns the chain of parents of an oncotree code, nearest first and ending at the root"""
+        return self._ancestors[code]
+
+
+def get_oncotree(file_path):
+    """
+    Returns the process-wide OncoTree for the given file, reloading it when the file's
+    mtime changes.
+
+    :param file_path: Path to the oncotree tsv file
+    :return: OncoTree
+    """
+    file_path = os.path.abspath(file_path)
+    mtime = os.path.getmtime(file_path)
+
+    onco_tree = _ONCOTREES.get(file_path)
+    if onco_tree is not None and onco_tree.mtime == mtime:
+        return onco_tree
+
+    with _ONCOTREES_LOCK:
+        onco_tree = _ONCOTREES.get(file_path)
+        if onco_tree is None or onco_tree.mtime != mtime:
+            logging.info("loading oncotree %s" % file_path)
+            onco_tree = OncoTree(file_path, mtime)
+            _ONCOTREES[file_path] = onco_tree
+
+    return onco_tree
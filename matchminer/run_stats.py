@@ -0,0 +1,240 @@
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+
+try:
+    from motor.frameworks import asyncio as motor_asyncio
+except ImportError:
+    motor_asyncio = None
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# the RunStats collecting database counters in the current thread or task, see RunStats.collect
+_collecting = contextvars.ContextVar('run_stats_collecting', default=None)
+
+# motor's own executor while collections are open, see _use_context_executor
+_motor_executor = None
+_motor_collections = 0
+_motor_lock = threading.Lock()
+
+
+class RunStats(object):
+    """
+    Wall time and database counters per stage of a filter run.
+
+    While collecting, every MongoDB command issued by the collecting thread, and by the asyncio tasks
+    and motor executor threads it starts, counts towards all stages open at the time, so the figures
+    of a stage include its nested stages. Commands of other threads are not counted. Stages can be entered
+    repeatedly, and may break their figures down per item such as a filter ID.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.items = {}
+        self._open = []
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def collect(self):
+        """Count database commands of the current thread towards this run while the context is open"""
+        if _collecting.get() is not None:
+            raise RuntimeError("RunStats are already being collected")
+
+        token = _collecting.set(self)
+        _use_context_executor()
+        try:
+            yield self
+        finally:
+            _restore_motor_executor()
+            _collecting.reset(token)
+
+    @contextmanager
+    def stage(self, name, item=None):
+        """
+        Time a stage of the run
+
+        :param name: name of the stage
+        :param item: optional key to break the stage down by
+        """
+        records = [self.stages.setdefault(name, _new_record())]
+        if item is not None:
+            records.append(self.items.setdefault(name, {}).setdefault(str(item), _new_record()))
+
+        with self._lock:
+            self._open.extend(records)
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                for record in records:
+                    record['calls'] += 1
+                    record['wall_time'] += elapsed
+                    self._open.remove(record)
+
+    def count(self, name, counter, value=1, item=None):
+        """
+        Add to a custom counter of a stage
+
+        :param name: name of the stage
+        :param counter: name of the counter
+        :param value: amount to add
+        :param item: optional key the stage is broken down by
+        """
+        with self._lock:
+            records = [self.stages.setdefault(name, _new_record())]
+            if item is not None:
+                records.append(self.items.setdefault(name, {}).setdefault(str(item), _new_record()))
+            for record in records:
+                record[counter] = record.get(counter, 0) + value
+
+    def as_document(self):
+        """Returns the stages and their breakdowns, slowest items first"""
+        with self._lock:
+            return {
+                'stages': {name: dict(record) for name, record in self.stages.items()},
+                'items': {
+                    name: sorted(({'item': key, **record} for key, record in items.items()),
+                                 key=lambda record: record['wall_time'], reverse=True)
+                    for name, items in self.items.items()
+                }
+            }
+
+    def _started(self, event):
+        with self._lock:
+            if not self._open:
+                return
+            records = list(self._open)
+            self._pending[event.request_id] = records
+            for record in records:
+                record['db_round_trips'] += 1
+
+    def _finished(self, event, reply=None):
+        with self._lock:
+            records = self._pending.pop(event.request_id, None)
+            if records is None:
+                return
+
+            returned, written = _reply_counts(event.command_name, reply)
+            for record in records:
+                record['db_time'] += event.duration_micros / 1e6
+                record['docs_returned'] += returned
+                record['docs_written'] += written
+
+
+class StageCommandListener(monitoring.CommandListener):
+    """Forwards MongoDB command events to the collecting RunStats"""
+
+    def started(self, event):
+        stats = _collecting.get()
+        if stats is not None:
+            stats._started(event)
+
+    def succeeded(self, event):
+        stats = _collecting.get()
+        if stats is not None:
+            stats._finished(event, event.reply)
+
+    def failed(self, event):
+        stats = _collecting.get()
+        if stats is not None:
+            stats._finished(event)
+
+
+class _ContextExecutor(ThreadPoolExecutor):
+    """Thread pool running every task in the context of the thread which submitted it"""
+
+    def submit(self, fn, *args, **kwargs):
+        return super(_ContextExecutor, self).submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def stage(stats, name, item=None):
+    """
+    Time a stage if stats are being collected
+
+    :param stats: RunStats or None
+    :param name: name of the stage
+    :param item: optional key to break the stage down by
+    """
+    if stats is None:
+        return _no_stage()
+    return stats.stage(name, item)
+
+
+@contextmanager
+def _no_stage():
+    yield
+
+
+def _new_record():
+    return {'calls': 0, 'wall_time': 0.0, 'db_round_trips': 0, 'db_time': 0.0, 'docs_returned': 0, 'docs_written': 0}
+
+
+def _reply_counts(command_name, reply):
+    """
+    Count the documents returned or written by a command
+
+    :param command_name: name of the MongoDB command
+    :param reply: command reply or None if it failed
+    :return: (documents returned, documents written)
+    """
+    if not reply:
+        return 0, 0
+
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', []))), 0
+
+    if command_name in ('insert', 'update', 'delete'):
+        return 0, reply.get('n', 0)
+
+    if command_name == 'findAndModify':
+        return 1 if reply.get('value') is not None else 0, 0
+
+    return 0, 0
+
+
+def _use_context_executor():
+    """
+    Motor runs the commands of the MatchEngine on its own thread pool, which doesn't pass on the context
+    of the run. While any collection is open its pool is swapped for one which does.
+    """
+    global _motor_executor, _motor_collections
+    if motor_asyncio is None:
+        return
+
+    with _motor_lock:
+        if _motor_collections == 0:
+            executor = getattr(motor_asyncio, '_EXECUTOR', None)
+            if not isinstance(executor, ThreadPoolExecutor):
+                return
+            _motor_executor = executor
+            motor_asyncio._EXECUTOR = _ContextExecutor(max_workers=executor._max_workers)
+        _motor_collections += 1
+
+
+def _restore_motor_executor():
+    """Give motor its own thread pool back once the last collection is closed"""
+    global _motor_executor, _motor_collections
+    with _motor_lock:
+        if _motor_executor is None:
+            return
+
+        _motor_collections -= 1
+        if _motor_collections == 0:
+            motor_asyncio._EXECUTOR.shutdown(wait=False)
+            motor_asyncio._EXECUTOR = _motor_executor
+            _motor_executor = None
+
+
+# listeners only apply to clients created after they are registered, which includes the
+# MatchEngine connections opened for every run
+monitoring.register(StageCommandListener())
@@ -7,18 +7,22 @@
     Securing an Eve-powered API with Token based Authentication.
 """
 import json
+import atexit
 import logging
 import time
 import uuid
 import datetime
+import threading
 from functools import wraps
 
 from bson import ObjectId
 from eve.auth import TokenAuth
 from flask import current_app as app, Response, request, abort
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
 
-from matchminer import database
+from matchminer import database, settings
 from matchminer.settings import ONCORE_CURATION_AUTH_TOKEN, DISABLE_ONCORE_AUTH
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
@@ -37,18 +41,9 @@ class TokenAuth(TokenAuth):
         accounts = app.data.driver.db['user']
 
         # search for user with right token and allowed roles.
-        lookup = {'token': token}
-        if allowed_roles:
-            lookup['roles'] = {"$in": allowed_roles}
-
-        user = None
-        for attempt in range(5):
-            try:
-                user = accounts.find_one(lookup)
-            except Exception as e:
-                wait_t = 0.2 * pow(2, attempt)  # exponential back off
-                logging.warning("PyMongo auto-reconnecting... %s. Waiting %.1f seconds.", str(e), wait_t)
-                time.sleep(wait_t)
+        user = find_token_user(accounts, token)
+        if user is not None and allowed_roles and not set(user['roles']).intersection(allowed_roles):
+            user = None
 
         # return none.
         if user is None:
@@ -64,10 +59,8 @@ class TokenAuth(TokenAuth):
         # verify it hasn't been toooo long.
         cur_time = datetime.datetime.now()
         cur_time = cur_time.replace(tzinfo=None)
-        if not skip_lastuath and 'last_auth' in user:
-
-            # extract last auth.
-            last_auth = user['last_auth'].replace(tzinfo=None)
+        last_auth = get_last_auth_writer(accounts).last_auth(user)
+        if not skip_lastuath and last_auth is not None:
 
             # find difference.
             diff = cur_time - last_auth
@@ -76,6 +69,7 @@ class TokenAuth(TokenAuth):
             if (float(total_seconds) / 60.0) > app.config['TOKEN_TIMEOUT']:
                 # reset token.
                 accounts.update_one({'_id': user['_id']}, {'$set': {'token': str(uuid.uuid4())}})
+                invalidate_user_tokens(user['_id'])
 
                 # don't authorize the request.
                 return None
@@ -83,19 +77,181 @@ class TokenAuth(TokenAuth):
         # set the user of this request.
         self.set_request_auth_value(user)
 
-        # log results
-        if user is None:
-            logging.info("warning failed authentication")
-            logging.info("token: %s" % token)
-        else:
-
-            # update with last auth.
-            accounts.update_one({'_id': user['_id']}, {'$set': {'last_auth': datetime.datetime.now()}})
+        # update with last auth.
+        get_last_auth_writer(accounts).touch(user['_id'], cur_time)
 
         # return results.
         return user
 
 
+# users by token, with the time they were looked up
+_token_cache = dict()
+_token_cache_lock = threading.Lock()
+
+
+def find_token_user(accounts, token):
+    """
+    Returns the user of a token. Users are cached for TOKEN_CACHE_TTL seconds, so a token which
+    is rotated by another process stays valid here for at most that long.
+
+    :param accounts: user collection
+    :param token: authentication token
+    :return: user or None
+    """
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+        if cached is not None and now - cached[1] < settings.TOKEN_CACHE_TTL:
+            return dict(cached[0])
+
+    user = None
+    for attempt in range(5):
+        try:
+            user = accounts.find_one({'token': token})
+            break
+        except Exception as e:
+            wait_t = 0.2 * pow(2, attempt)  # exponential back off
+            logging.warning("PyMongo auto-reconnecting... %s. Waiting %.1f seconds.", str(e), wait_t)
+            time.sleep(wait_t)
+
+    # unknown tokens are not cached, they may belong to a login in progress.
+    if user is not None and settings.TOKEN_CACHE_TTL:
+        with _token_cache_lock:
+            _token_cache[token] = (user, now)
+            for key in [key for key, (_, cached_at) in _token_cache.items() if now - cached_at >= settings.TOKEN_CACHE_TTL]:
+                del _token_cache[key]
+        return dict(user)
+
+    return user
+
+
+def invalidate_user_tokens(user_id):
+    """
+    Drop the cached tokens of a user, to be called whenever its token is rotated
+
+    :param user_id: user id
+    """
+    with _token_cache_lock:
+        for key in [key for key, (user, _) in _token_cache.items() if user['_id'] == user_id]:
+            del _token_cache[key]
+
+
+class LastAuthWriter(object):
+    """
+    Records the last authentication of users.
+
+    Authentications are kept in memory and written by a background thread every
+    LAST_AUTH_WRITE_INTERVAL seconds, so a user's last_auth is written at most once per interval
+    however many requests it makes. The timeout check uses the most recent of the stored and the
+    pending authentication.
+    """
+
+    def __init__(self, accounts, interval):
+        """
+        :param accounts: user collection
+        :param interval: seconds between writes
+        """
+        self.accounts = accounts
+        self.interval = interval
+        self._seen = dict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def touch(self, user_id, when):
+        """
+        Record an authentication
+
+        :param user_id: user id
+        :param when: time of the authentication
+        """
+        with self._lock:
+            self._seen[user_id] = when
+            self._pending[user_id] = when
+
+    def last_auth(self, user):
+        """
+        Returns the last authentication of a user
+
+        :param user: user document
+        :return: datetime or None
+        """
+        with self._lock:
+            seen = self._seen.get(user['_id'])
+
+        stored = user.get('last_auth')
+        if stored is not None:
+            stored = stored.replace(tzinfo=None)
+        if seen is None or (stored is not None and stored > seen):
+            return stored
+        return seen
+
+    def flush(self):
+        """Write the pending authentications"""
+        with self._lock:
+            pending = self._pending
+            self._pending = dict()
+
+        if not pending:
+            return
+
+        # $max keeps the latest authentication when several processes write.
+        requests = [UpdateOne({'_id': user_id}, {'$max': {'last_auth': when}}) for user_id, when in pending.items()]
+        try:
+            self.accounts.bulk_write(requests, ordered=False)
+        except PyMongoError as e:
+            logging.error(f"Writing last_auth of {len(pending)} users failed: {e}")
+            with self._lock:
+                for user_id, when in pending.items():
+                    self._pending.setdefault(user_id, when)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("last_auth writer failed")
+
+
+class _SyncLastAuthWriter(object):
+    """Writes last_auth in the request, used when LAST_AUTH_WRITE_INTERVAL is 0"""
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+
+    def touch(self, user_id, when):
+        self.accounts.update_one({'_id': user_id}, {'$set': {'last_auth': when}})
+
+    def last_auth(self, user):
+        if 'last_auth' not in user:
+            return None
+        return user['last_auth'].replace(tzinfo=None)
+
+
+# started on first use so every forked server worker gets its own thread
+_last_auth_writer = None
+_last_auth_writer_lock = threading.Lock()
+
+
+def get_last_auth_writer(accounts):
+    """
+    Returns the last_auth writer of the process
+
+    :param accounts: user collection
+    """
+    global _last_auth_writer
+    if not settings.LAST_AUTH_WRITE_INTERVAL:
+        return _SyncLastAuthWriter(accounts)
+
+    with _last_auth_writer_lock:
+        if _last_auth_writer is None:
+            _last_auth_writer = LastAuthWriter(accounts, settings.LAST_AUTH_WRITE_INTERVAL)
+            atexit.register(_last_auth_writer.flush)
+        return _last_auth_writer
+
+
 def authorize_custom_request(request):
     """
     Authorize custom request
@@ -108,7 +264,7 @@ def authorize_custom_request(request):
         token = request.authorization.username
 
         # find the user.
-        user = accounts.find_one({'token': token})
+        user = find_token_user(accounts, token)
 
         # die on this request.
         if user is None:
@@ -75,6 +75,19 @@ ES_SETTINGS = os.path.abspath(os.path.join(os.path.dirname(__file__), '../elasti
 
 
 TUMOR_TREE = os.path.abspath(os.path.join(os.path.dirname(__file__), './data/tumor_tree.txt'))
+FILTER_JOB_WORKERS = 2
+FILTER_LOCK_TTL = 600
+FILTER_LOCK_HEARTBEAT = 60
+FILTER_JOB_TTL = 600
+FILTER_JOB_HEARTBEAT = 60
+FILTER_JOB_MAX_ATTEMPTS = 3
+HIPAA_QUEUE_SIZE = 1000
+HIPAA_QUEUE_TIMEOUT = 1
+HIPAA_BATCH_SIZE = 500
+# durable directory private to the server user, transactions are not spooled if it is not set
+HIPAA_SPOOL_DIR = os.getenv('HIPAA_SPOOL_DIR')
+TOKEN_CACHE_TTL = 30
+LAST_AUTH_WRITE_INTERVAL = 60
 
 
 # connect to secrets
@@ -77,6 +77,7 @@ user = {
             'token': 0,
         }
     },
+    'mongo_indexes': {'token_1': [('token', 1)]},
     "allowed_read_roles": ["admin", "service", "user"],
     "allowed_write_roles": ["admin", "service"],
     'item_methods': ['GET', 'PATCH', 'PUT', 'DELETE']
@@ -103,7 +104,11 @@ clinical = {
     'schema': matchminer.data_model.clinical_schema,
     "allowed_read_roles": ["admin", "service", "user"],
     "allowed_write_roles": ["admin", "service"],
-    'mongo_indexes': {'FIRST_LAST': [('FIRST_LAST', 1)]},
+    'mongo_indexes': {
+        'FIRST_LAST': [('FIRST_LAST', 1)],
+        'SAMPLE_ID_1': [('SAMPLE_ID', 1)],
+        'MRN_1': [('MRN', 1)]
+    },
     'item_methods': ['GET', 'PATCH', 'PUT', 'DELETE']
 }
 
@@ -118,6 +123,11 @@ genomic = {
     'schema': matchminer.data_model.genomic_schema,
     "allowed_read_roles": ["admin", "service", "user"],
     "allowed_write_roles": ["admin", "service"],
+    'mongo_indexes': {
+        'CLINICAL_ID_1': [('CLINICAL_ID', 1)],
+        'SAMPLE_ID_1': [('SAMPLE_ID', 1)],
+        'TRUE_HUGO_SYMBOL_1_VARIANT_CATEGORY_1': [('TRUE_HUGO_SYMBOL', 1), ('VARIANT_CATEGORY', 1)]
+    },
     'item_methods': ['GET', 'PATCH', 'PUT', 'DELETE']
 }
 
@@ -125,6 +135,10 @@ match = {
     'schema': matchminer.data_model.match_schema,
     "allowed_read_roles": ["admin", "service", "user"],
     "allowed_write_roles": ["admin", "service", "user"],
+    'mongo_indexes': {
+        'CLINICAL_ID_1': [('CLINICAL_ID', 1)],
+        'TEAM_ID_1_FILTER_ID_1_is_disabled_1__me_id_1': [('TEAM_ID', 1), ('FILTER_ID', 1), ('is_disabled', 1), ('_me_id', 1)]
+    },
     'item_methods': ['GET', 'PATCH', 'PUT', 'DELETE']
 }
 
@@ -166,6 +180,7 @@ trial = {
     "allowed_write_roles": ["admin", "curator"],
     "public_item_methods": ['GET'],
     "public_methods": ['GET'],
+    'mongo_indexes': {'protocol_no_1': [('protocol_no', 1)]},
     'item_methods': ['GET', 'PATCH', 'PUT', 'DELETE']
 }
 response = {
@@ -208,6 +223,12 @@ trial_match = {
     'allow_unknown': False,
     'allowed_read_roles': ["admin", "service", "oncologist", "cti"],
     'allowed_write_roles': ["admin", "service", "oncologist", "cti"],
+    'datasource': {
+        'default_sort': [('sample_id', 1), ('sort_rank', 1)]
+    },
+    'mongo_indexes': {
+        'sample_id_1_sort_rank_1': [('sample_id', 1), ('sort_rank', 1)]
+    },
     'item_methods': ['GET']
 }
 
@@ -224,6 +245,7 @@ patient_view = {
     'allow_unknown': False,
     "allowed_read_roles": ["admin", "service", "user", "oncologist", "cti"],
     "allowed_write_roles": ["admin", "service", "user", "oncologist", "cti"],
+    'mongo_indexes': {'user_id_1_mrn_1_protocol_no_1': [('user_id', 1), ('mrn', 1), ('protocol_no', 1)]},
     'item_methods': ['GET', 'PUT'],
 }
 
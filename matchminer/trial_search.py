@@ -1,10 +1,6 @@
-import oncotreenx
-import pandas as pd
-import networkx as nx
-
 from matchminer.settings import TUMOR_TREE
+from matchminer.oncotree import get_oncotree
 from matchminer.matchengine_v1.engine import MatchEngine
-from .database import get_db
 
 
 class Summary:
@@ -193,10 +189,10 @@ class Summary:
         :param item: Trial document
         """
 
-        m = MatchEngine(get_db())
+        protocol_no = item.get('protocol_no')
         for step in item['treatment_list']['step']:
             if 'match' in step:
-                g = m.create_match_tree(step['match'][0])
+                g = MatchEngine.create_match_tree(step['match'][0], protocol_no)
                 pmt = ParseMatchTree(g)
                 signatures = pmt.extract_signatures()
                 self.mmr.extend(signatures[0])
@@ -207,7 +203,7 @@ class Summary:
             if 'arm' in step:
                 for arm in step['arm']:
                     if 'match' in arm:
-                        g = m.create_match_tree(arm['match'][0])
+                        g = MatchEngine.create_match_tree(arm['match'][0], protocol_no)
                         pmt = ParseMatchTree(g)
                         signatures = pmt.extract_signatures()
                         self.mmr.extend(signatures[0])
@@ -218,7 +214,7 @@ class Summary:
                     if 'dose_level' in arm:
                         for dose in arm['dose_level']:
                             if 'match' in dose:
-                                g = m.create_match_tree(dose['match'][0])
+                                g = MatchEngine.create_match_tree(dose['match'][0], protocol_no)
                                 pmt = ParseMatchTree(g)
                                 signatures = pmt.extract_signatures()
                                 self.mmr.extend(signatures[0])
@@ -310,7 +306,7 @@ class Autocomplete:
         }
         self.genes = []
         self.cancer_type_dict = dict()
-        self.m = MatchEngine(get_db())
+        self.protocol_no = item.get('protocol_no')
 
     @staticmethod
     def _get_cancer_type_weight(cancer_type, hierarchy='default'):
@@ -416,7 +412,7 @@ class Autocomplete:
         Extract Cancer Type, Gene, and Variant data from the given match tree
         """
 
-        g = self.m.create_match_tree(match)
+        g = MatchEngine.create_match_tree(match, self.protocol_no)
         pmt = ParseMatchTree(g)
         for key, value_list in list(pmt.extract_cancer_types().items()):
             if key not in self.cancer_type_dict:
@@ -524,7 +520,7 @@ class ParseMatchTree:
 
     def __init__(self, g):
         """
-        :param g: DiGraph match tree
+        :param g: compiled match tree, see MatchEngine.create_match_tree
         """
         self.g = g
 
@@ -538,7 +534,7 @@ class ParseMatchTree:
         genes = []
 
         # iterate through the graph
-        for node_id in list(nx.dfs_postorder_nodes(self.g, source=1)):
+        for node_id in self.g.postorder():
             node = self.g.nodes[node_id]
             if node['type'] == 'genomic':
                 if 'hugo_symbol' in node['value']:
@@ -577,7 +573,7 @@ class ParseMatchTree:
         exclusions = []
 
         # iterate through the graph
-        for node_id in list(nx.dfs_postorder_nodes(self.g, source=1)):
+        for node_id in self.g.postorder():
             node = self.g.nodes[node_id]
             if node['type'] == 'genomic':
                 if 'hugo_symbol' in node['value']:
@@ -648,19 +644,20 @@ class ParseMatchTree:
         cancer_types_expanded = []
         primary_cancer_types = []
         excluded_cancer_types = []
-        onco_tree = oncotreenx.build_oncotree(file_path=TUMOR_TREE)
-        liquid_children_txt, solid_children_txt = expand_liquid_oncotree(onco_tree)
+        onco_tree = get_oncotree(TUMOR_TREE)
+        liquid_children_txt, solid_children_txt = onco_tree.liquid_texts, onco_tree.solid_texts
+        primary_tumors = onco_tree.primary_tumors
 
         # iterate through the graph
-        for node_id in list(nx.dfs_postorder_nodes(self.g, source=1)):
+        for node_id in self.g.postorder():
             node = self.g.nodes[node_id]
             if node['type'] == 'clinical':
                 if 'oncotree_primary_diagnosis' in node['value']:
 
                     diagnosis = node['value']['oncotree_primary_diagnosis']
 
-                    n = oncotreenx.lookup_text(onco_tree, diagnosis.replace('!', ''))
-                    children = list(nx.dfs_tree(onco_tree, n))
+                    n = onco_tree.lookup_text(diagnosis.replace('!', ''))
+                    children = onco_tree.subtree(n)
 
                     if diagnosis == '_SOLID_':
                         children_txt = solid_children_txt
@@ -671,7 +668,7 @@ class ParseMatchTree:
                         primary_parent = 'All Liquid Tumors'
                         parents_txt = ['All Liquid Tumors']
                     else:
-                        children_txt = [onco_tree.nodes[nn]['text'] for nn in children]
+                        children_txt = [onco_tree.text(nn) for nn in children]
 
                         if n is not None:
                             parents, parents_txt, primary_parent = get_parents(onco_tree, n)
@@ -684,7 +681,6 @@ class ParseMatchTree:
                         excluded_cancer_types.append(diagnosis.replace('!', ''))
                         excluded_cancer_types.extend(children_txt)
                     else:
-                        primary_tumors = get_primary_tumors()
                         cancer_types_expanded.append(parse_diagnosis(diagnosis))
                         cancer_types_expanded.extend(children_txt)
                         cancer_types_expanded.extend([i for i in parents_txt if i.split()[0] not in primary_tumors])
@@ -717,7 +713,7 @@ class ParseMatchTree:
         }
 
         # iterate through the graph
-        for node_id in list(nx.dfs_postorder_nodes(self.g, source=1)):
+        for node_id in self.g.postorder():
             node = self.g.nodes[node_id]
             if node['type'] == 'genomic':
                 if 'mmr_status' in node['value']:
@@ -741,7 +737,7 @@ class ParseMatchTree:
         """
 
         hr_status = []
-        for node_id in list(nx.dfs_postorder_nodes(self.g, source=1)):
+        for node_id in self.g.postorder():
             node = self.g.nodes[node_id]
             if node['type'] == 'clinical':
 
@@ -802,47 +798,11 @@ def parse_dfci_investigator(staff, overall_pi, dfci=True):
     }
 
 
-def expand_liquid_oncotree(onco_tree):
-    """
-    Expand the _LIQUID_ oncotree node to all of its children
-
-    :param onco_tree: Digraph of the Oncotree
-    :returns liquid_children: All liquid tumor types in the Oncotree
-             solid_children: All tumor types in the Oncotree minus "liquid_children"
-    """
-
-    # build the nodes for liquid.
-    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
-    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
-
-    nodes1 = list(nx.dfs_tree(onco_tree, node1))
-    nodes2 = list(nx.dfs_tree(onco_tree, node2))
-    nodes = list(set(nodes1).union(set(nodes2)))
-
-    primary_tumors = get_primary_tumors()
-
-    liquid_children_codes = []
-    for n in nodes:
-        liquid_children_codes.extend(list(nx.dfs_tree(onco_tree, n)))
-
-    liquid_children = [onco_tree.nodes[nn]['text'] for nn in liquid_children_codes
-                       if onco_tree.nodes[nn]['text'].strip() not in primary_tumors]
-
-    # solid nodes are all other nodes
-    all_nodes = set(list(onco_tree.nodes()))
-    tmp_nodes = all_nodes - set(nodes)
-    solid_children_codes = list(tmp_nodes)
-    solid_children = [onco_tree.nodes[nn]['text'] for nn in solid_children_codes
-                      if onco_tree.nodes[nn]['text'].strip() not in primary_tumors]
-
-    return liquid_children, solid_children
-
-
 def get_parents(onco_tree, node):
     """
     Retrive all parents of a given onco tree node
 
-    :param onco_tree: Oncotree directed graph object
+    :param onco_tree: OncoTree object
     :param node: Location within the oncotree
     :return: List of all parents
     """
@@ -850,16 +810,19 @@ def get_parents(onco_tree, node):
     if not node:
         return [], []
 
-    predecessors = list(onco_tree.predecessors(node))
-    parents_txt = [onco_tree.nodes._nodes[n]['text'] for n in predecessors]
-    check = onco_tree.nodes._nodes[predecessors[0]]['text']
-
-    if check and 'root' not in check:
-        pr, pa, primary_parent = get_parents(onco_tree, predecessors[0])
-        predecessors.extend(pr)
-        parents_txt.extend(pa)
-    else:
-        primary_parent = node.title()
+    # walk up the precomputed ancestor chain until the root.
+    predecessors = []
+    parents_txt = []
+    primary_parent = node.title()
+    child = node
+    for parent in onco_tree.ancestors(node):
+        predecessors.append(parent)
+        parents_txt.append(onco_tree.text(parent))
+        check = onco_tree.text(parent)
+        if not check or 'root' in check:
+            primary_parent = child.title()
+            break
+        child = parent
 
     return predecessors, parents_txt, primary_parent
 
@@ -886,5 +849,4 @@ def get_primary_tumors():
     """
     Returns a list of all primary tumor types
     """
-    oncotree_df = pd.read_csv(TUMOR_TREE, sep='\t')
-    return [i.split('(')[0].strip() for i in oncotree_df.primary.unique().tolist()]
+    return list(get_oncotree(TUMOR_TREE).primary_tumors)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import sys
 import argparse
 from eve import Eve
 from flask import redirect
@@ -6,7 +7,9 @@ from flask import redirect
 from matchminer.elasticsearch import reset_elasticsearch
 from matchminer.utilities import *
 from matchminer.custom import blueprint
-from matchminer import settings, security
+from matchminer import settings, security, database
+from matchminer.indexes import ensure_indexes, index_report
+from matchminer.event_hooks.trial_match import rank_trial_matches
 from matchminer.events import register_hooks
 from matchminer.validation import ConsentValidatorEve
 from matchminer.components.oncore.oncore_app import oncore_blueprint
@@ -63,6 +66,23 @@ def run_server(args):
     app.run(host='0.0.0.0', port=settings.API_PORT, threaded=True)
 
 
+def run_indexes(args):
+    db = database.get_db()
+    if not args.verify_only:
+        ensure_indexes(db, settings.DOMAIN)
+
+    report = index_report(db, settings.DOMAIN)
+    for index in report['missing']:
+        logging.warning("missing index %s on %s: %s" % (index['name'], index['collection'], index['keys']))
+    for index in report['unused']:
+        logging.info("unused index %s on %s since %s" % (index['name'], index['collection'], index['since']))
+    for scan in report['collection_scans']:
+        logging.warning("collection scan on %s: %s" % (scan['collection'], scan['query']))
+
+    if report['missing'] or report['collection_scans']:
+        sys.exit(1)
+
+
 # main
 if __name__ == '__main__':
     main_p = argparse.ArgumentParser()
@@ -80,5 +100,12 @@ if __name__ == '__main__':
     subp_p = subp.add_parser('reannotate-trials', help='regenerates elasticsearch fields on all trials')
     subp_p.set_defaults(func=lambda x: reannotate_trials())
 
+    subp_p = subp.add_parser('rank-trial-matches', help='stores the rank of all trial matches, run after matchengine')
+    subp_p.set_defaults(func=lambda x: rank_trial_matches())
+
+    subp_p = subp.add_parser('indexes', help='creates the declared indexes and reports missing or unused ones')
+    subp_p.add_argument("--verify-only", dest='verify_only', action='store_const', const=True, default=False)
+    subp_p.set_defaults(func=run_indexes)
+
     args = main_p.parse_args()
     args.func(args)
@@ -17,6 +17,7 @@ from matchminer.validation import ConsentValidatorEve
 from matchminer.settings import *
 from matchminer.events import register_hooks
 from matchminer import security
+import matchminer.settings
 
 
 class ValueStack(object):
@@ -122,6 +123,14 @@ class TestMinimal(unittest.TestCase):
         self.user_token = self.user['token']
         self.curator_token = self.curator['token']
 
+        # match saved filters and write audit logs and last_auth in the request instead of in the background.
+        matchminer.settings.FILTER_JOB_WORKERS = 0
+        matchminer.settings.HIPAA_QUEUE_SIZE = 0
+        matchminer.settings.LAST_AUTH_WRITE_INTERVAL = 0
+
+        # look up users on every request, tests rewrite the user collection.
+        matchminer.settings.TOKEN_CACHE_TTL = 0
+
         # setup the database.
         self.setupDB()
 
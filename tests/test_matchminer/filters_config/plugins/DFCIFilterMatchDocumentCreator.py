@@ -9,9 +9,21 @@ if TYPE_CHECKING:
     from matchengine.internals.engine import MatchEngine
     from typing import Dict
 
+# genomic documents are looked up in chunks of ids, with only the fields copied to matches
+GENOMIC_CHUNK_SIZE = 1000
+GENOMIC_PROJECTION = {
+    'TRUE_HUGO_SYMBOL': 1,
+    'VARIANT_CATEGORY': 1,
+    'TIER': 1,
+    'ALLELE_FRACTION': 1,
+    'TEST_NAME': 1,
+    'PATHOGENICITY_PATHOLOGIST': 1
+}
+
 
 class DFCIFilterMatchDocumentCreator(TrialMatchDocumentCreator):
     def results_transformer(self: MatchEngine, results: Dict[ClinicalID, List[MatchReason]]):
+        first_variants = dict()
         for clinical_id, reasons in results.items():
             self.cache.docs[clinical_id]['FILTER_ID'] = self.cache.docs[clinical_id]['_id']
 
@@ -29,28 +41,33 @@ class DFCIFilterMatchDocumentCreator(TrialMatchDocumentCreator):
             self.cache.docs[clinical_id]['VARIANTS'] = sorted_variants
 
             if len(sorted_variants) > 0:
-                genomic = list(self.db_ro.genomic.find({'_id': sorted_variants[0]}))
-
-                if len(genomic) > 0:
-                    genomic = genomic[0]
-                    if "TRUE_HUGO_SYMBOL" in genomic and 'TRUE_HUGO_SYMBOL' not in self.cache.docs[clinical_id]:
-                        self.cache.docs[clinical_id]['TRUE_HUGO_SYMBOL'] = genomic['TRUE_HUGO_SYMBOL']
-                    if "VARIANT_CATEGORY" in genomic and 'VARIANT_CATEGORY' not in self.cache.docs[clinical_id]:
-                        self.cache.docs[clinical_id]['VARIANT_CATEGORY'] = genomic['VARIANT_CATEGORY']
-                    if "TIER" in genomic and 'TIER' not in self.cache.docs[clinical_id]:
-                        self.cache.docs[clinical_id]['TIER'] = genomic['TIER']
-                    if "ALLELE_FRACTION" in genomic and 'ALLELE_FRACTION' not in self.cache.docs[clinical_id]:
-                        self.cache.docs[clinical_id]['ALLELE_FRACTION'] = genomic['ALLELE_FRACTION']
-                    if "TEST_NAME" in genomic and 'TEST_NAME' not in self.cache.docs[clinical_id]:
-                        self.cache.docs[clinical_id]['TEST_NAME'] = genomic['TEST_NAME']
-
-                    # RHP samples should populate tier column with PATHOGENICITY_PATHOLOGIST
-                    # val from genomic samples
-                    if "PATHOGENICITY_PATHOLOGIST" in genomic and 'TIER' not in self.cache.docs[clinical_id]:
-                        self.cache.docs[clinical_id]['TIER'] = genomic['PATHOGENICITY_PATHOLOGIST']
+                first_variants[clinical_id] = sorted_variants[0]
 
             results[clinical_id] = [reasons[0]]
 
+        # fetch the first variant of every clinical document at once
+        genomic_docs = dict()
+        variant_ids = list(set(first_variants.values()))
+        for i in range(0, len(variant_ids), GENOMIC_CHUNK_SIZE):
+            query = {'_id': {'$in': variant_ids[i:i + GENOMIC_CHUNK_SIZE]}}
+            for genomic in self.db_ro.genomic.find(query, GENOMIC_PROJECTION):
+                genomic_docs[genomic['_id']] = genomic
+
+        for clinical_id, variant_id in first_variants.items():
+            genomic = genomic_docs.get(variant_id)
+            if genomic is None:
+                continue
+
+            clinical = self.cache.docs[clinical_id]
+            for field in ['TRUE_HUGO_SYMBOL', 'VARIANT_CATEGORY', 'TIER', 'ALLELE_FRACTION', 'TEST_NAME']:
+                if field in genomic and field not in clinical:
+                    clinical[field] = genomic[field]
+
+            # RHP samples should populate tier column with PATHOGENICITY_PATHOLOGIST
+            # val from genomic samples
+            if "PATHOGENICITY_PATHOLOGIST" in genomic and 'TIER' not in clinical:
+                clinical['TIER'] = genomic['PATHOGENICITY_PATHOLOGIST']
+
     def create_trial_matches(self, trial_match: TrialMatch, new_trial_match: Dict) -> Dict:
         """
         Create a filter match document to be inserted into the db.
@@ -0,0 +1,225 @@
+import json
+import random
+import unittest
+import datetime as dt
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+from matchminer.settings import MONGO_URI
+from matchminer.matchengine_v1 import engine
+from matchminer.matchengine_v1.engine import MatchEngine
+from matchminer.matchengine_v1.cache import leaf_cache
+
+DIAGNOSES = ['Melanoma', 'Lung Adenocarcinoma', 'Acute Myeloid Leukemia', 'Colorectal Adenocarcinoma']
+ALTERATIONS = [
+    ('BRAF', 'MUTATION', 'p.V600E', None),
+    ('BRAF', 'MUTATION', 'p.K601E', None),
+    ('KRAS', 'MUTATION', 'p.G12C', None),
+    ('EGFR', 'CNV', None, 'High level amplification'),
+    ('EGFR', 'MUTATION', 'p.L858R', None),
+    ('TP53', 'MUTATION', 'p.R175H', None),
+]
+
+
+class LegacyMatchEngine(MatchEngine):
+    """
+    Matches the way the engine did before leaf queries were batched, cached and evaluated as masks:
+    every leaf of every tree runs its own find() and trees are combined as sets.
+    """
+
+    def plan_leaf_queries(self, match_trees):
+        pass
+
+    def run_query(self, node):
+        matched_genomic_info = []
+        item = dict(node['value'])
+
+        if node['type'] == 'genomic':
+            g, neg, sv = self.prepare_genomic_criteria(item)
+            if not g:
+                return set(), []
+
+            proj = dict(engine.genomic_proj, STRUCTURAL_VARIANT_COMMENT=1) if sv else engine.genomic_proj
+            results = list(self.db.genomic.find(g, proj))
+            if neg:
+                matched_sample_ids = self.all_match - set(x['SAMPLE_ID'] for x in results)
+                alteration, is_variant = engine.format_not_match(g)
+                matched_genomic_info = [{'sample_id': sample_id, 'match_type': is_variant,
+                                         'genomic_alteration': alteration} for sample_id in matched_sample_ids]
+                return matched_sample_ids, matched_genomic_info
+
+            for result in results:
+                alteration, is_variant = engine.format_genomic_alteration(result, g)
+                genomic_info = {'match_type': is_variant, 'genomic_alteration': alteration}
+                for field in proj:
+                    if field in result:
+                        genomic_info['genomic_id' if field == '_id' else field.lower()] = result[field]
+                matched_genomic_info.append(genomic_info)
+            return set(x['SAMPLE_ID'] for x in results), matched_genomic_info
+
+        c = self.prepare_clinical_criteria(item)
+        if not c:
+            return set(), []
+        return set(self.db.clinical.find(c).distinct('SAMPLE_ID')), []
+
+    def traverse_match_tree(self, g):
+        tree_genomic = {}
+        matched = {}
+        for node_id in g.postorder():
+            successors = g.successors(node_id)
+            if len(successors) == 0:
+                matched[node_id], matched_genomic_info = self.run_query(g.nodes[node_id])
+                for match in matched_genomic_info:
+                    tree_genomic.setdefault(match['sample_id'], []).append(match)
+                continue
+
+            matched[node_id] = set(matched[successors[0]])
+            for i in successors[1:]:
+                if g.nodes[node_id]['type'] == 'and':
+                    matched[node_id].intersection_update(matched[i])
+                elif g.nodes[node_id]['type'] == 'or':
+                    matched[node_id].update(matched[i])
+
+        final_sample_ids = matched[1]
+        return final_sample_ids, [tree_genomic[i] for i in sorted(final_sample_ids) if i in tree_genomic]
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MongoClient(MONGO_URI)
+        self.connection.drop_database('matchminer_engine_test')
+        self.db = self.connection['matchminer_engine_test']
+        leaf_cache.clear()
+
+        rng = random.Random(0)
+        clinical = []
+        genomic = []
+        for i in range(60):
+            sample_id = 'ENGINE-%02d' % i
+            clinical.append({
+                'SAMPLE_ID': sample_id,
+                'MRN': 'MRN-%02d' % (i // 2),
+                'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': rng.choice(DIAGNOSES),
+                'BIRTH_DATE': dt.datetime(rng.randint(1940, 2015), 1, 1),
+                'GENDER': rng.choice(['Male', 'Female']),
+                'VITAL_STATUS': 'alive',
+                'REPORT_DATE': dt.datetime(2020, 1, 1),
+                'FIRST_LAST': 'First Last'
+            })
+            for gene, category, protein_change, cnv_call in rng.sample(ALTERATIONS, rng.randint(0, 3)):
+                genomic.append({
+                    'SAMPLE_ID': sample_id,
+                    'TRUE_HUGO_SYMBOL': gene,
+                    'VARIANT_CATEGORY': category,
+                    'TRUE_PROTEIN_CHANGE': protein_change,
+                    'CNV_CALL': cnv_call,
+                    'WILDTYPE': False,
+                    'TIER': rng.randint(1, 4)
+                })
+        self.db.clinical.insert_many(clinical)
+        clinical_ids = {c['SAMPLE_ID']: c['_id'] for c in clinical}
+        for g in genomic:
+            g['CLINICAL_ID'] = clinical_ids[g['SAMPLE_ID']]
+        self.db.genomic.insert_many(genomic)
+
+        self.db.trial.insert_many([
+            _trial('90-001', {'and': [
+                {'genomic': {'hugo_symbol': 'BRAF', 'protein_change': 'p.V600E'}},
+                {'clinical': {'oncotree_primary_diagnosis': '_SOLID_', 'age_numerical': '>=18'}}
+            ]}, arm={'or': [
+                {'genomic': {'hugo_symbol': 'BRAF'}},
+                {'genomic': {'hugo_symbol': 'KRAS', 'variant_category': 'Mutation'}}
+            ]}),
+            _trial('90-002', {'or': [
+                {'genomic': {'hugo_symbol': 'EGFR', 'variant_category': 'Copy Number Variation',
+                             'cnv_call': 'High Amplification'}},
+                {'and': [
+                    {'genomic': {'hugo_symbol': '!TP53'}},
+                    {'clinical': {'oncotree_primary_diagnosis': 'Lung Adenocarcinoma'}}
+                ]}
+            ]}, dose={'clinical': {'oncotree_primary_diagnosis': '_LIQUID_', 'gender': 'Female'}}),
+            _trial('90-003', {'genomic': {'hugo_symbol': 'EGFR'}}, status='Closed to Accrual'),
+        ])
+
+    def tearDown(self):
+        self.connection.drop_database('matchminer_engine_test')
+        leaf_cache.clear()
+
+    def test_find_trial_matches(self):
+
+        LegacyMatchEngine(self.db).find_trial_matches(processes=1)
+        expected = _trial_matches(self.db)
+        assert expected
+
+        # small batches exercise the batched facets, the second run is served by the leaf cache.
+        batch_size = engine.LEAF_BATCH_SIZE
+        engine.LEAF_BATCH_SIZE = 2
+        try:
+            for _ in range(2):
+                self.db.trial_match.drop()
+                MatchEngine(self.db).find_trial_matches(processes=1)
+                assert _trial_matches(self.db) == expected
+        finally:
+            engine.LEAF_BATCH_SIZE = batch_size
+
+    def test_parallel_find_trial_matches(self):
+
+        MatchEngine(self.db).find_trial_matches(processes=1)
+        expected = _trial_matches(self.db)
+
+        # forked workers read the same database as the engine.
+        self.db.trial_match.drop()
+        MatchEngine(self.db).find_trial_matches(processes=2)
+        assert _trial_matches(self.db) == expected
+
+    def test_stream_oversized_leaf(self):
+
+        me = MatchEngine(self.db)
+        specs = [me._prepare_leaf({'type': 'genomic', 'value': {'hugo_symbol': 'BRAF'}}),
+                 me._prepare_leaf({'type': 'genomic', 'value': {'hugo_symbol': '!KRAS'}})]
+        expected = me._run_facets(self.db.genomic, specs)
+
+        # leaves whose facet exceeds the document size limit are streamed.
+        ids = me._run_facets(_OversizedFacets(self.db.genomic), specs)
+        assert [sorted(i) for i in ids] == [sorted(i) for i in expected]
+
+        # other failures are raised.
+        with self.assertRaises(OperationFailure):
+            me._run_facets(_OversizedFacets(self.db.genomic, code=13), specs)
+
+
+class _OversizedFacets(object):
+    """Collection whose aggregations fail like a $facet result over 16MB"""
+
+    def __init__(self, collection, code=10334):
+        self.collection = collection
+        self.code = code
+
+    def aggregate(self, pipeline, **kwargs):
+        raise OperationFailure("BSONObj size is invalid", code=self.code)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def _trial(protocol_no, step, arm=None, dose=None, status='Open to Accrual'):
+    dose_level = {'level_internal_id': 1, 'level_code': 'D1', 'level_suspended': 'N'}
+    if dose is not None:
+        dose_level['match'] = [dose]
+    arm_level = {'arm_internal_id': 1, 'arm_code': 'A1', 'arm_suspended': 'N', 'dose_level': [dose_level]}
+    if arm is not None:
+        arm_level['match'] = [arm]
+    return {
+        'protocol_no': protocol_no,
+        'nct_id': 'NCT-' + protocol_no,
+        '_summary': {'status': [{'value': status}]},
+        'treatment_list': {'step': [{'step_internal_id': 1, 'step_code': 'S1', 'match': [step], 'arm': [arm_level]}]}
+    }
+
+
+def _trial_matches(db):
+    matches = [json.dumps({k: v for k, v in match.items() if k != '_id'}, sort_keys=True, default=str)
+               for match in db.trial_match.find()]
+    return sorted(matches)
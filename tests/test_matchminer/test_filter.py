@@ -1,5 +1,9 @@
 import json
+import datetime
+import threading
 from bson.objectid import ObjectId
+from matchminer import miner
+from matchminer.run_stats import RunStats
 from tests.test_matchminer import TestMinimal
 
 
@@ -458,3 +462,163 @@ class TestFilter(TestMinimal):
         #
         # filter_doc = self.db['filter'].find_one({"_id": ObjectId(r['_id'])})
         # assert filter_doc['description'] == 'ERCC2 V600E Mutation in Adrenocortical Adenoma, Gender: Male, Age > 17'
+
+    def test_changed_sample_ids(self):
+
+        since = datetime.datetime.utcnow()
+        clinical = list(self.db['clinical'].find({}, {'SAMPLE_ID': 1}).limit(2))
+        assert len(clinical) == 2
+
+        # touch one clinical document and the genomic documents of another.
+        now = datetime.datetime.utcnow()
+        self.db['clinical'].update_one({'_id': clinical[0]['_id']}, {'$set': {'_updated': now}})
+        self.db['genomic'].update_many({'CLINICAL_ID': clinical[1]['_id']}, {'$set': {'_updated': now}})
+
+        sample_ids = miner.changed_sample_ids(self.db, since)
+        assert clinical[0]['SAMPLE_ID'] in sample_ids
+        if self.db['genomic'].count_documents({'CLINICAL_ID': clinical[1]['_id']}) > 0:
+            assert clinical[1]['SAMPLE_ID'] in sample_ids
+
+        # nothing changed since now.
+        assert miner.changed_sample_ids(self.db, datetime.datetime.utcnow()) == set()
+
+    def test_filter_job(self):
+
+        rule = {
+            'USER_ID': self.user_id,
+            'TEAM_ID': self.team_id,
+            'genomic_filter': {'CNV_CALL': ["High level amplification"]},
+            'label': 'test',
+            'temporary': False,
+            'status': 1
+        }
+
+        # saved filters are matched by a job.
+        r, status_code = self.post('filter', rule)
+        self.assert201(status_code)
+        assert '_job_id' in r
+
+        r, status_code = self.get('filter_job/%s' % r['_job_id'])
+        self.assert200(status_code)
+        assert r['status'] == 'done'
+        assert r['num_samples'] > 0
+        assert len(r['enrollment']['x_axis']) == len(r['enrollment']['y_axis'])
+
+        # unknown jobs.
+        r, status_code = self.get('filter_job/%s' % ObjectId())
+        self.assert404(status_code)
+
+    def test_stale_filter_job(self):
+
+        rule = {
+            'USER_ID': self.user_id,
+            'TEAM_ID': self.team_id,
+            'genomic_filter': {'CNV_CALL': ["High level amplification"]},
+            'label': 'test',
+            'temporary': False,
+            'status': 1
+        }
+        r, status_code = self.post('filter', rule)
+        self.assert201(status_code)
+        job_id = ObjectId(r['_job_id'])
+
+        # jobs whose worker died while running them are run again.
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.db['filter_job'].update_one({'_id': job_id}, {'$set': {
+            'status': 'running', 'owner': 'dead', 'expires': expired, 'num_samples': None}})
+
+        r, status_code = self.get('filter_job/%s' % job_id)
+        self.assert200(status_code)
+        assert r['status'] == 'done'
+        assert r['num_samples'] > 0
+        assert r['attempts'] == 2
+
+        # until they have been abandoned too often.
+        self.db['filter_job'].update_one({'_id': job_id}, {'$set': {
+            'status': 'running', 'owner': 'dead', 'expires': expired,
+            'attempts': miner.settings.FILTER_JOB_MAX_ATTEMPTS}})
+
+        r, status_code = self.get('filter_job/%s' % job_id)
+        self.assert200(status_code)
+        assert r['status'] == 'failed'
+
+    def test_run_stats(self):
+
+        stats = RunStats()
+        other_thread = threading.Thread(target=self.db['clinical'].find_one)
+        with stats.collect(), stats.stage('total'):
+            with stats.stage('query', 'filter1'):
+                clinical = list(self.db['clinical'].find({}, {'_id': 1}).limit(2))
+
+                # commands of other threads are not counted.
+                other_thread.start()
+                other_thread.join()
+            stats.count('query', 'num_samples', len(clinical), 'filter1')
+
+            # collection doesn't nest.
+            with self.assertRaises(RuntimeError):
+                with RunStats().collect():
+                    pass
+
+        # commands are not counted once collection stopped.
+        self.db['clinical'].find_one()
+
+        doc = stats.as_document()
+        for stage in ['total', 'query']:
+            assert doc['stages'][stage]['calls'] == 1
+            assert doc['stages'][stage]['db_round_trips'] == 1
+            assert doc['stages'][stage]['docs_returned'] == len(clinical)
+        assert doc['items']['query'][0]['item'] == 'filter1'
+        assert doc['items']['query'][0]['num_samples'] == len(clinical)
+
+    def test_filter_hash(self):
+
+        filter_id = ObjectId()
+        self.db['filter'].insert_one({
+            '_id': filter_id,
+            'USER_ID': self.user_id,
+            'TEAM_ID': self.team_id,
+            'genomic_filter': {'TRUE_HUGO_SYMBOL': ['BRAF', 'BRAF'], 'VARIANT_CATEGORY': ['MUTATION']},
+            'clinical_filter': {'GENDER': 'Female'},
+            'label': 'test',
+            'temporary': False,
+            'status': 1
+        })
+
+        # compiled and hashed on the first run, duplicate clauses are removed.
+        miner.transform_filter_to_CTML([self.db['filter'].find_one({'_id': filter_id})], save=True)
+        filter_doc = self.db['filter'].find_one({'_id': filter_id})
+        assert filter_doc['filter_hash'] == miner.get_filter_hash(filter_doc)
+        assert filter_doc['match'][0]['and'][1] == {
+            'or': [{'genomic': {'TRUE_HUGO_SYMBOL': 'BRAF', 'VARIANT_CATEGORY': 'MUTATION'}}]
+        }
+
+        # unchanged filters are not compiled or written again.
+        self.db['filter'].update_one({'_id': filter_id}, {'$set': {'match': []}})
+        miner.transform_filter_to_CTML([self.db['filter'].find_one({'_id': filter_id})], save=True)
+        assert self.db['filter'].find_one({'_id': filter_id})['match'] == []
+
+        # changed filters are.
+        self.db['filter'].update_one({'_id': filter_id}, {'$set': {'genomic_filter.TRUE_HUGO_SYMBOL': ['BRAF', 'KRAS']}})
+        miner.transform_filter_to_CTML([self.db['filter'].find_one({'_id': filter_id})], save=True)
+        filter_doc = self.db['filter'].find_one({'_id': filter_id})
+        assert len(filter_doc['match'][0]['and'][1]['or']) == 2
+        self.db['filter'].delete_one({'_id': filter_id})
+
+    def test_genomic_or_clauses(self):
+
+        genomic_filter = {
+            'TRUE_HUGO_SYMBOL': ['BRAF', 'KRAS'],
+            'VARIANT_CATEGORY': ['MUTATION', 'CNV'],
+            'CNV_CALL': ['High level amplification', 'Homozygous deletion'],
+            'TIER': [1, 2]
+        }
+        item = {'genomic_filter': genomic_filter, 'clinical_filter': {}}
+        miner.transform_filter_to_CTML([item])
+
+        # every multi-valued key is expanded, CNV_CALL only for CNV's.
+        or_clauses = [clause['genomic'] for clause in item['match'][0]['and'][1]['or']]
+        assert len(or_clauses) == 2 * 2 + 2 * 2 * 2
+        for clause in or_clauses:
+            assert ('CNV_CALL' in clause) == (clause['VARIANT_CATEGORY'] == 'CNV')
+            assert 'TIER' in clause
@@ -6,7 +6,12 @@ from email.utils import formatdate
 import time
 import datetime
 
+import tempfile
+
+from pymongo.errors import AutoReconnect
+
 from tests.test_matchminer import TestMinimal
+from matchminer.event_hooks.hipaa import HipaaAuditWriter
 
 class TestHipaa(TestMinimal):
 
@@ -99,3 +104,71 @@ class TestHipaa(TestMinimal):
 
         # assert we get a log for each entry.
         assert 1 == len(hipaa_logs)
+
+    def test_audit_writer(self):
+
+        spool_dir = tempfile.mkdtemp()
+        writer = HipaaAuditWriter(self.db, 2, 3, spool_dir)
+
+        # responses are written in batches.
+        for i in range(5):
+            writer.submit([_transaction(i)])
+        writer.flush()
+        assert self.db['hipaa'].count_documents({}) == 5
+
+        # transactions which can't be written are spooled to a file only the process can read.
+        writer.db = _UnavailableDatabase()
+        writer.write([_transaction(5)])
+        assert self.db['hipaa'].count_documents({}) == 5
+        assert os.stat(writer.spool_path).st_mode & 0o777 == 0o600
+
+        # spooled transactions are written with the next successful write.
+        writer.db = self.db
+        writer.write([_transaction(6)])
+        assert self.db['hipaa'].count_documents({}) == 7
+        assert os.listdir(spool_dir) == []
+
+        # spools of processes which have exited are replayed too.
+        pid = os.fork()
+        if pid == 0:
+            HipaaAuditWriter(_UnavailableDatabase(), 2, 3, spool_dir).write([_transaction(7)])
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert len(os.listdir(spool_dir)) == 1
+
+        writer.write([_transaction(8)])
+        assert self.db['hipaa'].count_documents({}) == 9
+        assert os.listdir(spool_dir) == []
+
+        # transactions are not spooled without a private spool directory.
+        os.chmod(spool_dir, 0o755)
+        writer.db = _UnavailableDatabase()
+        with self.assertRaises(RuntimeError):
+            writer.write([_transaction(9)])
+        with self.assertRaises(RuntimeError):
+            HipaaAuditWriter(_UnavailableDatabase(), 2, 3, None).write([_transaction(9)])
+        assert os.listdir(spool_dir) == []
+
+        # the writer keeps running when transactions can't be spooled either.
+        writer = HipaaAuditWriter(_UnavailableDatabase(), 2, 3, os.path.join(tempfile.mkstemp()[1], 'spool'))
+        writer.submit([_transaction(9)])
+        writer.flush()
+
+        writer.db = self.db
+        writer.submit([_transaction(10)])
+        writer.flush()
+        assert self.db['hipaa'].count_documents({}) == 10
+
+
+class _UnavailableDatabase(object):
+    """Database whose inserts fail like an unreachable server"""
+
+    def __getitem__(self, name):
+        return self
+
+    def insert_many(self, *args, **kwargs):
+        raise AutoReconnect("connection refused")
+
+
+def _transaction(patient_id):
+    return {'user_id': 'jd00', 'patient_id': str(patient_id), 'timestamp': datetime.datetime.now()}
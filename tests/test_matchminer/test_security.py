@@ -7,7 +7,9 @@ import datetime
 from email.utils import formatdate
 from bson import ObjectId
 
+import matchminer.settings
 from matchminer import miner
+from matchminer.security import get_last_auth_writer
 from tests.test_matchminer import TestMinimal
 
 
@@ -361,3 +363,83 @@ class TestSecurity(TestMinimal):
 
             # assert we only get filters with this team id.
             assert f['TEAM_ID'] == str(team2_id)
+
+    def test_token_cache(self):
+
+        # add an admin.
+        matchminer.settings.TOKEN_CACHE_TTL = 30
+        self.db['user'].insert({
+            'user_name': "",
+            'first_name': "",
+            'last_name': "",
+            'title': "",
+            'email': "",
+            'token': "admin",
+            'teams': [],
+            'roles': ["admin"]
+        })
+
+        # add two users, their first request caches them.
+        users = {}
+        for token in ["patched", "deleted"]:
+            self.user_token = "admin"
+            r, status_code = self.post('user', {
+                'user_name': token,
+                'first_name': "",
+                'last_name': "",
+                'title': "",
+                'email': "",
+                'teams': [],
+                'roles': ["user"]
+            })
+            self.assert201(status_code)
+            self.db['user'].update_one({'_id': ObjectId(r['_id'])}, {'$set': {'token': token}})
+            users[token] = r
+
+            self.user_token = token
+            r, status_code = self.get('genomic', query="?max_results=1")
+            self.assert200(status_code)
+
+        # changes made around the api are picked up when the cache expires.
+        self.db['user'].update_one({'_id': ObjectId(users["deleted"]['_id'])}, {'$set': {'roles': []}})
+        r, status_code = self.get('genomic', query="?max_results=1")
+        self.assert200(status_code)
+
+        # updating or deleting a user through the api drops its cached token.
+        self.user_token = "admin"
+        r, status_code = self.patch('user/%s' % users["patched"]['_id'], {'roles': ["curator"]},
+                                    headers=[('If-Match', users["patched"]['_etag'])])
+        self.assert200(status_code)
+        r, status_code = self.delete('user/%s' % users["deleted"]['_id'],
+                                     headers=[('If-Match', users["deleted"]['_etag'])])
+        assert status_code == 204
+
+        for token in ["patched", "deleted"]:
+            self.user_token = token
+            r, status_code = self.get('genomic', query="?max_results=1")
+            assert status_code == 401
+
+    def test_last_auth_writer(self):
+
+        # add a user.
+        matchminer.settings.LAST_AUTH_WRITE_INTERVAL = 3600
+        user_id = self.db['user'].insert({'token': 'abc', 'teams': [], 'roles': ["user"]})
+        self.user_token = 'abc'
+
+        # authentications are kept until the writer flushes.
+        for _ in range(2):
+            r, status_code = self.get('genomic', query="?max_results=1")
+            self.assert200(status_code)
+        assert 'last_auth' not in self.db['user'].find_one({'_id': user_id})
+
+        get_last_auth_writer(self.db['user']).flush()
+        assert 'last_auth' in self.db['user'].find_one({'_id': user_id})
+
+        # the writes never move last_auth back.
+        later = datetime.datetime(2100, 1, 1)
+        self.db['user'].update_one({'_id': user_id}, {'$set': {'last_auth': later}})
+        r, status_code = self.get('genomic', query="?max_results=1")
+        self.assert200(status_code)
+
+        get_last_auth_writer(self.db['user']).flush()
+        assert self.db['user'].find_one({'_id': user_id})['last_auth'] == later
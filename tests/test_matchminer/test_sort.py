@@ -0,0 +1,20 @@
+import unittest
+
+from matchminer.matchengine_v1.sort import add_sort_order
+from benchmarks.benchmark_sort import add_sort_order_legacy, synthetic_trial_matches
+
+
+class TestSort(unittest.TestCase):
+
+    def test_add_sort_order(self):
+
+        for seed in range(3):
+            df = synthetic_trial_matches(rows=1000, samples=100, protocols=50, seed=seed)
+            new = add_sort_order(df.copy())
+            old = add_sort_order_legacy(df.copy())
+            assert new['sort_order'].equals(old['sort_order'])
+
+        # matches filtered out entirely are not ranked.
+        df = synthetic_trial_matches(rows=10, samples=2, seed=0)
+        df['vital_status'] = 'deceased'
+        assert (add_sort_order(df)['sort_order'] == -1).all()
@@ -0,0 +1,58 @@
+import json
+
+from matchminer.event_hooks.trial_match import rank_trial_matches
+from tests.test_matchminer import TestMinimal
+
+
+class TestTrialMatch(TestMinimal):
+
+    def setUp(self, settings_file=None, url_converters=None):
+        super(TestTrialMatch, self).setUp(settings_file=None, url_converters=None)
+        self.user_token = self.service_token
+
+        statuses = {'RANK-1': 'Open to Accrual', 'RANK-2': 'Closed to Accrual', 'RANK-3': 'Open to Accrual'}
+        for protocol_no, status in statuses.items():
+            self.db['trial'].insert_one({'protocol_no': protocol_no, '_summary': {'status': [{'value': status}]}})
+
+        # sort orders are given best first, protocol number last.
+        self.db['trial_match'].insert_many([
+            {'sample_id': 'RANK-S1', 'protocol_no': 'RANK-3', 'sort_order': [2, 1, 3]},
+            {'sample_id': 'RANK-S1', 'protocol_no': 'RANK-1', 'sort_order': [0, 1, 1]},
+            {'sample_id': 'RANK-S1', 'protocol_no': 'RANK-2', 'sort_order': [1, 0, 2]},
+            {'sample_id': 'RANK-S1', 'protocol_no': 'RANK-1', 'sort_order': [3, 0, 1]},
+            {'sample_id': 'RANK-S1', 'protocol_no': 'RANK-3', 'sort_order': [0, 0, 3], 'is_disabled': True},
+        ])
+
+    def tearDown(self):
+        self.db['trial'].delete_many({'protocol_no': {'$regex': '^RANK-'}})
+        self.db['trial_match'].delete_many({'sample_id': 'RANK-S1'})
+
+    def test_rank_trial_matches(self):
+
+        assert rank_trial_matches(self.db) == 4
+        assert rank_trial_matches(self.db) == 0
+
+        # ranks hold across pages.
+        assert self._pages() == [('RANK-1', 1), ('RANK-2', -1), ('RANK-3', 2), ('RANK-1', 1)]
+
+        # disabled matches aren't ranked.
+        assert 'rank' not in self.db['trial_match'].find_one({'sample_id': 'RANK-S1', 'is_disabled': True})
+
+        # pages with a match rewritten since it was ranked are sorted page by page.
+        self.db['trial_match'].update_one({'protocol_no': 'RANK-2'}, {'$set': {'sort_order': [0, 0, 2]}})
+        assert self._pages()[:2] == [('RANK-2', -1), ('RANK-1', 1)]
+
+        assert rank_trial_matches(self.db) == 2
+        assert self._pages() == [('RANK-2', -1), ('RANK-1', 1), ('RANK-3', 2), ('RANK-1', 1)]
+
+    def _pages(self):
+        where = json.dumps({'sample_id': 'RANK-S1', 'is_disabled': {'$ne': True}})
+        ranks = list()
+        for page in (1, 2):
+            r, status_code = self.get('trial_match', query='?where=%s&max_results=2&page=%d' % (where, page))
+            self.assert200(status_code)
+            ranks.extend((item['protocol_no'], item['sort_order']) for item in r['_items'])
+
+            # rank bookkeeping isn't returned.
+            assert not any('rank_hash' in item for item in r['_items'])
+        return ranks
@@ -1,9 +1,13 @@
 import oncotreenx
+import networkx as nx
 
 from matchminer.utilities import *
+from matchminer.indexes import ensure_indexes, index_report
 from matchminer.validation import check_valid_email_address
 from tests.test_matchminer import TestMinimal
-from matchminer.trial_search import Autocomplete, expand_liquid_oncotree
+from matchminer.oncotree import get_oncotree
+from matchminer.matchengine_v1.cache import LeafResultCache, estimate_size
+from matchminer.trial_search import Autocomplete, get_primary_tumors
 
 
 class TestUtilities(TestMinimal):
@@ -104,10 +108,45 @@ class TestUtilities(TestMinimal):
 
     def test_expand_liquid_oncotree(self):
 
-        onco_tree = oncotreenx.build_oncotree(file_path=TUMOR_TREE)
-        l, s, = expand_liquid_oncotree(onco_tree)
-        assert 'Leukemia' in l
-        assert 'Leukemia' not in s
+        onco_tree = get_oncotree(TUMOR_TREE)
+        assert 'Leukemia' in onco_tree.liquid_texts
+        assert 'Leukemia' not in onco_tree.solid_texts
+
+    def test_get_oncotree(self):
+
+        onco_tree = get_oncotree(TUMOR_TREE)
+        assert onco_tree is get_oncotree(TUMOR_TREE)
+
+        # precomputed expansions agree with the graph traversal.
+        l, s, = _expand_liquid_oncotree(oncotreenx.build_oncotree(file_path=TUMOR_TREE))
+        assert onco_tree.liquid_texts == set(l)
+        assert onco_tree.solid_texts == set(s)
+
+        blood = onco_tree.lookup_text('Blood')
+        assert blood in onco_tree.subtree(blood)
+        assert blood not in onco_tree.descendants(blood)
+        assert onco_tree.ancestors(blood) == ('root',)
+
+    def test_leaf_result_cache(self):
+
+        a = (frozenset(['S1', 'S2']), (), None)
+        b = (frozenset(['S3']), ({'sample_id': 'S3', 'genomic_alteration': 'KRAS'},), None)
+        cache = LeafResultCache(max_bytes=estimate_size(a) + estimate_size(b))
+
+        cache.put('v1', 'a', a)
+        cache.put('v1', 'b', b)
+        assert cache.get('v1', 'a') is a
+        assert cache.get('v2', 'a') is None
+
+        # least recently used result is evicted over the cap.
+        cache.put('v1', 'c', (frozenset(['S4']), (), None))
+        assert cache.get('v1', 'b') is None
+        assert cache.get('v1', 'a') is a
+
+        # a new data version drops everything computed before it.
+        cache.put('v2', 'b', b)
+        assert len(cache) == 1
+        assert cache.get('v1', 'a') is None
 
     def test_get_cancer_type_weight(self):
 
@@ -183,6 +222,19 @@ class TestUtilities(TestMinimal):
         r = self.a._get_tumor_types_search(ct_suggest)
         assert r == ["_LIQUID_"]
 
+    def test_indexes(self):
+
+        # every declared index exists and the hot queries use them.
+        ensure_indexes(self.db, DOMAIN)
+        report = index_report(self.db, DOMAIN)
+        assert report['missing'] == []
+        assert report['collection_scans'] == []
+
+        # a query on an unindexed field is reported.
+        query = {'FIRST_NAME': 'John'}
+        report = index_report(self.db, DOMAIN, queries=[('clinical', query)])
+        assert report['collection_scans'] == [{'collection': 'clinical', 'query': query}]
+
     def test_check_valid_email_address(self):
 
         good_address = "demo@demo.demo"
@@ -192,3 +244,29 @@ class TestUtilities(TestMinimal):
         res2 = check_valid_email_address(bad_address)
         assert res1
         assert not res2
+
+
+def _expand_liquid_oncotree(onco_tree):
+    """
+    Expands _LIQUID_ and _SOLID_ by walking the oncotree graph, the reference for OncoTree
+
+    :param onco_tree: Digraph of the Oncotree
+    :returns liquid_children: All liquid tumor types in the Oncotree
+             solid_children: All tumor types in the Oncotree minus "liquid_children"
+    """
+    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
+    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
+    nodes = set(nx.dfs_tree(onco_tree, node1)).union(set(nx.dfs_tree(onco_tree, node2)))
+
+    primary_tumors = get_primary_tumors()
+
+    liquid_children_codes = []
+    for n in nodes:
+        liquid_children_codes.extend(list(nx.dfs_tree(onco_tree, n)))
+
+    liquid_children = [onco_tree.nodes[nn]['text'] for nn in liquid_children_codes
+                       if onco_tree.nodes[nn]['text'].strip() not in primary_tumors]
+    solid_children = [onco_tree.nodes[nn]['text'] for nn in set(onco_tree.nodes()) - nodes
+                      if onco_tree.nodes[nn]['text'].strip() not in primary_tumors]
+
+    return liquid_children, solid_children